@@ -0,0 +1,288 @@
+"""
+Usage:
+    bench_rapy.py [options] [POINTS...]
+    bench_rapy.py -h | --help
+
+Benchmark the probing pipeline of rapy against a local mock routing server,
+without any API key or network access. The accessibilities of all the
+points in the POINTS csv files, by default the Munich test sets in
+`input/`, are calculated with every router from the landmark, and the
+throughput, latencies and memory use are written as JSON to RESULTS. With
+a BASELINE of an earlier run, the benchmarks which got slower by more than
+TOLERANCE are reported and the exit status is 1.
+
+Options:
+    -r ROUTERS     Comma separated routers to benchmark
+                   [default: mapbox,openrouteservice,google]
+    -f LANDMARK    Source location of the paths in a GeoJSON file
+                   [default: input/muenchen-hbf.json]
+    -w WORKERS     Number of concurrent requests [default: 4]
+    --async        Send the requests from one event loop, with up to WORKERS
+                   of them in flight
+    -s STORE       How the routes are saved, `files`, `sqlite` or `none`
+                   [default: files]
+    --latency=SECONDS
+                   Latency of the mock server [default: 0.0]
+    --jitter=SECONDS
+                   Maximum random latency added by the mock server
+                   [default: 0.0]
+    --error-rate=RATE
+                   Probability of HTTP 503 responses [default: 0.0]
+    --rate-limit=RPS
+                   Requests per second answered by the mock server before
+                   HTTP 429, unlimited if not given
+    --no-route-rate=RATE
+                   Fraction of the points without a path [default: 0.1]
+    --tracemalloc  Trace the peak of Python memory allocations, which makes
+                   the benchmarks much slower
+    -o RESULTS     Write the results to a JSON file [default: bench.json]
+    -c BASELINE    Compare with the results of an earlier run
+    --tolerance=FRACTION
+                   Allowed slowdown compared to BASELINE [default: 0.1]
+    -h --help      Show this help
+"""
+
+import functools
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rap import __version__  # noqa: E402
+from rap.google import GoogleMapsRouter  # noqa: E402
+from rap.mapbox import MapboxRouter  # noqa: E402
+from rap.mockserver import MockRoutingServer  # noqa: E402
+from rap.ors import OpenRouteServiceRouter  # noqa: E402
+from rap.rapy import iter_accessibility, \
+    iter_accessibility_in_event_loop, read_points  # noqa: E402
+from rap.store import DirectoryStore, SQLiteStore  # noqa: E402
+
+ROUTERS = {
+    'mapbox': (MapboxRouter, 'mapbox-mock-token'),
+    'openrouteservice': (OpenRouteServiceRouter, 'ors-mock-key'),
+    'google': (GoogleMapsRouter, 'AIza-mock-key')
+}
+
+DEFAULT_POINTS = ['input/mini_munich.csv', 'input/munich.csv',
+                  'input/dense-munich.csv']
+
+# Metrics of which a higher value is a regression
+LOWER_IS_BETTER = ['p50_latency', 'p99_latency', 'wall_time']
+
+
+class NullStore(object):
+    """Throw the routes away, to measure the requests only."""
+
+    def save(self, source_id, target_id, route):
+        pass
+
+    def close(self):
+        pass
+
+
+def percentile(values, q):
+    """Get the q-th percentile of a list of values, nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(q / 100.0 * len(values))) - 1
+    rank = max(0, min(len(values) - 1, rank))
+    return values[rank]
+
+
+def timed(func, latencies):
+    """Wrap func to append the seconds taken by every call to latencies."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def timed_async(func, latencies):
+    """Same as `timed` for a coroutine function."""
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def open_store(kind, output_dir):
+    if kind == 'none':
+        return NullStore()
+    if kind == 'sqlite':
+        return SQLiteStore(os.path.join(output_dir, 'routes.db'))
+    return DirectoryStore(output_dir)
+
+
+def run_case(mock, router_name, points_file, landmark, workers, store_kind,
+             use_async=False, trace=False):
+    """Probe all the points of a file with a router and measure it.
+
+    :return: dict of the metrics
+    """
+    cls, key = ROUTERS[router_name]
+    router = cls('walking', key, pool_size=workers)
+    router.set_base_url(mock.url)
+    latencies = []
+    if use_async:
+        router.max_in_flight = workers
+        router.find_path_raw_async = timed_async(
+            router.find_path_raw_async, latencies)
+        probe = functools.partial(iter_accessibility_in_event_loop,
+                                  concurrency=workers)
+    else:
+        router.find_path_raw = timed(router.find_path_raw, latencies)
+        probe = functools.partial(iter_accessibility, workers=workers)
+    output_dir = tempfile.mkdtemp(prefix='bench-rapy-')
+    store = open_store(store_kind, output_dir)
+    before = dict(mock.stats)
+    if trace:
+        tracemalloc.start()
+    found = probed = 0
+    start = time.perf_counter()
+    try:
+        for res in probe(router, landmark, read_points(points_file), store):
+            probed += 1
+            found += res['acc']
+        store.close()
+        wall_time = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace else None
+    finally:
+        if trace:
+            tracemalloc.stop()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    requests = {k: mock.stats[k] - before[k] for k in mock.stats}
+    return {
+        'router': router_name,
+        'points': os.path.basename(points_file),
+        'probed': probed,
+        'found': found,
+        'requests': requests['requests'],
+        'rate_limited': requests['rate_limited'],
+        'server_errors': requests['errors'],
+        'bytes_received': requests['bytes_sent'],
+        'wall_time': wall_time,
+        'requests_per_second': requests['requests'] / wall_time,
+        'points_per_second': probed / wall_time,
+        'p50_latency': percentile(latencies, 50),
+        'p99_latency': percentile(latencies, 99),
+        'peak_traced_memory': peak,
+        # Peak resident memory of the whole process so far, in KiB on Linux
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Find the benchmarks that got slower than in the baseline.
+
+    :return: list of messages about the regressions
+    """
+    old = {(b['router'], b['points']): b for b in baseline['benchmarks']}
+    regressions = []
+    for b in results['benchmarks']:
+        o = old.get((b['router'], b['points']))
+        if o is None:
+            continue
+        for metric in LOWER_IS_BETTER:
+            if b[metric] and o[metric] and \
+                    b[metric] > o[metric] * (1 + tolerance):
+                regressions.append("{0} {1}: {2} {3:.4f} -> {4:.4f}".format(
+                    b['router'], b['points'], metric, o[metric], b[metric]))
+        if b['points_per_second'] < \
+                o['points_per_second'] * (1 - tolerance):
+            regressions.append("{0} {1}: points_per_second {2:.1f} -> "
+                               "{3:.1f}".format(b['router'], b['points'],
+                                                o['points_per_second'],
+                                                b['points_per_second']))
+    return regressions
+
+
+def main():
+    args = docopt(__doc__)
+    # Like rapy without --verbose, logging would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+    with open(args['-f'], 'r') as f:
+        landmark = json.load(f)
+    points_files = args['POINTS'] or DEFAULT_POINTS
+    routers = args['-r'].split(',')
+    for name in routers:
+        if name not in ROUTERS:
+            sys.exit("Unknown router {0}, should be one of {1}".format(
+                name, ', '.join(sorted(ROUTERS))))
+    params = {
+        'workers': int(args['-w']),
+        'async': args['--async'],
+        'store': args['-s'],
+        'latency': float(args['--latency']),
+        'jitter': float(args['--jitter']),
+        'error_rate': float(args['--error-rate']),
+        'rate_limit': int(args['--rate-limit'])
+        if args['--rate-limit'] else None,
+        'no_route_rate': float(args['--no-route-rate'])
+    }
+    results = {
+        'commit': git_commit(),
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'benchmarks': []
+    }
+    mock = MockRoutingServer(latency=params['latency'],
+                             jitter=params['jitter'],
+                             error_rate=params['error_rate'],
+                             rate_limit=params['rate_limit'],
+                             no_route_rate=params['no_route_rate'], seed=0)
+    with mock:
+        for points_file in points_files:
+            for name in routers:
+                res = run_case(mock, name, points_file, landmark,
+                               params['workers'], params['store'],
+                               params['async'], args['--tracemalloc'])
+                results['benchmarks'].append(res)
+                print("{router:>16} {points:>18} {probed:>6} points "
+                      "{points_per_second:9.1f}/s {requests_per_second:9.1f} "
+                      "req/s p50 {p50_latency:.4f}s p99 {p99_latency:.4f}s".
+                      format(**res))
+    with open(args['-o'], 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {0}".format(args['-o']))
+    if args['-c']:
+        with open(args['-c'], 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline,
+                              float(args['--tolerance']))
+        for r in regressions:
+            print("Regression: {0}".format(r))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Adaptive probing refining a grid only where the accessibility changes
+"""
+
+import logging
+from .grid import grid_coords, grid_shape, points_in_polygons
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _split(r0, r1):
+    # Split a span of grid rows or columns in halves sharing the middle one
+    if r1 - r0 <= 1:
+        return [(r0, r1)]
+    mid = (r0 + r1) // 2
+    return [(r0, mid), (mid, r1)]
+
+
+def iter_adaptive(probe, bbox, coarse_spacing, min_spacing, threshold=None,
+                  mask=None):
+    """Probe a quadtree over a test area, refined where the results differ.
+
+    A coarse grid is probed first. Then every cell whose corners disagree on
+    the accessibility, or whose travel times differ by more than threshold,
+    is split in four, and the new corners are probed, until the cells are as
+    small as min_spacing. The points get the ids they would have in the full
+    grid with min_spacing, see `rap.grid.grid_points`.
+
+    :param probe: function probing an iterable of points, dicts with `x`, `y`
+        and `id`, and returning an iterable of the results in the same
+        order, dicts with at least `id` and `acc`, e.g. a partial of
+        `rap.rapy.iter_accessibility`
+    :param Dict bbox: `left`, `right`, `top` and `bottom` of the test area
+    :param float coarse_spacing: spacing of the first grid in degrees
+    :param float min_spacing: spacing of the finest cells in degrees
+    :param float threshold: maximum difference of the `duration` of the
+        results at the corners of a cell, ignored if None
+    :param list mask: polygons out of which the points are not probed, see
+        `rap.grid.load_mask`
+    :return: generator of the results as they are probed, level by level
+    """
+    rows, cols = grid_shape(bbox, min_spacing)
+    step = max(1, int(round(coarse_spacing / min_spacing)))
+    row_spans = [(r, min(r + step, rows - 1))
+                 for r in range(0, max(rows - 1, 1), step)]
+    col_spans = [(c, min(c + step, cols - 1))
+                 for c in range(0, max(cols - 1, 1), step)]
+    cells = [(r, c) for r in row_spans for c in col_spans]
+    results = {}
+    level = 0
+    while cells:
+        corners = sorted({r * cols + c
+                          for (r0, r1), (c0, c1) in cells
+                          for r in (r0, r1) for c in (c0, c1)} -
+                         set(results))
+        xs, ys = grid_coords(bbox, min_spacing, corners)
+        if mask is not None:
+            inside = points_in_polygons(xs, ys, mask)
+            outside = [i for i, k in zip(corners, inside) if not k]
+            results.update((i, None) for i in outside)
+            corners, xs, ys = [i for i, k in zip(corners, inside) if k], \
+                xs[inside], ys[inside]
+        LOGGER.info("Probe %s new points of %s cells at level %s",
+                    len(corners), len(cells), level)
+        pts = ({'x': x, 'y': y, 'id': i}
+               for i, x, y in zip(corners, xs.tolist(), ys.tolist()))
+        for res in probe(pts):
+            results[res['id']] = res
+            yield res
+
+        refined = []
+        for (r0, r1), (c0, c1) in cells:
+            if r1 - r0 <= 1 and c1 - c0 <= 1:
+                continue
+            # A corner given up after failing is missing, like one out of
+            # the mask
+            corner_res = [results.get(r * cols + c)
+                          for r in (r0, r1) for c in (c0, c1)]
+            if _uniform(corner_res, threshold):
+                continue
+            refined.extend((rs, cs) for rs in _split(r0, r1)
+                           for cs in _split(c0, c1))
+        cells = refined
+        level += 1
+
+
+def _uniform(corner_res, threshold):
+    # Whether all the probed corners of a cell agree, a cell partly out of
+    # the mask is never uniform so that the edge of the mask is refined too
+    if any(res is None for res in corner_res):
+        return all(res is None for res in corner_res)
+    if len({res['acc'] for res in corner_res}) > 1:
+        return False
+    if threshold is not None:
+        durations = [res.get('duration') for res in corner_res]
+        if None not in durations and \
+                max(durations) - min(durations) > threshold:
+            return False
+    return True
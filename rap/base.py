@@ -1,38 +1,889 @@
 """Base routing service class"""
 
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
 import requests
-from cachecontrol import CacheControl
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from . import __version__
 from . import errors
+from .metrics import Metrics
+from .ratelimit import CircuitBreaker, RateLimiter, retry_after_seconds
+from .replay import RECORD, REPLAY, STRICT, ArchiveAdapter, not_recorded
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
+LOGGER = logging.getLogger(__name__)
 
-def Session():
+
+# Defaults of the `http` settings of a router in routerconf.json
+HTTP_DEFAULTS = {
+    # Connections kept alive per host, at least the number of workers
+    'pool_size': 10,
+    # Retries of a request failing to connect or with a 5xx status
+    'retries': 3,
+    # Maximum seconds before the n-th retry are backoff_factor * 2^(n-1)
+    'backoff_factor': 0.5,
+    # Seconds to wait for connecting and for reading, or for both
+    'timeout': [6.05, 60]
+}
+
+# Server errors worth retrying, HTTP 429 is left to the rate limiter
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+# Failures of the transport of a request, retried by the HTTP session
+TRANSPORT_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ContentDecodingError)
+
+
+def backoff_time(backoff_factor, errors,
+                 backoff_max=Retry.DEFAULT_BACKOFF_MAX):
+    """Seconds to wait after a number of consecutive errors.
+
+    A random time up to the exponential backoff is taken ("full jitter"),
+    so that the clients failing at the same time do not retry together.
+    """
+    if errors <= 0:
+        return 0.0
+    return random.uniform(0, min(backoff_max,
+                                 backoff_factor * 2 ** (errors - 1)))
+
+
+class JitteredRetry(Retry):
+    """urllib3 retry policy with a full jitter exponential backoff.
+
+    HTTP 429 is never retried here, even with a Retry-After header, so that
+    the rate limiter of the routing service sees it and slows down all the
+    requests. `on_retry` is called before every retry, e.g. to count it
+    against a quota.
+    """
+
+    on_retry = None
+
+    def new(self, **kw):
+        retry = super(JitteredRetry, self).new(**kw)
+        retry.on_retry = self.on_retry
+        return retry
+
+    def increment(self, *args, **kwargs):
+        # Raises MaxRetryError when no retry is left
+        retry = super(JitteredRetry, self).increment(*args, **kwargs)
+        if self.on_retry is not None:
+            self.on_retry()
+        return retry
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429:
+            return False
+        return super(JitteredRetry, self).is_retry(method, status_code,
+                                                   has_retry_after)
+
+    def get_backoff_time(self):
+        errors = len(list(itertools.takewhile(
+            lambda h: h.redirect_location is None, reversed(self.history))))
+        return backoff_time(self.backoff_factor, errors, self.backoff_max)
+
+
+class MeteredAdapter(HTTPAdapter):
+    """HTTP adapter calling `before_send` before every request it sends.
+    """
+
+    def __init__(self, before_send=None, **kwargs):
+        self.before_send = before_send
+        super(MeteredAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.before_send is not None:
+            self.before_send()
+        return super(MeteredAdapter, self).send(request, **kwargs)
+
+
+def Session(pool_size=None, retries=HTTP_DEFAULTS['retries'],
+            backoff_factor=HTTP_DEFAULTS['backoff_factor'], before_send=None):
     """Returns an HTTP session.
+
+    Connection errors and server errors are retried, which is safe for the
+    routing APIs since all their requests are queries, POST included. The
+    last response is returned if it is still a server error.
+
+    :param int pool_size: maximum number of connections kept alive for the
+        same host, 10 by default
+    :param int retries: maximum number of retries of a request
+    :param float backoff_factor: backoff between the retries, see
+        `backoff_time`
+    :param before_send: function called before every request sent over the
+        network, its retries included, but not before the responses
+        replayed by an `ArchiveAdapter` mounted over the adapter
     """
     session = requests.Session()
     session.headers.update({
         'User-Agent': 'rap/{0} {1}'.format(__version__,
-                                           requests.utils.default_user_agent())
+                                           requests.utils.default_user_agent()),
+        # Routes compress very well, requests decodes them transparently
+        'Accept-Encoding': 'gzip, deflate'
     })
+    retry = JitteredRetry(total=retries, connect=retries, read=retries,
+                          status=retries, redirect=3,
+                          status_forcelist=RETRY_STATUSES,
+                          allowed_methods=frozenset(['GET', 'POST']),
+                          backoff_factor=backoff_factor,
+                          raise_on_status=False)
+    retry.on_retry = before_send
+    pool_size = pool_size or HTTP_DEFAULTS['pool_size']
+    adapter = MeteredAdapter(before_send, pool_connections=pool_size,
+                             pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
     return session
 
 
+def http_settings(http=None, pool_size=None):
+    """Merge the `http` settings of a router with the defaults.
+
+    :param Dict http: any of the settings in `HTTP_DEFAULTS`
+    :param int pool_size: pool size overriding the one of the settings,
+        usually the number of workers
+    :return: the complete settings, with the timeout as a number or a
+        (connect, read) tuple
+    """
+    unknown = set(http or {}) - set(HTTP_DEFAULTS)
+    if unknown:
+        raise errors.InvalidParameterError(
+            "Unknown http settings: {0}".format(', '.join(sorted(unknown))))
+    settings = dict(HTTP_DEFAULTS, **(http or {}))
+    if pool_size:
+        settings['pool_size'] = pool_size
+    if isinstance(settings['timeout'], (list, tuple)):
+        settings['timeout'] = tuple(settings['timeout'])
+    return settings
+
+
+def AsyncSession(pool_size=None, timeout=None):
+    """Returns an aiohttp session, must be called in a running event loop.
+
+    :param int pool_size: maximum number of connections kept alive, 100 by
+        default like aiohttp
+    :param timeout: seconds to wait for connecting and for reading, a number
+        or a (connect, read) tuple
+    """
+    if aiohttp is None:
+        raise ImportError("The async routing API requires aiohttp: "
+                          "pip install aiohttp")
+    connector = aiohttp.TCPConnector(limit=pool_size or 100,
+                                     keepalive_timeout=30)
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(
+        total=None, sock_connect=timeout[0], sock_read=timeout[1]), headers={
+        'User-Agent': 'rap/{0} {1}'.format(__version__,
+                                           requests.utils.default_user_agent())
+    })
+
+
+class AsyncResponse(object):
+    """Response of an async request, read in full.
+
+    It has the attributes of `requests.Response` used by the routers, so
+    that the same code parses the responses of both APIs.
+    """
+
+    def __init__(self, status_code, headers, content, encoding='utf-8'):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(
+                "{0} error".format(self.status_code), response=self)
+
+
+class RawRoute(object):
+    """Response body of a found path, kept as received.
+
+    Only the duration and distance of the path are extracted from the
+    response, so that the route can be archived without encoding its
+    geometry again.
+    """
+
+    __slots__ = ('body', 'summary')
+
+    def __init__(self, body, summary):
+        """Creates a raw route.
+
+        :param bytes body: JSON body of the directions API response
+        :param dict summary: the `duration` and the `distance` of the path,
+            see `RoutingService.route_summary`
+        """
+        self.body = body
+        self.summary = summary
+
+    def json(self):
+        """Decode the body of the response."""
+        return json.loads(self.body)
+
+
+def _query_string_value(value):
+    # aiohttp only accepts strings and numbers in the query string
+    return value if isinstance(value, (str, int, float)) and \
+        not isinstance(value, bool) else str(value)
+
+
 class RoutingService(object):
     """Routing service base class.
     """
 
-    def __init__(self, api_key=None, cache=None, rate_limit=-1):
+    # How many times a request rejected by the rate limit of the provider
+    # (HTTP 429) is sent again after backing off
+    rate_limit_retries = 3
+    # Maximum number of locations (the source included) in one matrix
+    # request, None if the provider has no matrix API
+    matrix_max_locations = None
+    # Maximum number of async requests in flight at the same time
+    max_in_flight = 100
+    # Query parameters asking the directions API for the smallest response
+    # still telling the duration and distance of a path, see `find_summary`
+    summary_params = {}
+
+    def __init__(self, api_key=None, cache=None, rate_limit=-1,
+                 pool_size=None, route_cache=None, http=None):
         """Constructs a routing service object.
 
         :param api_key: API key for a routing service if needed
         :param cache: CacheControl cache instance (Dict or FileCache).
+        :param rate_limit: maximum number of requests per second, no limit
+            if it is not positive, or a dict of limits per time window as
+            accepted by `RateLimiter.from_conf`
+        :param pool_size: size of the HTTP connection pool, should be at
+            least the number of threads sharing this service
+        :param route_cache: RouteCache instance for the found paths, which
+            works for any provider unlike the HTTP cache
+        :param http: dict of HTTP settings, see `HTTP_DEFAULTS`, pool_size
+            taking precedence over its pool size
         """
         self.api_key = api_key
-        self.session = Session()
+        self.route_cache = route_cache
+        self.http = http_settings(http, pool_size)
+        self.session = Session(self.http['pool_size'], self.http['retries'],
+                               self.http['backoff_factor'],
+                               self._spend_quota)
+        self.timeout = self.http['timeout']
         self.rate_limit = rate_limit
+        self.limiter = RateLimiter.from_conf(rate_limit)
+        # Pause of all the requests when too many of them fail
+        self.breaker = CircuitBreaker()
+        self.pool_size = pool_size
+        self._async_session = None
+        self._in_flight = None
+        # Deduplicator of the path requests, see `dedup_fetch`
+        self.dedup = None
+        # Archive of the exchanges, see `use_archive`
+        self.archive = None
+        self.archive_mode = None
+        # Daily and monthly budgets of the requests, see `rap.quota`
+        self.quota = None
+        self.metrics = Metrics(self.__class__.__name__)
+        self.session.hooks['response'].append(self._observe_response)
         if cache:
+            # Only imported when an HTTP cache is asked for
+            from cachecontrol import CacheControl
             self.session = CacheControl(self.session, cache=cache)
 
+    @classmethod
+    def from_conf(cls, profile, conf, pool_size=None, route_cache=None):
+        """Creates a routing service from its settings in routerconf.json.
+
+        :param str profile: routing profile name
+        :param dict conf: settings of the router, its `key` and optionally
+            its `rate_limit`, `http` settings, `circuit_breaker` settings,
+            see `CircuitBreaker.from_conf`, and `base_url`
+        :param pool_size: size of the HTTP connection pool
+        :param route_cache: RouteCache instance for the found paths
+        """
+        router = cls(profile, conf.get('key'), conf.get('rate_limit', -1),
+                     pool_size=pool_size, route_cache=route_cache,
+                     http=conf.get('http'))
+        if 'circuit_breaker' in conf:
+            router.breaker = CircuitBreaker.from_conf(conf['circuit_breaker'])
+        base_url = conf.get('base_url')
+        if base_url:
+            LOGGER.info("Send the requests of %s to %s", cls.__name__,
+                        base_url)
+            router.set_base_url(base_url)
+        return router
+
+    def use_archive(self, archive, mode=REPLAY):
+        """Record the exchanges with the routing service in an archive, or
+        replay them from it, see `rap.replay`.
+
+        The requests replayed by `send_request` and `send_request_async`
+        are not rate limited, and none is in STRICT mode.
+
+        :param Archive archive: the archive of the responses
+        :param str mode: one of `rap.replay.MODES`
+        """
+        for prefix, adapter in list(self.session.adapters.items()):
+            self.session.mount(prefix, ArchiveAdapter(archive, mode, adapter))
+        self.archive = archive
+        self.archive_mode = mode
+        if mode == STRICT:
+            self.limiter = RateLimiter.from_conf(-1)
+
+    def _replayed(self, prepared):
+        return self.recorded(prepared.method, prepared.url, prepared.body)
+
+    def recorded(self, method, url, body=None):
+        """Tell whether a request would be replayed from the archive, so
+        that it is not rate limited.
+        """
+        return self.archive is not None and self.archive_mode != RECORD \
+            and self.archive.contains(method, url, body)
+
+    def set_base_url(self, base_url):
+        """Send the requests to another server than the public API.
+
+        The server must implement the same API, e.g. a self-hosted instance
+        or `rap.mockserver.MockRoutingServer`.
+
+        :param str base_url: scheme, host and port, e.g. http://127.0.0.1:8000
+        """
+        raise NotImplementedError(
+            "{0} cannot change its server".format(self.__class__.__name__))
+
+    def throttle(self):
+        """Block until the next request is allowed by the rate limit.
+
+        The limit holds for all the threads sharing this routing service.
+        The request is held back while the circuit `breaker` is open.
+
+        :return: seconds waited
+        """
+        if self.breaker is not None:
+            self.breaker.wait()
+        wait = self.limiter.acquire()
+        self.metrics.observe_throttle(wait)
+        return wait
+
+    def _spend_quota(self):
+        # Count a request about to be sent, its retries included, against
+        # the budgets of the quota. The responses replayed from an archive
+        # and the paths of the route cache never get here.
+        if self.quota is not None:
+            self.quota.spend()
+
+    def _observe_response(self, resp, *args, **kwargs):
+        # Response hook of the HTTP session, so that the requests of third
+        # party clients sharing the session are recorded too. The body is
+        # read here to include its download in the request time.
+        start = time.perf_counter()
+        nbytes = len(resp.content)
+        self.metrics.observe_response(
+            resp.elapsed.total_seconds() + time.perf_counter() - start,
+            resp.status_code, nbytes)
+        # The retries of urllib3 are only known from their history
+        retries = getattr(resp.raw, 'retries', None)
+        for h in getattr(retries, 'history', ()):
+            self.metrics.observe_retry(
+                h.status or h.error.__class__.__name__)
+            self._record_outcome(h.status)
+        self._record_outcome(resp.status_code)
+
+    def _record_outcome(self, status=None):
+        # A server error, or no response at all with None, is a failure
+        if self.breaker is not None:
+            self.breaker.record(status is None or status >= 500)
+
+    def raise_for_failure(self, resp):
+        """Raise the error of a request which failed, see `rap.errors`.
+
+        The routers call it for the responses which do not tell about a
+        path, unless the provider tells that there is none.
+
+        :param resp: a `requests.Response` or an `AsyncResponse`
+        :raises RateLimitError: the request was rejected by the rate limit
+        :raises TransientError: the server failed to answer
+        :raises PermanentError: the request was refused, e.g. as invalid
+        """
+        status = resp.status_code
+        if status < 400:
+            return
+        message = "{0} answered {1}: {2}".format(
+            self.__class__.__name__, status, resp.text[:200])
+        if status == 429:
+            raise errors.RateLimitError(message)
+        if status >= 500 or status == 408:
+            raise errors.TransientError(message)
+        raise errors.PermanentError(message)
+
+    def send_request(self, url, params=None, method='GET', **kwargs):
+        """Send a rate limited HTTP request to the routing service.
+
+        The request is sent again after backing off if the provider rejects
+        it with HTTP 429, honouring the `Retry-After` header.
+
+        :param str url: URL of the API endpoint
+        :param Dict params: query string parameters
+        :param str method: HTTP method
+        :raises TransientError: no response was received
+        :return: the last response received
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        replayed = self.archive is not None and self._replayed(
+            self.session.prepare_request(requests.Request(
+                method, str(url), params=params, data=kwargs.get('data'),
+                json=kwargs.get('json'))))
+        for attempt in range(self.rate_limit_retries + 1):
+            if not replayed:
+                self.throttle()
+            try:
+                resp = self.session.request(method, str(url), params=params,
+                                            **kwargs)
+            except TRANSPORT_ERRORS as e:
+                self._record_outcome()
+                raise errors.TransientError(
+                    "{0} did not answer: {1}".format(
+                        self.__class__.__name__, e)) from e
+            if resp.status_code != 429:
+                self.limiter.recover()
+                return resp
+            retry_after = retry_after_seconds(resp.headers)
+            LOGGER.warning("Too many requests (attempt %s), retry after %s "
+                           "seconds", attempt + 1, retry_after)
+            self.limiter.backoff(retry_after)
+        return resp
+
+    def async_session(self):
+        """Get the aiohttp session of the running event loop.
+
+        The session and the semaphore limiting the requests in flight to
+        `max_in_flight` are created on first use, see `close_async`.
+        """
+        if self._async_session is None or self._async_session.closed:
+            self._async_session = AsyncSession(
+                self.pool_size or self.max_in_flight, self.timeout)
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self._async_session
+
+    async def close_async(self):
+        """Close the aiohttp session, before its event loop is closed."""
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    async def send_request_async(self, url, params=None, method='GET',
+                                 **kwargs):
+        """Send a rate limited HTTP request from the running event loop.
+
+        Same as `send_request`, the rate limiter and the circuit breaker are
+        shared by the sync and the async requests.
+
+        :return: an AsyncResponse
+        """
+        session = self.async_session()
+        if params is not None:
+            params = {k: _query_string_value(v) for k, v in params.items()}
+        prepared = None
+        if self.archive is not None:
+            prepared = requests.Request(method, str(url), params=params,
+                                        data=kwargs.get('data'),
+                                        json=kwargs.get('json')).prepare()
+            if self.archive_mode != RECORD:
+                found = self.archive.get(prepared.method, prepared.url,
+                                         prepared.body)
+                if found is not None:
+                    return AsyncResponse(*found)
+                if self.archive_mode == STRICT:
+                    raise not_recorded(prepared.method, prepared.url,
+                                       self.archive.path)
+        for attempt in range(self.rate_limit_retries + 1):
+            if self.breaker is not None:
+                await self.breaker.wait_async()
+            self.metrics.observe_throttle(await self.limiter.acquire_async())
+            try:
+                resp = await self._request_async(session, method, str(url),
+                                                 params, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise errors.TransientError(
+                    "{0} did not answer: {1}".format(
+                        self.__class__.__name__, e)) from e
+            if resp.status_code != 429:
+                self.limiter.recover()
+                break
+            retry_after = retry_after_seconds(resp.headers)
+            LOGGER.warning("Too many requests (attempt %s), retry after %s "
+                           "seconds", attempt + 1, retry_after)
+            self.limiter.backoff(retry_after)
+        if prepared is not None:
+            self.archive.put(prepared.method, prepared.url, prepared.body,
+                             resp.status_code, resp.headers, resp.content)
+        return resp
+
+    async def _request_async(self, session, method, url, params, **kwargs):
+        # Same retry policy as the adapter of the sync session
+        failures = 0
+        while True:
+            # Every attempt is counted against the quota, see `_spend_quota`
+            if self.quota is not None:
+                await self.quota.spend_async()
+            try:
+                async with self._in_flight:
+                    start = time.perf_counter()
+                    async with session.request(method, url, params=params,
+                                               **kwargs) as r:
+                        body = await r.read()
+                        resp = AsyncResponse(r.status, r.headers, body,
+                                             r.get_encoding())
+                    self.metrics.observe_response(
+                        time.perf_counter() - start, r.status, len(body))
+                    self._record_outcome(r.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self._record_outcome()
+                if failures >= self.http['retries']:
+                    raise
+                LOGGER.warning("Request failed (%s), retry", e)
+                self.metrics.observe_retry(e.__class__.__name__)
+            else:
+                if resp.status_code not in RETRY_STATUSES or \
+                        failures >= self.http['retries']:
+                    return resp
+                LOGGER.warning("Server error %s, retry", resp.status_code)
+                self.metrics.observe_retry(resp.status_code)
+            failures += 1
+            await asyncio.sleep(backoff_time(self.http['backoff_factor'],
+                                             failures))
+
+    def find_path(self, source_lng, source_lat, target_lng, target_lat,
+                  params=None):
+        """ Find the optimal path between two positions
+
+        The path is looked up in the route cache first if there is one, and
+        only fetched from the routing service on a cache miss, through the
+        deduplicator of the router if it has one, see `dedup_fetch`.
+
+        :param float source_lng: longitude value of the starting position
+        :param float source_lat: latitude value of the starting position
+        :param float target_lng: longitude value of the ending position
+        :param float target_lat: latitude value of the ending position
+        :param Dict params: the other query parameters for the router
+        :return: None for no path found; a JSON object for the found path info
+        """
+        if self.route_cache is None:
+            return self.dedup_fetch('route', self.fetch_path, source_lng,
+                                    source_lat, target_lng, target_lat,
+                                    params)
+        key = self.cache_key('route', (source_lng, source_lat),
+                             (target_lng, target_lat), params)
+        found, route = self.route_cache.get(key)
+        self.metrics.observe_cache(found)
+        if found:
+            return route
+        route = self.dedup_fetch('route', self.fetch_path, source_lng,
+                                 source_lat, target_lng, target_lat, params)
+        # A failed request raises an error, so no path found is cached too
+        self.route_cache.put(key, route)
+        return route
+
+    async def find_path_async(self, source_lng, source_lat, target_lng,
+                              target_lat, params=None):
+        """Find the optimal path between two positions in an event loop.
+
+        Same as `find_path`, thousands of paths can be searched concurrently
+        by one thread.
+        """
+        if self.route_cache is None:
+            return await self.dedup_fetch_async(
+                'route', self.fetch_path_async, source_lng, source_lat,
+                target_lng, target_lat, params)
+        key = self.cache_key('route', (source_lng, source_lat),
+                             (target_lng, target_lat), params)
+        found, route = self.route_cache.get(key)
+        self.metrics.observe_cache(found)
+        if found:
+            return route
+        route = await self.dedup_fetch_async(
+            'route', self.fetch_path_async, source_lng, source_lat,
+            target_lng, target_lat, params)
+        self.route_cache.put(key, route)
+        return route
+
+    def find_path_raw(self, source_lng, source_lat, target_lng, target_lat,
+                      params=None):
+        """ Find the optimal path between two positions, undecoded
+
+        Same as `find_path`, but the response body is returned as received
+        along with the summary of the path, for writing it to a route store
+        as it is.
+
+        :return: None for no path found; a RawRoute for the found path
+        """
+        if self.route_cache is None:
+            return self.dedup_fetch('raw', self.fetch_path_raw, source_lng,
+                                    source_lat, target_lng, target_lat,
+                                    params)
+        key = self.cache_key('raw', (source_lng, source_lat),
+                             (target_lng, target_lat), params)
+        found, cached = self.route_cache.get(key)
+        self.metrics.observe_cache(found)
+        if found:
+            return self._cached_raw_route(cached)
+        route = self.dedup_fetch('raw', self.fetch_path_raw, source_lng,
+                                 source_lat, target_lng, target_lat, params)
+        self._cache_raw_route(key, route)
+        return route
+
+    def _cache_raw_route(self, key, route):
+        self.route_cache.put(key, None if route is None else {
+            'body': route.body.decode('utf-8'), 'summary': route.summary})
+
+    @staticmethod
+    def _cached_raw_route(cached):
+        if cached is None:
+            return None
+        return RawRoute(cached['body'].encode('utf-8'), cached['summary'])
+
+    async def find_path_raw_async(self, source_lng, source_lat, target_lng,
+                                  target_lat, params=None):
+        """Find the optimal path between two positions in an event loop.
+
+        Same as `find_path_raw`, see `find_path_async`.
+        """
+        if self.route_cache is None:
+            return await self.dedup_fetch_async(
+                'raw', self.fetch_path_raw_async, source_lng, source_lat,
+                target_lng, target_lat, params)
+        key = self.cache_key('raw', (source_lng, source_lat),
+                             (target_lng, target_lat), params)
+        found, cached = self.route_cache.get(key)
+        self.metrics.observe_cache(found)
+        if found:
+            return self._cached_raw_route(cached)
+        route = await self.dedup_fetch_async(
+            'raw', self.fetch_path_raw_async, source_lng, source_lat,
+            target_lng, target_lat, params)
+        self._cache_raw_route(key, route)
+        return route
+
+    def dedup_fetch(self, kind, fetch, source_lng, source_lat, target_lng,
+                    target_lat, params=None):
+        """Fetch a path with one of the fetch methods, deduplicated.
+
+        With a `rap.dedup.Deduplicator` set as `dedup`, the positions are
+        snapped and the requests between the same snapped positions are
+        sent only once.
+        """
+        if self.dedup is None:
+            return fetch(source_lng, source_lat, target_lng, target_lat,
+                         params)
+        return self.dedup.find(kind, fetch, source_lng, source_lat,
+                               target_lng, target_lat, params)
+
+    async def dedup_fetch_async(self, kind, fetch, source_lng, source_lat,
+                                target_lng, target_lat, params=None):
+        """Same as `dedup_fetch` for the async fetch methods."""
+        if self.dedup is None:
+            return await fetch(source_lng, source_lat, target_lng,
+                               target_lat, params)
+        return await self.dedup.find_async(kind, fetch, source_lng,
+                                           source_lat, target_lng,
+                                           target_lat, params)
+
+    def find_summary(self, source_lng, source_lat, target_lng, target_lat,
+                     params=None):
+        """ Find the duration and distance of the optimal path
+
+        The directions API is asked for a minimal response with the
+        `summary_params`, without the geometry and the steps of the path
+        where the provider allows it.
+
+        :return: None for no path found; a dict with the `duration` and the
+            `distance` of the path, see `route_summary`
+        """
+        route = self.find_path_raw(source_lng, source_lat, target_lng,
+                                   target_lat, self._summary_query(params))
+        return None if route is None else route.summary
+
+    async def find_summary_async(self, source_lng, source_lat, target_lng,
+                                 target_lat, params=None):
+        """Same as `find_summary` in an event loop."""
+        route = await self.find_path_raw_async(
+            source_lng, source_lat, target_lng, target_lat,
+            self._summary_query(params))
+        return None if route is None else route.summary
+
+    def _summary_query(self, params):
+        query = dict(self.summary_params)
+        query.update(params or {})
+        return query
+
+    def fetch_path(self, source_lng, source_lat, target_lng, target_lat,
+                   params=None):
+        """Ask the routing service for a path, see `find_path`.
+
+        The request is built by `path_request` and its response parsed by
+        `parse_path`, which must be implemented by the concrete routing
+        services unless they override this method.
+        """
+        url, query = self.path_request(source_lng, source_lat, target_lng,
+                                       target_lat, params)
+        return self.parse_path(self.send_request(url, params=query))
+
+    async def fetch_path_async(self, source_lng, source_lat, target_lng,
+                               target_lat, params=None):
+        """Ask the routing service for a path, see `find_path_async`."""
+        url, query = self.path_request(source_lng, source_lat, target_lng,
+                                       target_lat, params)
+        return self.parse_path(await self.send_request_async(url,
+                                                             params=query))
+
+    def fetch_path_raw(self, source_lng, source_lat, target_lng,
+                       target_lat, params=None):
+        """Ask the routing service for a path, see `find_path_raw`.
+
+        The response is parsed by `parse_path_raw`. The paths of a router
+        overriding `fetch_path` are encoded from the found path info instead.
+        """
+        if type(self).fetch_path is not RoutingService.fetch_path:
+            return self.raw_route(self.fetch_path(
+                source_lng, source_lat, target_lng, target_lat, params))
+        url, query = self.path_request(source_lng, source_lat, target_lng,
+                                       target_lat, params)
+        return self.parse_path_raw(self.send_request(url, params=query))
+
+    async def fetch_path_raw_async(self, source_lng, source_lat, target_lng,
+                                   target_lat, params=None):
+        """Ask the routing service for a path, see `find_path_raw_async`."""
+        if type(self).fetch_path_async is not \
+                RoutingService.fetch_path_async:
+            return self.raw_route(await self.fetch_path_async(
+                source_lng, source_lat, target_lng, target_lat, params))
+        url, query = self.path_request(source_lng, source_lat, target_lng,
+                                       target_lat, params)
+        return self.parse_path_raw(await self.send_request_async(
+            url, params=query))
+
+    def path_request(self, source_lng, source_lat, target_lng, target_lat,
+                     params=None):
+        """Build the request for a path, see `fetch_path`.
+
+        :return: (url, query) of the directions API request
+        """
+        raise NotImplementedError
+
+    def parse_path(self, resp):
+        """Get the path info from the response of the directions API.
+
+        :param resp: a `requests.Response` or an `AsyncResponse`
+        :return: None for no path found; a JSON object for the found path
+        """
+        raise NotImplementedError
+
+    def parse_path_raw(self, resp):
+        """Get the summary of the path from the response of the directions
+        API, keeping the response body as it is.
+
+        The body is decoded only once, by `parse_path`.
+
+        :param resp: a `requests.Response` or an `AsyncResponse`
+        :return: None for no path found; a RawRoute for the found path
+        """
+        route = self.parse_path(resp)
+        if route is None:
+            return None
+        return RawRoute(resp.content, self.route_summary(route))
+
+    def raw_route(self, route):
+        """Encode the path info returned by `find_path` into a RawRoute."""
+        if route is None:
+            return None
+        return RawRoute(json.dumps(route).encode('utf-8'),
+                        self.route_summary(route))
+
+    def cache_key(self, kind, source, target, params=None):
+        """Key of a result of this router in the route cache."""
+        return self.route_cache.make_key(kind, self.__class__.__name__,
+                                         getattr(self, 'profile', None),
+                                         source, target, params)
+
+    def find_paths_matrix(self, source, targets, params=None):
+        """Find the optimal paths from one source to many targets.
+
+        The targets are split into batches fitting in one matrix request of
+        the provider. Without a matrix API, `find_path` is called for every
+        pair instead.
+
+        :param tuple source: (lng, lat) of the starting position
+        :param list targets: (lng, lat) of all the ending positions
+        :param Dict params: the other query parameters for the router
+        :return: a list aligned with targets, each being None for no path
+            found or a dict with the `duration` in seconds and the `distance`
+            in meters of the path
+        """
+        if self.route_cache is None:
+            return self._find_paths_matrix(source, targets, params)
+        keys = [self.cache_key('matrix', source, t, params) for t in targets]
+        results = []
+        missing = []
+        for i, key in enumerate(keys):
+            found, res = self.route_cache.get(key)
+            self.metrics.observe_cache(found)
+            results.append(res)
+            if not found:
+                missing.append(i)
+        if missing:
+            fetched = self._find_paths_matrix(
+                source, [targets[i] for i in missing], params)
+            for i, res in zip(missing, fetched):
+                results[i] = res
+                self.route_cache.put(keys[i], res)
+        return results
+
+    def _find_paths_matrix(self, source, targets, params=None):
+        if not self.matrix_max_locations:
+            return [self.route_summary(self.find_path(source[0], source[1],
+                                                      t[0], t[1], params))
+                    for t in targets]
+        batch_size = self.matrix_max_locations - 1
+        results = []
+        for i in range(0, len(targets), batch_size):
+            results.extend(self.request_matrix(
+                source, targets[i:i + batch_size], params))
+        return results
+
+    def request_matrix(self, source, targets, params=None):
+        """Send one matrix request, see `find_paths_matrix`.
+
+        The number of targets must fit in `matrix_max_locations`.
+        """
+        raise NotImplementedError(
+            "{0} has no matrix API".format(self.__class__.__name__))
+
+    def route_summary(self, route):
+        """Extract the duration and distance of a path found by `find_path`.
+
+        :param route: the path info returned by `find_path`
+        :return: None for no path found; a dict with the `duration` and the
+            `distance`, which are None if not known
+        """
+        if route is None:
+            return None
+        return {'duration': None, 'distance': None}
+
     def handle_http_error(self,
                           response,
                           custom_messages=None,
@@ -0,0 +1,141 @@
+"""Persistent cache of route results shared by all routing services
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Query parameters which do not change the result, e.g. API keys
+IGNORED_PARAMS = ('access_token', 'api_key', 'key')
+
+
+class RouteCache(object):
+    """Route results cached in a SQLite database.
+
+    The entries are keyed on the router, the profile, the source and target
+    coordinates rounded to `precision` decimal places, and the other query
+    parameters. They expire after `ttl` seconds, and the least recently used
+    ones are evicted as soon as there are more than `max_entries` of them.
+    The entries are counted in memory, and counted again in the database at
+    every eviction, so the entries added meanwhile by other processes sharing
+    the database are only seen then.
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None, precision=6):
+        """Opens or creates a route cache.
+
+        :param str path: path of the SQLite database file
+        :param float ttl: seconds before an entry expires, never if None
+        :param int max_entries: maximum number of entries, unbounded if None
+        :param int precision: decimal places of the coordinates in the keys
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS routes ("
+                           "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                           "created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS routes_accessed "
+                           "ON routes (accessed)")
+        self._entries = self._count()
+
+    def _count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    def make_key(self, kind, router, profile, source, target, params=None):
+        """Build the cache key of a route.
+
+        :param str kind: kind of the result, e.g. route or matrix
+        :param str router: name of the routing service
+        :param profile: routing profile of the routing service
+        :param tuple source: (lng, lat) of the starting position
+        :param tuple target: (lng, lat) of the ending position
+        :param Dict params: the other query parameters for the router
+        :return: a hex digest
+        """
+        fmt = '{0:.' + str(self.precision) + 'f}'
+        normalized = {
+            'kind': kind,
+            'router': router,
+            'profile': profile,
+            'source': [fmt.format(float(c)) for c in source],
+            'target': [fmt.format(float(c)) for c in target],
+            'params': {k: v for k, v in (params or {}).items()
+                       if k not in IGNORED_PARAMS}
+        }
+        raw = json.dumps(normalized, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Look up a cached result.
+
+        :return: a (found, value) tuple
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM routes WHERE key = ?",
+                (key, )).fetchone()
+            if row is not None and self.ttl is not None \
+                    and row[1] + self.ttl < now:
+                self._conn.execute("DELETE FROM routes WHERE key = ?",
+                                   (key, ))
+                self._entries -= 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return False, None
+            self._conn.execute("UPDATE routes SET accessed = ? WHERE key = ?",
+                               (now, key))
+            self.hits += 1
+        return True, json.loads(row[0])
+
+    def put(self, key, value):
+        """Cache a JSON serializable result."""
+        now = time.time()
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT 1 FROM routes WHERE key = ?", (key, )).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now))
+            if found is None:
+                self._entries += 1
+            if self.max_entries and self._entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        excess = self._count() - self.max_entries
+        if excess > 0:
+            LOGGER.debug("Evict %s least recently used routes from the cache",
+                         excess)
+            self._conn.execute(
+                "DELETE FROM routes WHERE key IN (SELECT key FROM routes "
+                "ORDER BY accessed LIMIT ?)", (excess, ))
+        self._entries = self._count()
+
+    def stats(self):
+        """Get the hit and miss counters and the number of entries."""
+        with self._lock:
+            entries = self._count()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def close(self):
+        """Evict the entries over the size limit and close the database."""
+        with self._lock:
+            if self.max_entries:
+                self._evict()
+            self._conn.close()
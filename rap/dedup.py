@@ -0,0 +1,140 @@
+"""Deduplication of the path requests to nearby positions
+"""
+
+import asyncio
+import collections
+import functools
+import json
+import logging
+import threading
+from concurrent.futures import Future
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Deduplicator(object):
+    """Send one request for all the paths between the same snapped positions.
+
+    The coordinates are rounded to `precision` decimal places before the
+    path is searched, so that the points of a dense grid falling into the
+    same cell, e.g. about 11 m wide for 4 decimal places, share one
+    request. Identical requests in flight are coalesced, the first one is
+    sent and the others wait for its result, and the results of the last
+    `max_entries` requests are kept to answer the later ones.
+    """
+
+    def __init__(self, precision=4, max_entries=10000):
+        """Creates a deduplicator shared by the threads and the event loop
+        of a routing service.
+
+        :param int precision: decimal places of the snapped coordinates
+        :param int max_entries: number of results kept in memory
+        """
+        self.precision = precision
+        self.max_entries = max_entries
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._in_flight = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def snap(self, lng, lat):
+        """Round a position to the precision of the deduplicator."""
+        return round(lng, self.precision), round(lat, self.precision)
+
+    def make_key(self, kind, source, target, params=None):
+        """Build the key of a request between two snapped positions."""
+        return (kind, source, target,
+                json.dumps(params, sort_keys=True, default=str))
+
+    def _lookup(self, key, in_flight, start):
+        # Get (True, result) if the result is known, (True, request) for a
+        # request in flight to wait for, or (False, request) for a new one
+        # registered in flight as returned by start()
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return True, self._results[key]
+            request = in_flight.get(key)
+            if request is None:
+                self.misses += 1
+                request = in_flight[key] = start()
+                return False, request
+            self.coalesced += 1
+        LOGGER.debug("Wait for the request %s in flight", key)
+        return True, request
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def find(self, kind, func, source_lng, source_lat, target_lng,
+             target_lat, params=None):
+        """Search for a path with func between the snapped positions.
+
+        :param str kind: kind of the result of func, e.g. route or raw
+        :param func: a function taking the coordinates and the params like
+            `RoutingService.find_path`
+        :return: the result of func for the snapped positions
+        """
+        source = self.snap(source_lng, source_lat)
+        target = self.snap(target_lng, target_lat)
+        key = self.make_key(kind, source, target, params)
+        known, request = self._lookup(key, self._in_flight, Future)
+        if known:
+            return request.result() if isinstance(request, Future) \
+                else request
+        try:
+            result = func(source[0], source[1], target[0], target[1], params)
+        except BaseException as e:
+            request.set_exception(e)
+            raise
+        else:
+            self._remember(key, result)
+            request.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def find_async(self, kind, func, source_lng, source_lat,
+                         target_lng, target_lat, params=None):
+        """Same as `find` for a coroutine function, in an event loop.
+
+        The requests are coalesced with the other requests of the same
+        event loop only.
+        """
+        source = self.snap(source_lng, source_lat)
+        target = self.snap(target_lng, target_lat)
+        key = self.make_key(kind, source, target, params)
+        known, task = self._lookup(key, self._tasks, lambda: asyncio.
+                                   ensure_future(func(source[0], source[1],
+                                                      target[0], target[1],
+                                                      params)))
+        if known and not asyncio.isfuture(task):
+            return task
+        if not known:
+            task.add_done_callback(functools.partial(self._request_done,
+                                                     key))
+        # A cancelled waiter must not cancel the request of the others
+        return await asyncio.shield(task)
+
+    def _request_done(self, key, task):
+        with self._lock:
+            del self._tasks[key]
+        if not task.cancelled() and task.exception() is None:
+            self._remember(key, task.result())
+
+    def stats(self):
+        """Get the numbers of requests answered from memory, coalesced with
+        one in flight, and sent.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'coalesced': self.coalesced,
+                    'misses': self.misses}
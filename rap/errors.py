@@ -45,3 +45,32 @@ class InvalidParameterError(ValidationError):
 
 class InvalidFileError(ValidationError):
     pass
+
+
+class NotRecordedError(ValidationError):
+    pass
+
+
+class RoutingError(ValidationError):
+    """A request to a routing service failed, unlike one finding no path"""
+    pass
+
+
+class TransientError(RoutingError):
+    """The request may succeed later: server error, timeout, lost connection
+    """
+    pass
+
+
+class RateLimitError(TransientError):
+    """The request was still rejected by the rate limit of the provider"""
+    pass
+
+
+class PermanentError(RoutingError):
+    """The request is refused as it is, e.g. invalid or unauthorized"""
+    pass
+
+
+class QuotaExceededError(RoutingError):
+    pass
@@ -2,13 +2,22 @@
 """
 
 import logging
+import asyncio
 import json
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 import googlemaps
-from .base import RoutingService
+from . import errors
+from .base import RawRoute, RoutingService
 
 LOGGER = logging.getLogger(__name__)
 
+DIRECTIONS_PATH = "/maps/api/directions/json"
+
+# Statuses of the Directions API for a request which may succeed later
+TRANSIENT_STATUSES = ('UNKNOWN_ERROR', )
+# Statuses of the Directions API for a used up quota
+QUOTA_STATUSES = ('OVER_DAILY_LIMIT', )
+
 
 class GoogleMapsRouter(RoutingService):
     """ Wrapper class of Google Maps Services Python client
@@ -22,29 +31,51 @@ class GoogleMapsRouter(RoutingService):
         "walking": "walking",
         "cycling": "bicycling"
     }
+    # The Directions API has no option to leave out the overview polyline
+    # and the steps, the query parameters are not sent anyway
+    summary_params = {}
 
-    def __init__(self, profile, api_key, rate_limit=-1, cache=None):
+    def __init__(self, profile, api_key, rate_limit=-1, cache=None,
+                 pool_size=None, route_cache=None, http=None):
         LOGGER.debug(
             "GoogleMapsRouter __init__ with %s, %s, %s and %s arguments passed in",
             profile, api_key, cache, rate_limit)
         if profile not in self.profile_dict:
             # The profile passed in is not supported by Google Maps routing service
             return None
-        # TODO (lliu) Should support quota in the future
-        # but it's not easy
-        # self.daily_quota = 2500
+        # The daily quota is tracked across the runs by `rap.quota`, with
+        # the `quota` of the router in routerconf.json
         self.profile = self.profile_dict[profile]
         self.coordinates = ""
         self.params = {}
-        self.gmaps = googlemaps.Client(key=api_key)
 
         # Request directions via public transit
         LOGGER.debug("The input profile %s has been converted to %s",
                      profile, self.profile)
-        super(GoogleMapsRouter, self).__init__(api_key, cache, rate_limit)
+        super(GoogleMapsRouter, self).__init__(api_key, cache, rate_limit,
+                                               pool_size, route_cache,
+                                               http)
+        self._executor = None
+        # Share the connection pool of the routing service with the client
+        # and leave the rate limiting to the routing service, the client
+        # would otherwise throttle to 60 queries per second on its own
+        if isinstance(self.timeout, tuple):
+            timeouts = {'connect_timeout': self.timeout[0],
+                        'read_timeout': self.timeout[1]}
+        else:
+            timeouts = {'timeout': self.timeout}
+        self.gmaps = googlemaps.Client(key=api_key,
+                                       requests_session=self.session,
+                                       retry_over_query_limit=False,
+                                       queries_per_second=10000,
+                                       queries_per_minute=600000,
+                                       **timeouts)
 
-    def find_path(self, source_lng, source_lat, target_lng, target_lat,
-                  params=None):
+    def set_base_url(self, base_url):
+        self.gmaps.base_url = base_url
+
+    def fetch_path(self, source_lng, source_lat, target_lng, target_lat,
+                   params=None):
         """ Find the optimal path with Google Maps Directions HTTP API
 
         :param float source_lng: longitude value of the starting position
@@ -54,17 +85,148 @@ class GoogleMapsRouter(RoutingService):
         :param Dict params: the other query parameters for Google Maps router
         :return: None for no path found; a JSON object for the found path info
         """
-        directions_result = self.gmaps.directions("{0},{1}".format(source_lat, source_lng),
-                                                  "{0},{1}".format(
-                                                      target_lat, target_lng),
-                                                  mode=self.profile)
-        LOGGER.info("Sending request to Google Maps Directions API server")
-        if self.rate_limit > 0:
-            sleep(1 / self.rate_limit)
-        for r in directions_result:
-            LOGGER.debug("Get routes: %s", str(r))
+        body = self._directions(source_lng, source_lat, target_lng,
+                                target_lat)
+        if body is None:
+            return None
+        directions_result = body['routes']
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            for r in directions_result:
+                LOGGER.debug("Get routes: %s", str(r))
         if not directions_result:
             LOGGER.info("No path found")
             return None
 
         return json.dumps(directions_result)
+
+    def fetch_path_raw(self, source_lng, source_lat, target_lng, target_lat,
+                       params=None):
+        """ Find the optimal path with Google Maps Directions HTTP API
+
+        Same as `fetch_path`, but the body of the response is kept as it is.
+
+        :return: None for no path found; a RawRoute for the found path
+        """
+        return self._directions(source_lng, source_lat, target_lng,
+                                target_lat, self._extract_raw_route)
+
+    def _directions(self, source_lng, source_lat, target_lng, target_lat,
+                    extract_body=None):
+        # Send a rate limited request of the googlemaps client, retried when
+        # the query limit is exceeded. The response is decoded by
+        # extract_body, or by the client into a dict. The errors of the
+        # client are raised as the errors of rap.
+        LOGGER.info("Sending request to Google Maps Directions API server")
+        query = {
+            'origin': "{0},{1}".format(source_lat, source_lng),
+            'destination': "{0},{1}".format(target_lat, target_lng),
+            'mode': self.profile
+        }
+        # The responses replayed from an archive are not rate limited, like
+        # in send_request. The key in the URL is ignored by the archive.
+        replayed = self.archive is not None and self.recorded(
+            'GET', self.gmaps.base_url + self.gmaps._generate_auth_url(
+                DIRECTIONS_PATH, query, True))
+        for attempt in range(self.rate_limit_retries + 1):
+            if not replayed:
+                self.throttle()
+            try:
+                result = self.gmaps._request(DIRECTIONS_PATH, query,
+                                             extract_body=extract_body)
+                break
+            except googlemaps.exceptions.ApiError as e:
+                if e.status != 'OVER_QUERY_LIMIT':
+                    raise routing_error(e) from e
+                LOGGER.warning("Over query limit (attempt %s)", attempt + 1)
+                self.limiter.backoff()
+            except (googlemaps.exceptions.TransportError,
+                    googlemaps.exceptions.Timeout) as e:
+                # The client wraps any error of the session, e.g. a request
+                # missing from a STRICT archive
+                base = getattr(e, 'base_exception', None)
+                if isinstance(base, errors.ValidationError):
+                    raise base
+                if not isinstance(e, googlemaps.exceptions.HTTPError):
+                    self._record_outcome()
+                raise routing_error(e) from e
+        else:
+            raise errors.RateLimitError(
+                "Google Maps is still over the query limit")
+        self.limiter.recover()
+        return result
+
+    def _extract_raw_route(self, resp):
+        # Decode the response once, for its status and the path summary
+        if resp.status_code != 200:
+            raise googlemaps.exceptions.HTTPError(resp.status_code)
+        body = resp.json()
+        if body['status'] not in ('OK', 'ZERO_RESULTS'):
+            raise googlemaps.exceptions.ApiError(body['status'],
+                                                 body.get('error_message'))
+        if not body['routes']:
+            LOGGER.info("No path found")
+            return None
+        return RawRoute(resp.content, self._legs_summary(
+            body['routes'][0]['legs']))
+
+    async def fetch_path_async(self, source_lng, source_lat, target_lng,
+                               target_lat, params=None):
+        """ Find the optimal path in a thread of the default executor
+
+        The googlemaps client is synchronous, so the requests are sent by
+        a pool of `max_in_flight` threads, sharing the connection pool and
+        the rate limiter with the other requests.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_in_flight)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.fetch_path,
+                                          source_lng, source_lat, target_lng,
+                                          target_lat, params)
+
+    async def fetch_path_raw_async(self, source_lng, source_lat, target_lng,
+                                   target_lat, params=None):
+        """Same as `fetch_path_async` for `fetch_path_raw`."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_in_flight)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          self.fetch_path_raw, source_lng,
+                                          source_lat, target_lng, target_lat,
+                                          params)
+
+    async def close_async(self):
+        await super(GoogleMapsRouter, self).close_async()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def route_summary(self, route):
+        """Sum up the duration and distance of all legs of the first route."""
+        if route is None:
+            return None
+        return self._legs_summary(json.loads(route)[0]['legs'])
+
+    @staticmethod
+    def _legs_summary(legs):
+        return {'duration': sum(l['duration']['value'] for l in legs),
+                'distance': sum(l['distance']['value'] for l in legs)}
+
+
+def routing_error(e):
+    """Translate an error of the googlemaps client, see `rap.errors`."""
+    if isinstance(e, googlemaps.exceptions.ApiError):
+        if e.status in QUOTA_STATUSES:
+            return errors.QuotaExceededError(str(e))
+        if e.status in TRANSIENT_STATUSES:
+            return errors.TransientError(str(e))
+        return errors.PermanentError(str(e))
+    if isinstance(e, googlemaps.exceptions.HTTPError):
+        if e.status_code == 429:
+            return errors.RateLimitError(str(e))
+        if e.status_code >= 500 or e.status_code == 408:
+            return errors.TransientError(str(e))
+        return errors.PermanentError(str(e))
+    return errors.TransientError(str(e))
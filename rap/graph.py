@@ -0,0 +1,466 @@
+"""Offline router searching the paths in a local road network
+
+The road network is read from a csv edge list, e.g. extracted from
+OpenStreetMap, with the columns
+
+    x1,y1,x2,y2[,length][,oneway][,speed]
+
+giving the longitude and latitude of both ends of every edge, and optionally
+its length in meters, 1 for a one way edge from (x1, y1) to (x2, y2), and
+the speed in km/h for driving on it. The ends with the same coordinates are
+the same node. A graph can be saved in a .npz file loading much faster.
+
+input/munich-grid-roads.csv is a synthetic street grid over the Munich test
+area, only good for trying the router out. A real network can be extracted
+from OpenStreetMap, e.g. with osmnx::
+
+    import osmnx
+    g = osmnx.graph_from_place('Munich, Germany', network_type='walk')
+    edges = osmnx.graph_to_gdfs(g, nodes=False).reset_index()
+    nodes = osmnx.graph_to_gdfs(g, edges=False)
+    edges['x1'] = nodes.x[edges.u].values
+    edges['y1'] = nodes.y[edges.u].values
+    edges['x2'] = nodes.x[edges.v].values
+    edges['y2'] = nodes.y[edges.v].values
+    edges[['x1', 'y1', 'x2', 'y2', 'length', 'oneway']].to_csv(
+        'munich-roads.csv', index=False)
+"""
+
+import collections
+import csv
+import heapq
+import logging
+import os
+import threading
+import numpy as np
+from . import errors
+from .base import RoutingService
+
+LOGGER = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6371008.8
+# Meters of a degree of latitude
+DEGREE = np.pi * EARTH_RADIUS / 180
+
+
+def haversine(lng1, lat1, lng2, lat2):
+    """Great circle distances in meters between (arrays of) positions."""
+    lng1, lat1, lng2, lat2 = (np.radians(np.asarray(a, dtype=float))
+                              for a in (lng1, lat1, lng2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class GridIndex(object):
+    """Spatial index of positions in a regular grid of square cells.
+
+    The positions are sorted by cell, the ones of the cell `c` being
+    `order[starts[c]:starts[c + 1]]`.
+    """
+
+    def __init__(self, xs, ys, cell_size=None):
+        """Index positions.
+
+        :param xs: array of the longitudes
+        :param ys: array of the latitudes
+        :param float cell_size: width of the cells in degrees, by default
+            for a few positions in every cell
+        """
+        self.xs = np.asarray(xs, dtype=float)
+        self.ys = np.asarray(ys, dtype=float)
+        if not len(self.xs):
+            raise errors.InvalidParameterError("Nothing to index")
+        self.left, self.bottom = self.xs.min(), self.ys.min()
+        width = self.xs.max() - self.left
+        height = self.ys.max() - self.bottom
+        if cell_size is None:
+            cell_size = max(np.sqrt(width * height / len(self.xs) * 4), 1e-4)
+        self.cell_size = cell_size
+        self.cols = int(width / cell_size) + 1
+        self.rows = int(height / cell_size) + 1
+        cells = self._cells(self.xs, self.ys)
+        self.order = np.argsort(cells, kind='stable')
+        self.starts = np.searchsorted(cells[self.order],
+                                      np.arange(self.rows * self.cols + 1))
+        # Shortest meters across a cell, along the parallels far north
+        self._cell_meters = cell_size * DEGREE * np.cos(np.radians(
+            min(89.0, max(abs(self.bottom), abs(self.ys.max())))))
+
+    def _cells(self, xs, ys):
+        col = ((xs - self.left) / self.cell_size).astype(np.int64)
+        row = ((ys - self.bottom) / self.cell_size).astype(np.int64)
+        return row * self.cols + col
+
+    @staticmethod
+    def _ring(k):
+        # Offsets (rows, cols) of the cells k cells away from a cell
+        if k == 0:
+            return [(0, 0)]
+        return [(dr, dc) for dr in (-k, k) for dc in range(-k, k + 1)] + \
+            [(dr, dc) for dc in (-k, k) for dr in range(-k + 1, k)]
+
+    def nearest_many(self, xs, ys, max_distance=None):
+        """Find the indexed positions nearest to many positions at once.
+
+        The cells around all the positions are searched together, ring
+        after ring, until the positions farther than the nearest one found
+        can only be in the next rings.
+
+        :param float max_distance: meters to search within, unlimited if
+            None
+        :return: (indices, distances in meters) arrays, -1 and inf for the
+            positions with nothing within `max_distance`
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        limit = np.inf if max_distance is None else max_distance
+        best = np.full(len(xs), -1, dtype=np.int64)
+        best_distances = np.full(len(xs), np.inf)
+        cols = np.floor((xs - self.left) / self.cell_size).astype(np.int64)
+        rows = np.floor((ys - self.bottom) / self.cell_size).astype(np.int64)
+        # Rings from the first one reaching the grid to the last one
+        # covering it
+        first = np.maximum.reduce([np.zeros(len(xs), dtype=np.int64), -rows,
+                                   rows - self.rows + 1, -cols,
+                                   cols - self.cols + 1])
+        last = np.maximum.reduce([abs(rows), abs(rows - self.rows),
+                                  abs(cols), abs(cols - self.cols)])
+        active = np.arange(len(xs))
+        k = 0
+        while len(active):
+            # The positions in the ring k are at least k - 1 cells away
+            done = (k > last[active]) | ((k - 1) * self._cell_meters > (
+                np.minimum(best_distances[active], limit)))
+            active = active[~done]
+            if not len(active):
+                break
+            k = max(k, int(first[active].min()))
+            ring = active[first[active] <= k]
+            for dr, dc in self._ring(k):
+                r, c = rows[ring] + dr, cols[ring] + dc
+                inside = (r >= 0) & (r < self.rows) & (c >= 0) & \
+                    (c < self.cols)
+                queries = ring[inside]
+                cells = r[inside] * self.cols + c[inside]
+                starts = self.starts[cells]
+                counts = self.starts[cells + 1] - starts
+                for slot in range(counts.max() if len(counts) else 0):
+                    has = counts > slot
+                    q = queries[has]
+                    candidates = self.order[starts[has] + slot]
+                    distances = haversine(xs[q], ys[q], self.xs[candidates],
+                                          self.ys[candidates])
+                    better = distances < best_distances[q]
+                    best[q[better]] = candidates[better]
+                    best_distances[q[better]] = distances[better]
+            k += 1
+        far = best_distances > limit
+        best[far] = -1
+        best_distances[far] = np.inf
+        return best, best_distances
+
+    def nearest(self, x, y, max_distance=None):
+        """Find the indexed position nearest to a position.
+
+        :return: (index, distance in meters) of the nearest position, or
+            (None, None) if there is none within `max_distance`
+        """
+        indices, distances = self.nearest_many([x], [y], max_distance)
+        if indices[0] < 0:
+            return None, None
+        return int(indices[0]), float(distances[0])
+
+
+class RoadGraph(object):
+    """Directed road network in compressed sparse row arrays.
+
+    The edges leaving the node `i` are the edges `indptr[i]:indptr[i + 1]`,
+    going to the nodes `indices`, with their `lengths` in meters and their
+    `speeds` in km/h, 0 if not known.
+    """
+
+    def __init__(self, xs, ys, indptr, indices, lengths, speeds=None):
+        self.xs = np.asarray(xs, dtype=float)
+        self.ys = np.asarray(ys, dtype=float)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=float)
+        self.speeds = np.zeros(len(self.indices)) if speeds is None \
+            else np.asarray(speeds, dtype=float)
+        self.index = GridIndex(self.xs, self.ys)
+        self._adjacency = None
+
+    def __len__(self):
+        return len(self.xs)
+
+    @classmethod
+    def from_edges(cls, x1, y1, x2, y2, lengths=None, oneway=None,
+                   speeds=None, precision=7):
+        """Build a graph from the coordinates of the ends of its edges.
+
+        :param lengths: array of the lengths of the edges in meters, the
+            great circle distances between their ends by default or where
+            they are NaN
+        :param oneway: boolean array of the edges only going from (x1, y1)
+            to (x2, y2), none by default
+        :param speeds: array of the speeds in km/h of the edges
+        :param int precision: decimal places of the coordinates of the same
+            node
+        """
+        x1, y1, x2, y2 = (np.asarray(a, dtype=float)
+                          for a in (x1, y1, x2, y2))
+        ends = np.round(np.concatenate([np.column_stack([x1, y1]),
+                                        np.column_stack([x2, y2])]),
+                        precision)
+        nodes, ids = np.unique(ends, axis=0, return_inverse=True)
+        ids = ids.reshape(-1)
+        u, v = ids[:len(x1)], ids[len(x1):]
+        distances = haversine(x1, y1, x2, y2)
+        lengths = distances if lengths is None else np.where(
+            np.isnan(lengths), distances, np.asarray(lengths, dtype=float))
+        speeds = np.zeros(len(x1)) if speeds is None \
+            else np.asarray(speeds, dtype=float)
+        both = np.ones(len(x1), dtype=bool) if oneway is None \
+            else ~np.asarray(oneway, dtype=bool)
+        u, v = np.concatenate([u, v[both]]), np.concatenate([v, u[both]])
+        lengths = np.concatenate([lengths, lengths[both]])
+        speeds = np.concatenate([speeds, speeds[both]])
+        order = np.argsort(u, kind='stable')
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(
+            u, minlength=len(nodes)))])
+        LOGGER.info("Road graph with %s nodes and %s edges", len(nodes),
+                    len(u))
+        return cls(nodes[:, 0], nodes[:, 1], indptr, v[order],
+                   lengths[order], speeds[order])
+
+    @classmethod
+    def load(cls, path):
+        """Load a graph from a csv edge list, or a .npz file written by
+        `save`.
+        """
+        LOGGER.info("Load the road graph %s", path)
+        if not os.path.isfile(path):
+            raise errors.InvalidFileError(
+                "No road network file {0}, see rap.graph for making "
+                "one".format(path))
+        if path.endswith('.npz'):
+            with np.load(path) as arrays:
+                return cls(**{k: arrays[k] for k in arrays.files})
+        with open(path, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            missing = {'x1', 'y1', 'x2', 'y2'} - set(reader.fieldnames or [])
+            if missing:
+                raise errors.InvalidFileError(
+                    "The edges of {0} have no {1}".format(
+                        path, ', '.join(sorted(missing))))
+            columns = collections.defaultdict(list)
+            for row in reader:
+                for k, value in row.items():
+                    columns[k].append(value)
+        arrays = {k: np.asarray(columns[k], dtype=float)
+                  for k in ('x1', 'y1', 'x2', 'y2')}
+        for k, blank in (('length', 'nan'), ('oneway', 0), ('speed', 0)):
+            if k in columns:
+                arrays[k] = np.asarray([v or blank for v in columns[k]],
+                                       dtype=float)
+        return cls.from_edges(arrays['x1'], arrays['y1'], arrays['x2'],
+                              arrays['y2'], arrays.get('length'),
+                              arrays.get('oneway'), arrays.get('speed'))
+
+    def save(self, path):
+        """Write the arrays of the graph to a .npz file."""
+        np.savez_compressed(path, xs=self.xs, ys=self.ys, indptr=self.indptr,
+                            indices=self.indices, lengths=self.lengths,
+                            speeds=self.speeds)
+
+    def shortest_paths(self, source, weights):
+        """Search the shortest paths from a node to all the others.
+
+        :param int source: index of the starting node
+        :param weights: array of the non-negative costs of the edges
+        :return: (costs, lengths, predecessors) arrays over the nodes, with
+            an infinite cost and a predecessor of -1 for the nodes not
+            reached
+        """
+        if self._adjacency is None:
+            # Indexing lists is much faster than numpy arrays in the loop
+            self._adjacency = (self.indptr.tolist(), self.indices.tolist(),
+                               self.lengths.tolist())
+        indptr, indices, lengths = self._adjacency
+        weights = np.asarray(weights, dtype=float).tolist()
+        n = len(self)
+        costs = [float('inf')] * n
+        dists = [float('inf')] * n
+        preds = [-1] * n
+        done = [False] * n
+        costs[source] = dists[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            cost, u = heapq.heappop(heap)
+            if done[u]:
+                continue
+            done[u] = True
+            for e in range(indptr[u], indptr[u + 1]):
+                v = indices[e]
+                c = cost + weights[e]
+                if c < costs[v]:
+                    costs[v] = c
+                    dists[v] = dists[u] + lengths[e]
+                    preds[v] = u
+                    heapq.heappush(heap, (c, v))
+        return np.array(costs), np.array(dists), np.array(preds)
+
+    def path(self, predecessors, target):
+        """Get the nodes of the path to a target, from the source on."""
+        nodes = []
+        while target != -1:
+            nodes.append(int(target))
+            target = predecessors[target]
+        return nodes[::-1]
+
+
+class GraphRouter(RoutingService):
+    """Router searching the fastest paths in a local road network.
+
+    The positions are snapped to the nearest nodes of the graph within
+    `max_snap` meters, and the straight lines to them are added to the paths
+    at the speed of the profile. One search from the node of a source finds
+    the paths to all the nodes, and the searches of the last sources are
+    kept, so probing all the points from a landmark costs a single search.
+    """
+
+    # Speeds in km/h of the profiles, the speeds of the edges are used for
+    # driving when known
+    profile_dict = {'walking': 5.0, 'cycling': 15.0, 'driving': 50.0}
+    # Any number of points is answered from the search of the source
+    matrix_max_locations = 10001
+    # Query parameters leaving out the geometry of the paths
+    summary_params = {'geometry': 'false'}
+    # Number of searches kept in memory
+    max_searches = 4
+
+    def __init__(self, profile, api_key=None, rate_limit=-1, cache=None,
+                 pool_size=None, route_cache=None, http=None, graph=None,
+                 max_snap=500):
+        """Creates a router.
+
+        :param RoadGraph graph: the road network
+        :param float max_snap: meters between a position and its node, no
+            path is found for the positions farther from the graph
+        """
+        LOGGER.debug("GraphRouter __init__ with %s and %s arguments passed "
+                     "in", profile, max_snap)
+        if profile not in self.profile_dict:
+            raise errors.InvalidProfileError(
+                "GraphRouter has no profile {0}".format(profile))
+        super(GraphRouter, self).__init__(api_key, cache, rate_limit,
+                                          pool_size, route_cache, http)
+        self.profile = profile
+        self.graph = graph
+        self.max_snap = max_snap
+        # Meters per second off the graph
+        self.speed = self.profile_dict[profile] / 3.6
+        speeds = np.full(len(graph.lengths), self.profile_dict[profile])
+        if profile == 'driving':
+            speeds = np.where(graph.speeds > 0, graph.speeds, speeds)
+        self.weights = graph.lengths / (speeds / 3.6)
+        self._searches = collections.OrderedDict()
+        self._search_lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, profile, conf, pool_size=None, route_cache=None):
+        """Creates a router from its settings in routerconf.json, the
+        `graph` file of the road network and optionally `max_snap`.
+        """
+        if not conf.get('graph'):
+            raise errors.InvalidFileError(
+                "No road network file is configured for the graph router")
+        return cls(profile, rate_limit=conf.get('rate_limit', -1),
+                   pool_size=pool_size, route_cache=route_cache,
+                   graph=RoadGraph.load(conf['graph']),
+                   max_snap=conf.get('max_snap', 500))
+
+    def search(self, node):
+        """Get the (costs, lengths, predecessors) of the paths from a node,
+        see `RoadGraph.shortest_paths`.
+        """
+        with self._search_lock:
+            if node in self._searches:
+                self._searches.move_to_end(node)
+                return self._searches[node]
+            LOGGER.debug("Search the paths from node %s", node)
+            result = self.graph.shortest_paths(node, self.weights)
+            self._searches[node] = result
+            while len(self._searches) > self.max_searches:
+                self._searches.popitem(last=False)
+            return result
+
+    def _paths(self, source, targets):
+        # Get the duration and distance of the paths to the targets, with
+        # the node of the target and the predecessors to follow back to the
+        # source, None for no path
+        node, off = self.graph.index.nearest(source[0], source[1],
+                                             self.max_snap)
+        if node is None:
+            return [None] * len(targets)
+        costs, dists, preds = self.search(node)
+        targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+        nodes, offs = self.graph.index.nearest_many(targets[:, 0],
+                                                    targets[:, 1],
+                                                    self.max_snap)
+        found = nodes >= 0
+        durations = np.full(len(nodes), np.inf)
+        distances = np.full(len(nodes), np.inf)
+        durations[found] = costs[nodes[found]] + \
+            (off + offs[found]) / self.speed
+        distances[found] = dists[nodes[found]] + off + offs[found]
+        return [{'node': int(n), 'preds': preds, 'duration': float(t),
+                 'distance': float(d)} if np.isfinite(t) else None
+                for n, t, d in zip(nodes, durations, distances)]
+
+    def fetch_path(self, source_lng, source_lat, target_lng, target_lat,
+                   params=None):
+        """Find the fastest path in the road network.
+
+        :param Dict params: `geometry` set to `false` leaves out the
+            coordinates of the path
+        :return: None for no path found, or a dict with the `duration` in
+            seconds, the `distance` in meters and the GeoJSON LineString
+            `geometry` of the path
+        """
+        found = self._paths((source_lng, source_lat),
+                            [(target_lng, target_lat)])[0]
+        if found is None:
+            return None
+        route = {'duration': found['duration'],
+                 'distance': found['distance']}
+        if str((params or {}).get('geometry', 'true')).lower() != 'false':
+            nodes = self.graph.path(found['preds'], found['node'])
+            route['geometry'] = {
+                'type': 'LineString',
+                'coordinates': [[source_lng, source_lat]] + [
+                    [float(self.graph.xs[n]), float(self.graph.ys[n])]
+                    for n in nodes] + [[target_lng, target_lat]]
+            }
+        return route
+
+    async def fetch_path_async(self, source_lng, source_lat, target_lng,
+                               target_lat, params=None):
+        """Same as `fetch_path`, blocking the event loop for the search."""
+        return self.fetch_path(source_lng, source_lat, target_lng,
+                               target_lat, params)
+
+    def request_matrix(self, source, targets, params=None):
+        """Find the fastest paths from one source to many targets, see
+        `find_paths_matrix`.
+        """
+        return [None if found is None else
+                {'duration': found['duration'],
+                 'distance': found['distance']}
+                for found in self._paths(source, targets)]
+
+    def route_summary(self, route):
+        if route is None:
+            return None
+        return {'duration': route['duration'], 'distance': route['distance']}
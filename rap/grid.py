@@ -0,0 +1,204 @@
+"""Stub point grids generated from the test areas in appconf.json
+"""
+
+import json
+import logging
+import numpy as np
+from . import errors
+
+LOGGER = logging.getLogger(__name__)
+
+
+def grid_shape(bbox, spacing):
+    """Get the number of rows and columns of the grid covering a bbox.
+
+    :param Dict bbox: `left`, `right`, `top` and `bottom` of the test area
+    :param float spacing: distance between two stub points in degrees
+    :return: a (rows, cols) tuple
+    """
+    if spacing <= 0:
+        raise errors.InvalidParameterError(
+            "Stub spacing should be positive, not {0}".format(spacing))
+    cols = int(round((bbox['right'] - bbox['left']) / spacing)) + 1
+    rows = int(round((bbox['top'] - bbox['bottom']) / spacing)) + 1
+    return rows, cols
+
+
+def _decimals(spacing):
+    # Round the coordinates a bit finer than the spacing to get rid of the
+    # floating point noise, e.g. 11.451 instead of 11.450999999999999
+    return int(max(0, -np.floor(np.log10(spacing)))) + 3
+
+
+def grid_coords(bbox, spacing, ids):
+    """Compute the coordinates of stub points of a grid.
+
+    The points are numbered row by row from the top left corner, so that the
+    id of a point only depends on its position in the grid.
+
+    :param ids: array of point ids
+    :return: (xs, ys) arrays of the coordinates of the points
+    """
+    rows, cols = grid_shape(bbox, spacing)
+    r, c = np.divmod(np.asarray(ids, dtype=np.int64), cols)
+    decimals = _decimals(spacing)
+    xs = np.round(bbox['left'] + c * spacing, decimals)
+    ys = np.round(bbox['top'] - r * spacing, decimals)
+    return xs, ys
+
+
+def grid_chunk(bbox, spacing, start, stop):
+    """Compute a range of the stub points of a grid.
+
+    :return: (ids, xs, ys) arrays of the points with id in [start, stop)
+    """
+    rows, cols = grid_shape(bbox, spacing)
+    ids = np.arange(start, min(stop, rows * cols), dtype=np.int64)
+    xs, ys = grid_coords(bbox, spacing, ids)
+    return ids, xs, ys
+
+
+def points_in_polygons(xs, ys, polygons):
+    """Test which points are inside any of the polygons.
+
+    The even-odd rule is applied to all the rings of a polygon, so the holes
+    are excluded.
+
+    :param xs: array of the longitudes of the points
+    :param ys: array of the latitudes of the points
+    :param list polygons: coordinates of GeoJSON Polygons, i.e. lists of
+        rings of (lng, lat) positions
+    :return: boolean array
+    """
+    inside_any = np.zeros(xs.shape, dtype=bool)
+    for polygon in polygons:
+        inside = np.zeros(xs.shape, dtype=bool)
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=float)
+            x1, y1 = ring[:, 0], ring[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            for ax, ay, bx, by in zip(x1, y1, x2, y2):
+                if ay == by:
+                    continue
+                crosses = (ay > ys) != (by > ys)
+                x_cross = ax + (ys - ay) * (bx - ax) / (by - ay)
+                inside ^= crosses & (xs < x_cross)
+        inside_any |= inside
+    return inside_any
+
+
+def load_mask(path):
+    """Load the polygons of a GeoJSON file as a mask for the grid.
+
+    Polygon and MultiPolygon geometries are accepted, alone or in Features
+    and FeatureCollections.
+
+    :return: list of polygon coordinates for `points_in_polygons`
+    """
+    with open(path, 'r') as f:
+        obj = json.load(f)
+    polygons = []
+
+    def collect(o):
+        if o['type'] == 'FeatureCollection':
+            for feature in o['features']:
+                collect(feature)
+        elif o['type'] == 'Feature':
+            collect(o['geometry'])
+        elif o['type'] == 'Polygon':
+            polygons.append(o['coordinates'])
+        elif o['type'] == 'MultiPolygon':
+            polygons.extend(o['coordinates'])
+        else:
+            raise errors.InvalidFeatureError(
+                "{0} is not a polygon in {1}".format(o['type'], path))
+
+    collect(obj)
+    return polygons
+
+
+def iter_grid(bbox, spacing, mask=None, chunk_size=100000):
+    """Generate the stub points of a grid lazily in chunks.
+
+    :param Dict bbox: `left`, `right`, `top` and `bottom` of the test area
+    :param float spacing: distance between two stub points in degrees
+    :param list mask: polygons to keep the points in, see `load_mask`
+    :param int chunk_size: number of grid cells computed at once
+    :return: generator of (ids, xs, ys) arrays
+    """
+    rows, cols = grid_shape(bbox, spacing)
+    LOGGER.info("Generate a grid of %s x %s stub points", rows, cols)
+    for start in range(0, rows * cols, chunk_size):
+        ids, xs, ys = grid_chunk(bbox, spacing, start, start + chunk_size)
+        if mask is not None:
+            inside = points_in_polygons(xs, ys, mask)
+            ids, xs, ys = ids[inside], xs[inside], ys[inside]
+        yield ids, xs, ys
+
+
+def grid_points(bbox, spacing, mask=None, chunk_size=100000):
+    """Generate the stub points of a grid one by one.
+
+    :return: generator of dicts with `x`, `y` and `id` like the rows of a
+        points csv file
+    """
+    for ids, xs, ys in iter_grid(bbox, spacing, mask, chunk_size):
+        for i, x, y in zip(ids.tolist(), xs.tolist(), ys.tolist()):
+            yield {'x': x, 'y': y, 'id': i}
+
+
+def morton_codes(xs, ys, bits=16):
+    """Compute the Z-order codes of points in their bounding box.
+
+    The box is split into 2^bits x 2^bits cells, and the codes interleave
+    the bits of the column and the row of the cell of every point.
+
+    :return: array of unsigned integers, with 2 * bits significant bits
+    """
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    if not len(xs):
+        return np.zeros(0, dtype=np.uint64)
+    cells = 1 << bits
+
+    def quantize(v):
+        span = v.max() - v.min()
+        if span == 0:
+            return np.zeros(v.shape, dtype=np.uint64)
+        return np.minimum(np.floor((v - v.min()) / span * cells),
+                          cells - 1).astype(np.uint64)
+
+    cols, rows = quantize(xs), quantize(ys)
+    codes = np.zeros(xs.shape, dtype=np.uint64)
+    for b in range(bits):
+        codes |= ((cols >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b)
+        codes |= ((rows >> np.uint64(b)) & np.uint64(1)) << \
+            np.uint64(2 * b + 1)
+    return codes
+
+
+def spread_order(xs, ys, bits=16):
+    """Order points from coarse to fine, for progressive coverage.
+
+    The bounding box of the points is split into quadrants recursively. The
+    first point along the Z-order curve of every quadrant at a level of the
+    splits comes before all the points taken at the finer levels, and the
+    points of a level follow the curve. Any first part of the order thus
+    covers the whole area, down to a resolution growing with its length.
+
+    :return: array of the indices of the points in spread order
+    """
+    codes = morton_codes(xs, ys, bits)
+    if not len(codes):
+        return np.zeros(0, dtype=np.int64)
+    by_code = np.argsort(codes, kind='stable')
+    sorted_codes = codes[by_code]
+    # A point is the first of its quadrant at the level below the quadrants
+    # it shares with the point before it on the curve
+    differ = sorted_codes[1:] ^ sorted_codes[:-1]
+    differing_bits = np.zeros(differ.shape, dtype=np.int64)
+    nonzero = differ > 0
+    differing_bits[nonzero] = np.floor(
+        np.log2(differ[nonzero].astype(float))).astype(np.int64) + 1
+    shared = bits - (differing_bits + 1) // 2
+    levels = np.concatenate(([0], shared + 1))
+    return by_code[np.argsort(levels, kind='stable')]
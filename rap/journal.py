@@ -0,0 +1,89 @@
+"""Append-only journal of probing results for resumable runs
+"""
+
+import csv
+import logging
+import os
+from . import errors
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ResultJournal(object):
+    """CSV file of probing results written row by row as they are done.
+
+    The rows are flushed and synced to the disk every `sync_every` rows, so
+    that at most that many results are lost if the run is killed. A journal
+    opened with `resume` keeps the rows already written, and the ids of the
+    points in them are available in `done` to skip them. The rows written
+    afterwards are not kept in memory, only counted in `written`.
+    """
+
+    def __init__(self, path, fieldnames, resume=False, sync_every=100):
+        """Opens a journal.
+
+        :param str path: path of the CSV file
+        :param list fieldnames: columns of the CSV file, including `id`
+        :param bool resume: keep the rows of an existing file
+        :param int sync_every: number of rows between two syncs to the disk
+        """
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self.sync_every = sync_every
+        self.done = set()
+        self.written = 0
+        self._pending = 0
+        if resume and os.path.isfile(path) and os.path.getsize(path) > 0:
+            self._load()
+            self._file = open(path, 'a', newline='')
+            self._writer = csv.DictWriter(self._file, self.fieldnames)
+        else:
+            self._file = open(path, 'w', newline='')
+            self._writer = csv.DictWriter(self._file, self.fieldnames)
+            self._writer.writeheader()
+            self.sync()
+
+    def _load(self):
+        # Drop the last row if it was only partly written when killed
+        with open(self.path, 'rb+') as f:
+            content = f.read()
+            end = content.rfind(b'\n') + 1
+            if end < len(content):
+                LOGGER.warning("Drop the incomplete last row of %s",
+                               self.path)
+                f.truncate(end)
+        with open(self.path, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames != self.fieldnames:
+                raise errors.InvalidFileError(
+                    "Cannot resume {0}, its columns {1} are not {2}".format(
+                        self.path, reader.fieldnames, self.fieldnames))
+            for r in reader:
+                self.done.add(int(r['id']))
+        LOGGER.info("Resume with %s points done in %s", len(self.done),
+                    self.path)
+
+    def write(self, row):
+        """Append the result of a point."""
+        self._writer.writerow(row)
+        self.written += 1
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """Flush the rows written so far to the disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,327 @@
+"""Vectorized loading of the routes saved by probing jobs
+
+The routes of a run, saved one JSON file per route in a directory by
+`rap.store.DirectoryStore` or in the routes.db of a `SQLiteStore`, are
+summed up into NumPy arrays aligned with the ids of the points::
+
+    from rap.loader import load_point_ids, load_results
+
+    ids = load_point_ids('input/dense-munich.csv')
+    mapbox = load_results('output/mapbox/walking/2017-06-01', ids,
+                          index=True)
+    ors = load_results('output/openrouteservice/walking/2017-06-01/'
+                       'routes.db', ids, index=True)
+    slower = mapbox['duration'] - ors['duration']
+
+The routes are decoded by a pool of processes. With an `index` the summaries
+are kept in a .npz file, loaded instead of the routes as long as the store
+is unchanged.
+"""
+
+import csv
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import errors
+
+LOGGER = logging.getLogger(__name__)
+
+# Status of a point, no route saved is either no path found or not probed
+MISSING = 0
+FOUND = 1
+INVALID = -1
+
+# Columns of the loaded results besides the `id` of the points
+COLUMNS = ('duration', 'distance', 'geometry_size', 'status')
+
+# Name of the default index file of a directory of routes
+INDEX_NAME = 'index.npz'
+# Routes decoded by a process at once
+CHUNK_SIZE = 1000
+
+
+def polyline_size(encoded):
+    """Count the positions of an encoded polyline without decoding it.
+
+    Every coordinate ends with the only character of its chunks below 0x5f,
+    a position has two of them.
+    """
+    chars = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8)
+    return int(np.count_nonzero(chars < 0x5f)) // 2
+
+
+def geometry_size(geometry):
+    """Count the positions of a route geometry.
+
+    :param geometry: an encoded polyline, a GeoJSON LineString or its list
+        of coordinates
+    :return: the number of positions, 0 if not known
+    """
+    if isinstance(geometry, str):
+        return polyline_size(geometry)
+    if isinstance(geometry, dict):
+        if 'points' in geometry:
+            return polyline_size(geometry['points'])
+        geometry = geometry.get('coordinates')
+    if isinstance(geometry, list):
+        return len(geometry)
+    return 0
+
+
+def summarize_route(route):
+    """Extract the duration, distance and geometry size of a saved route.
+
+    The response bodies of Mapbox, OpenRouteService and Google Maps, and the
+    paths of `rap.graph`, are understood.
+
+    :param route: the decoded JSON of a saved route
+    :return: None if there is no route in it; a (duration, distance,
+        geometry size) tuple otherwise, NaN for a duration or distance not
+        known
+    """
+    if isinstance(route, dict) and 'routes' in route:
+        route = route['routes']
+    if isinstance(route, list):
+        if not route:
+            return None
+        route = route[0]
+    if not isinstance(route, dict):
+        raise ValueError("Unknown route format")
+    if 'legs' in route and 'duration' not in route:
+        # Google Maps, the legs are summed up as by its router
+        legs = route['legs']
+        duration = sum(l['duration']['value'] for l in legs)
+        distance = sum(l['distance']['value'] for l in legs)
+        return duration, distance, geometry_size(
+            route.get('overview_polyline'))
+    # OpenRouteService has a summary, Mapbox and rap.graph do not
+    summary = route['summary'] if isinstance(route.get('summary'), dict) \
+        else route
+    duration, distance = summary.get('duration'), summary.get('distance')
+    return (np.nan if duration is None else duration,
+            np.nan if distance is None else distance,
+            geometry_size(route.get('geometry')))
+
+
+def _summarize(decode, items):
+    # Rows of (duration, distance, geometry size, status) of the routes
+    rows = []
+    for item in items:
+        try:
+            summary = summarize_route(decode(item))
+        except (OSError, ValueError, KeyError, TypeError, zlib.error) as e:
+            LOGGER.debug("Cannot read route %s: %s", item, e)
+            rows.append((np.nan, np.nan, 0, INVALID))
+            continue
+        if summary is None:
+            rows.append((np.nan, np.nan, 0, MISSING))
+        else:
+            rows.append(summary + (FOUND, ))
+    return rows
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def _decode_blob(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def _summarize_files(paths):
+    return _summarize(_read_file, paths)
+
+
+def _summarize_blobs(blobs):
+    return _summarize(_decode_blob, blobs)
+
+
+def _scan(summarize, items, workers):
+    # Summarize the items in chunks, by a pool of processes unless there is
+    # only one worker or chunk
+    chunks = [items[i:i + CHUNK_SIZE]
+              for i in range(0, len(items), CHUNK_SIZE)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(chunks) < 2:
+        results = map(summarize, chunks)
+        return list(itertools.chain.from_iterable(results))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(itertools.chain.from_iterable(
+            executor.map(summarize, chunks)))
+
+
+def _route_files(routes_dir):
+    # (source id, target id, DirEntry) of the files named SOURCE_TARGET.json
+    files = []
+    for entry in os.scandir(routes_dir):
+        name, ext = os.path.splitext(entry.name)
+        if ext != '.json' or not entry.is_file():
+            continue
+        source, _, target = name.rpartition('_')
+        try:
+            files.append((source, int(target), entry))
+        except ValueError:
+            LOGGER.warning("Skip %s, not named SOURCE_TARGET.json",
+                           entry.path)
+    return files
+
+
+def _fingerprint_files(files):
+    stats = [f[2].stat() for f in files]
+    return np.array([len(stats), sum(s.st_size for s in stats),
+                     max((s.st_mtime_ns for s in stats), default=0)],
+                    dtype=np.int64)
+
+
+def _fingerprint_db(path):
+    # The write-ahead log holds changes not merged into the database yet
+    fingerprint = []
+    for p in (path, path + '-wal'):
+        s = os.stat(p) if os.path.exists(p) else None
+        fingerprint += [s.st_size, s.st_mtime_ns] if s else [0, 0]
+    return np.array(fingerprint, dtype=np.int64)
+
+
+def _index_arrays(sources, targets, rows):
+    rows = np.array(rows, dtype=np.float64).reshape(-1, len(COLUMNS))
+    return {
+        'source': np.array(sources, dtype=str),
+        'target': np.array(targets, dtype=np.int64),
+        'duration': rows[:, 0],
+        'distance': rows[:, 1],
+        'geometry_size': rows[:, 2].astype(np.int32),
+        'status': rows[:, 3].astype(np.int8)
+    }
+
+
+def scan_directory(routes_dir, workers=None):
+    """Sum up the routes saved as SOURCE_TARGET.json files in a directory.
+
+    :param int workers: number of processes decoding the routes, as many as
+        CPUs if None
+    :return: dict of the `source` and `target` ids of the routes, and their
+        `COLUMNS`, in arrays
+    """
+    files = _route_files(routes_dir)
+    return _scan_directory(files, workers)
+
+
+def _scan_directory(files, workers):
+    LOGGER.info("Read %s routes", len(files))
+    rows = _scan(_summarize_files, [f[2].path for f in files], workers)
+    return _index_arrays([f[0] for f in files], [f[1] for f in files], rows)
+
+
+def scan_database(path, workers=None):
+    """Sum up the routes saved in a database of `rap.store.SQLiteStore`.
+
+    The routes are read in order of the primary key, and decompressed and
+    decoded by a pool of processes.
+
+    :return: same as `scan_directory`
+    """
+    conn = sqlite3.connect('file:{0}?mode=ro'.format(path), uri=True)
+    try:
+        keys = conn.execute("SELECT source_id, target_id, route FROM routes "
+                            "ORDER BY target_id, source_id").fetchall()
+    finally:
+        conn.close()
+    LOGGER.info("Read %s routes from %s", len(keys), path)
+    rows = _scan(_summarize_blobs, [k[2] for k in keys], workers)
+    return _index_arrays([str(k[0]) for k in keys], [k[1] for k in keys],
+                         rows)
+
+
+def load_index(store, index=None, workers=None):
+    """Sum up all the routes of a store, see `scan_directory`.
+
+    :param str store: directory of the route files, or SQLite database file
+    :param index: path of the .npz file caching the summaries, True for the
+        index.npz of the directory or the .index.npz next to the database,
+        or None for no cache. The index is written again when the routes
+        have changed since.
+    :return: dict of arrays, see `scan_directory`
+    """
+    is_dir = os.path.isdir(store)
+    if not is_dir and not os.path.isfile(store):
+        raise errors.InvalidParameterError(
+            "No route store found at {0}".format(store))
+    if index is True:
+        index = os.path.join(store, INDEX_NAME) if is_dir \
+            else store + '.index.npz'
+    if is_dir:
+        files = _route_files(store)
+        fingerprint = _fingerprint_files(files)
+    else:
+        fingerprint = _fingerprint_db(store)
+    if index and os.path.isfile(index):
+        with np.load(index) as cached:
+            if np.array_equal(cached['fingerprint'], fingerprint):
+                LOGGER.info("Load the index %s", index)
+                return {k: cached[k] for k in cached.files
+                        if k != 'fingerprint'}
+        LOGGER.info("Routes changed since the index %s", index)
+    arrays = _scan_directory(files, workers) if is_dir \
+        else scan_database(store, workers)
+    if index:
+        LOGGER.info("Write the index %s", index)
+        # np.savez adds .npz to a path without it, keep the name as given
+        with open(index, 'wb') as f:
+            np.savez(f, fingerprint=fingerprint, **arrays)
+    return arrays
+
+
+def load_results(store, ids, source_id=None, index=None, workers=None):
+    """Load the duration, distance, geometry size and status of the routes
+    to the points.
+
+    :param str store: directory of the route files, or SQLite database file
+    :param ids: ids of the points, e.g. from `load_point_ids`
+    :param source_id: id of the landmark the routes start from, only needed
+        if several landmarks were probed
+    :param index: cache of the summaries of the routes, see `load_index`
+    :param int workers: number of processes decoding the routes, as many as
+        CPUs if None
+    :return: dict of the `id` array and one array per column of `COLUMNS`,
+        in the order of `ids`, with NaN durations and distances and a
+        `MISSING` status for the points without a route
+    """
+    arrays = load_index(store, index, workers)
+    sources = np.unique(arrays['source'])
+    if source_id is None:
+        if len(sources) > 1:
+            raise errors.InvalidParameterError(
+                "Routes from several landmarks, give one of {0}".format(
+                    ', '.join(sources)))
+        source_id = sources[0] if len(sources) else ''
+    # Position of every point among the sorted targets of the landmark
+    selected = np.flatnonzero(arrays['source'] == str(source_id))
+    selected = selected[np.argsort(arrays['target'][selected],
+                                   kind='stable')]
+    targets = arrays['target'][selected]
+    ids = np.asarray(ids, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(targets, ids), len(targets) - 1)
+    found = np.zeros(len(ids), dtype=bool) if not len(targets) \
+        else targets[pos] == ids
+    rows = selected[pos[found]]
+    results = {'id': ids}
+    for column, fill in [('duration', np.nan), ('distance', np.nan),
+                         ('geometry_size', 0), ('status', MISSING)]:
+        values = np.full(len(ids), fill, dtype=arrays[column].dtype)
+        values[found] = arrays[column][rows]
+        results[column] = values
+    return results
+
+
+def load_point_ids(points_file):
+    """Read the ids of the points of a csv file, see `rap.rapy.read_points`.
+    """
+    with open(points_file, 'r') as f:
+        return np.array([int(r['id']) for r in csv.DictReader(f)],
+                        dtype=np.int64)
@@ -2,13 +2,15 @@
 """
 
 import logging
-import json
-from time import sleep
 from uritemplate import URITemplate
+from . import errors
 from .base import RoutingService
 
 LOGGER = logging.getLogger(__name__)
 
+# Codes of the HTTP 422 responses for positions which cannot be routed
+NO_ROUTE_CODES = ('NoRoute', 'NoSegment')
+
 
 class MapboxRouter(RoutingService):
     """ Wrapper class of Mapbox direction http API v5
@@ -25,13 +27,26 @@ class MapboxRouter(RoutingService):
 
     v5_baseuri = "https://api.mapbox.com/directions/v5/mapbox"
     api_uri_template = URITemplate(v5_baseuri + "{/profile}{/coordinates}")
+    # Matrix API, see
+    # https://www.mapbox.com/api-documentation/?language=cURL#matrix
+    matrix_baseuri = "https://api.mapbox.com/directions-matrix/v1/mapbox"
+    matrix_uri_template = URITemplate(matrix_baseuri +
+                                      "{/profile}{/coordinates}")
+    matrix_max_locations = 25
+    # The duration and distance are always in the route object
+    summary_params = {
+        'overview': 'false',
+        'steps': 'false',
+        'alternatives': 'false'
+    }
     profile_dict = {
         "driving": "driving",
         "walking": "walking",
         "cycling": "cycling"
     }
 
-    def __init__(self, profile, api_key, rate_limit=-1, cache=None):
+    def __init__(self, profile, api_key, rate_limit=-1, cache=None,
+                 pool_size=None, route_cache=None, http=None):
         LOGGER.debug(
             "MapboxRouter __init__ with %s, %s and %s arguments passed in",
             profile, api_key, cache)
@@ -43,45 +58,131 @@ class MapboxRouter(RoutingService):
         self.params = {}
         LOGGER.debug("The input profile %s has been converted to %s",
                      profile, self.profile)
-        super(MapboxRouter, self).__init__(api_key, cache, rate_limit)
+        super(MapboxRouter, self).__init__(api_key, cache, rate_limit,
+                                           pool_size, route_cache,
+                                           http)
+
+    def set_base_url(self, base_url):
+        self.api_uri_template = URITemplate(
+            base_url + "/directions/v5/mapbox{/profile}{/coordinates}")
+        self.matrix_uri_template = URITemplate(
+            base_url + "/directions-matrix/v1/mapbox{/profile}{/coordinates}")
 
-    def find_path(self, source_lng, source_lat, target_lng, target_lat,
-                  params=None):
-        """ Find the optimal path with Mapbox Directions HTTP API
+    def path_request(self, source_lng, source_lat, target_lng, target_lat,
+                     params=None):
+        """ Build the request to Mapbox Directions HTTP API
 
         :param float source_lng: longitude value of the starting position
         :param float source_lat: latitude value of the starting position
         :param float target_lng: longitude value of the ending position
         :param float target_lat: latitude value of the ending position
         :param Dict params: the other query parameters for the mapbox router
-        :return: None for no path found; a JSON object for the found path info
+        :return: (url, query) of the request
         """
-        self.coordinates = "{0},{1};{2},{3}".format(source_lng, source_lat,
-                                                    target_lng, target_lat)
-        self.params = {} if params is None else params
-        self.params.update({'access_token': self.api_key})
+        # Keep the request state local, the router may be shared by threads
+        coordinates = "{0},{1};{2},{3}".format(source_lng, source_lat,
+                                               target_lng, target_lat)
+        query = {} if params is None else dict(params)
+        query.update({'access_token': self.api_key})
 
         uri = self.api_uri_template.expand({
             'profile': self.profile,
-            'coordinates': self.coordinates
+            'coordinates': coordinates
         })
         LOGGER.info("Sending request to Mapbox Directions API server")
-        LOGGER.debug("Query string parameters are: %s", str(self.params))
-        if self.rate_limit > 0:
-            sleep(1 / self.rate_limit)
-        resp = self.session.get(uri, params=self.params)
-        LOGGER.debug("Get response %s", resp.text)
+        LOGGER.debug("Query string parameters are: %s", query)
+        return uri, query
+
+    def parse_path(self, resp):
+        """ Get the found path from a response of Mapbox Directions HTTP API
+
+        :raises RoutingError: the request failed, see `raise_for_failure`
+        :return: None for no path found; a JSON object for the found path info
+        """
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            # Decoding a big response is costly, only do it when logged
+            LOGGER.debug("Get response %s", resp.text)
         if resp.status_code != 200:
             LOGGER.error("Error occurs with code %s", resp.status_code)
+            if self._no_route(resp):
+                return None
+            self.raise_for_failure(resp)
             return None
         else:
             try:
-                mapbox_status_code = json.loads(resp.text)['code']
-                if str.lower(mapbox_status_code) != 'ok':
+                route = resp.json()
+                if str.lower(route['code']) != 'ok':
                     LOGGER.info("No path found")
+                    return None
             except ValueError:
                 LOGGER.info("No information from Mapbox found in the response")
-            return None
+                raise errors.TransientError(
+                    "Mapbox answered an invalid body: {0}".format(
+                        resp.text[:200]))
 
         self.handle_http_error(resp)
-        return json.loads(resp.text)
+        return route
+
+    def request_matrix(self, source, targets, params=None):
+        """ Find the optimal paths to many targets with Mapbox Matrix HTTP API
+
+        :param tuple source: (lng, lat) of the starting position
+        :param list targets: (lng, lat) of the ending positions, at most
+            `matrix_max_locations` - 1 of them
+        :param Dict params: the other query parameters for the mapbox router
+        :return: a list aligned with targets, None for no path found or a
+            dict with the duration and distance of the path
+        """
+        coordinates = ";".join("{0},{1}".format(lng, lat)
+                               for lng, lat in [source] + list(targets))
+        query = {} if params is None else dict(params)
+        query.update({
+            'sources': '0',
+            'destinations': ';'.join(str(i)
+                                     for i in range(1, len(targets) + 1)),
+            'annotations': 'duration,distance',
+            'access_token': self.api_key
+        })
+        uri = self.matrix_uri_template.expand({
+            'profile': self.profile,
+            'coordinates': coordinates
+        })
+        LOGGER.info("Sending request to Mapbox Matrix API server")
+        resp = self.send_request(uri, params=query)
+        if resp.status_code != 200:
+            LOGGER.error("Error occurs with code %s", resp.status_code)
+            if self._no_route(resp):
+                return [None] * len(targets)
+            self.raise_for_failure(resp)
+            return [None] * len(targets)
+        try:
+            matrix = resp.json()
+        except ValueError:
+            LOGGER.info("No information from Mapbox found in the response")
+            raise errors.TransientError(
+                "Mapbox answered an invalid body: {0}".format(
+                    resp.text[:200]))
+        if str.lower(matrix.get('code', '')) != 'ok':
+            LOGGER.info("No path found")
+            return [None] * len(targets)
+        durations = matrix['durations'][0]
+        distances = matrix.get('distances', [[None] * len(targets)])[0]
+        return [None if t is None else {'duration': t, 'distance': d}
+                for t, d in zip(durations, distances)]
+
+    @staticmethod
+    def _no_route(resp):
+        # Mapbox refuses the positions too far away from any road
+        try:
+            return resp.status_code == 422 and \
+                resp.json().get('code') in NO_ROUTE_CODES
+        except (ValueError, AttributeError):
+            return False
+
+    def route_summary(self, route):
+        """Extract the duration and distance of the first route found."""
+        if route is None:
+            return None
+        best = route['routes'][0]
+        return {'duration': best.get('duration'),
+                'distance': best.get('distance')}
@@ -0,0 +1,263 @@
+"""Low overhead metrics of the requests sent by routing services
+"""
+
+import collections
+import json
+import logging
+import math
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+def exponential_bounds(start, factor, count):
+    """Upper bounds of histogram buckets growing by factor from start."""
+    return [start * factor ** i for i in range(count)]
+
+
+class Histogram(object):
+    """Thread-safe histogram with fixed buckets.
+
+    Observing a value costs a binary search and a few additions, so it can
+    be done for every request. Quantiles are interpolated in the buckets.
+    """
+
+    def __init__(self, bounds):
+        """Creates an empty histogram.
+
+        :param list bounds: increasing upper bounds of the buckets, values
+            above the last one go into an overflow bucket
+        """
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        lo, hi = 0, len(self.bounds)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if value <= self.bounds[mid]:
+                hi = mid
+            else:
+                lo = mid + 1
+        with self._lock:
+            self.counts[lo] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Estimate the q-quantile, 0 <= q <= 1, None if nothing observed."""
+        with self._lock:
+            counts = list(self.counts)
+            total, low, high = self.count, self.min, self.max
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = self.bounds[i - 1] if i > 0 else low
+                upper = self.bounds[i] if i < len(self.bounds) else high
+                lower, upper = max(lower, low), min(upper, high)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return high
+
+    def snapshot(self):
+        """Get the state of the histogram as a dict."""
+        with self._lock:
+            snap = {'count': self.count, 'sum': self.sum, 'min': self.min,
+                    'max': self.max}
+        for q in (0.5, 0.9, 0.99):
+            snap['p{0:g}'.format(q * 100)] = self.quantile(q)
+        return snap
+
+
+class Metrics(object):
+    """Metrics of the requests of one routing service.
+
+    * `request_seconds`: wall time of the HTTP requests
+    * `response_bytes`: size of the response bodies
+    * `throttle_seconds`: time waited for the rate limiter
+    * `responses`: number of responses per HTTP status code
+    * `route_cache`: number of route cache hits and misses
+    * `retries`: number of retried requests per HTTP status code or error
+    """
+
+    def __init__(self, router=None):
+        """Creates empty metrics.
+
+        :param str router: name of the routing service, used as label
+        """
+        self.router = router
+        self.started = time.time()
+        self.request_seconds = Histogram(exponential_bounds(0.001, 2, 17))
+        self.response_bytes = Histogram(exponential_bounds(64, 4, 12))
+        self.throttle_seconds = Histogram(exponential_bounds(0.001, 4, 10))
+        self.responses = {}
+        self.route_cache = {'hit': 0, 'miss': 0}
+        self.retries = {}
+        self._lock = threading.Lock()
+
+    def observe_response(self, seconds, status, nbytes):
+        """Record a response received after seconds."""
+        self.request_seconds.observe(seconds)
+        if nbytes is not None:
+            self.response_bytes.observe(nbytes)
+        with self._lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+
+    def observe_retry(self, reason):
+        """Record a request retried after a server or connection error."""
+        with self._lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def observe_throttle(self, seconds):
+        """Record the time waited for the rate limiter before a request."""
+        self.throttle_seconds.observe(seconds)
+
+    def observe_cache(self, hit):
+        """Record a lookup in the route cache."""
+        with self._lock:
+            self.route_cache['hit' if hit else 'miss'] += 1
+
+    def histograms(self):
+        return [('request_seconds', self.request_seconds),
+                ('response_bytes', self.response_bytes),
+                ('throttle_seconds', self.throttle_seconds)]
+
+    def snapshot(self):
+        """Get all the metrics as a dict."""
+        with self._lock:
+            responses = {str(k): v for k, v in sorted(self.responses.items())}
+            route_cache = dict(self.route_cache)
+            retries = dict(sorted((str(k), v)
+                                  for k, v in self.retries.items()))
+        snap = {'router': self.router, 'time': time.time(),
+                'elapsed': time.time() - self.started,
+                'responses': responses, 'route_cache': route_cache,
+                'retries': retries}
+        for name, h in self.histograms():
+            snap[name] = h.snapshot()
+        return snap
+
+    def summary(self):
+        """Get a human readable summary of the metrics."""
+        snap = self.snapshot()
+        req = snap['request_seconds']
+        lines = ["{0} requests in {1:.1f}s, responses {2}".format(
+            req['count'], snap['elapsed'],
+            ', '.join('{0}: {1}'.format(k, v)
+                      for k, v in snap['responses'].items()) or 'none')]
+        if req['count']:
+            lines.append(
+                "Request time: p50 {p50:.3f}s, p90 {p90:.3f}s, "
+                "p99 {p99:.3f}s, max {max:.3f}s, total {sum:.1f}s".format(
+                    **req))
+        if snap['retries']:
+            lines.append("Retries: {0}".format(', '.join(
+                '{0}: {1}'.format(k, v) for k, v in snap['retries'].items())))
+        size = snap['response_bytes']
+        if size['count']:
+            lines.append("Response size: p50 {0:.0f}, max {1:.0f}, total "
+                         "{2:.0f} bytes".format(size['p50'], size['max'],
+                                                size['sum']))
+        throttle = snap['throttle_seconds']
+        if throttle['sum']:
+            lines.append("Rate limit wait: {0:.1f}s in total, max "
+                         "{1:.3f}s".format(throttle['sum'], throttle['max']))
+        cache = snap['route_cache']
+        if cache['hit'] or cache['miss']:
+            lines.append("Route cache: {hit} hits, {miss} misses".format(
+                **cache))
+        return '\n'.join(lines)
+
+    def prometheus_families(self):
+        """Get the samples of the metrics in the Prometheus text format.
+
+        :return: list of (metric name, metric type, sample lines)
+        """
+        label = 'router="{0}"'.format(self.router or '')
+        families = []
+        for name, h in self.histograms():
+            metric = 'rap_' + name
+            lines = []
+            with h._lock:
+                counts, total, count = list(h.counts), h.sum, h.count
+            cumulative = 0
+            for bound, n in zip(h.bounds + [math.inf], counts):
+                cumulative += n
+                le = '+Inf' if bound == math.inf else '{0:g}'.format(bound)
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                    metric, label, le, cumulative))
+            lines.append('{0}_sum{{{1}}} {2!r}'.format(metric, label, total))
+            lines.append('{0}_count{{{1}}} {2}'.format(metric, label, count))
+            families.append((metric, 'histogram', lines))
+        snap = self.snapshot()
+        families.append(('rap_responses_total', 'counter', [
+            'rap_responses_total{{{0},status="{1}"}} {2}'.format(
+                label, status, n) for status, n in snap['responses'].items()
+        ]))
+        families.append(('rap_route_cache_total', 'counter', [
+            'rap_route_cache_total{{{0},result="{1}"}} {2}'.format(
+                label, result, n)
+            for result, n in snap['route_cache'].items()
+        ]))
+        families.append(('rap_retries_total', 'counter', [
+            'rap_retries_total{{{0},reason="{1}"}} {2}'.format(
+                label, reason, n) for reason, n in snap['retries'].items()
+        ]))
+        return families
+
+    def to_prometheus(self):
+        """Export the metrics in the Prometheus text exposition format."""
+        return prometheus_text([self])
+
+    def to_json_line(self):
+        """Export a snapshot of the metrics as one line of JSON."""
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def export(self, path):
+        """Write the metrics to a file, see `export_metrics`."""
+        export_metrics([self], path)
+
+
+def prometheus_text(metrics):
+    """Export the metrics of routing services in the Prometheus text
+    exposition format, the samples of all of them grouped by metric.
+    """
+    families = collections.OrderedDict()
+    for m in metrics:
+        for name, kind, lines in m.prometheus_families():
+            families.setdefault(name, (kind, []))[1].extend(lines)
+    out = []
+    for name, (kind, lines) in families.items():
+        out.append('# TYPE {0} {1}'.format(name, kind))
+        out.extend(lines)
+    return '\n'.join(out) + '\n'
+
+
+def export_metrics(metrics, path):
+    """Write the metrics of routing services to a file.
+
+    Files ending with `.prom` are overwritten with the Prometheus text
+    format, any other file gets a JSON line per routing service appended, so
+    that the snapshots of several runs can be kept together.
+    """
+    LOGGER.info("Export the request metrics to %s", path)
+    if path.endswith('.prom'):
+        with open(path, 'w') as f:
+            f.write(prometheus_text(metrics))
+    else:
+        with open(path, 'a') as f:
+            for m in metrics:
+                f.write(m.to_json_line() + '\n')
@@ -0,0 +1,314 @@
+"""Local stand-in for the HTTP APIs of the routing services
+
+The server answers the directions and matrix requests of Mapbox and
+OpenRouteService and the directions requests of Google Maps with made-up
+but deterministic routes, so that the probing pipeline can be tested and
+benchmarked offline. Latency, server errors and rate limiting (HTTP 429)
+can be configured to mimic the real services.
+
+Usage:
+    mock = MockRoutingServer(latency=0.05, rate_limit=100)
+    with mock:
+        router.set_base_url(mock.url)
+        ...
+"""
+
+import json
+import logging
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+LOGGER = logging.getLogger(__name__)
+
+# Average walking speed in m/s and detour factor of the made-up routes
+SPEED = 1.4
+DETOUR = 1.3
+
+
+def _haversine(lng1, lat1, lng2, lat2):
+    rlat1, rlat2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((rlat2 - rlat1) / 2) ** 2 + math.cos(rlat1) * \
+        math.cos(rlat2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+class MockRoutingServer(object):
+    """Threaded HTTP server mimicking the routing service APIs.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, rate_limit=None, retry_after=1,
+                 no_route_rate=0.0, geometry_size=100, seed=None):
+        """Creates a mock server, which is started by `start`.
+
+        :param str host: address to listen on
+        :param int port: port to listen on, any free one if 0
+        :param float latency: seconds to wait before every response
+        :param float jitter: maximum random seconds added to the latency
+        :param float error_rate: probability of an HTTP 503 response
+        :param int rate_limit: requests per second answered before
+            responding with HTTP 429, unlimited if None
+        :param int retry_after: seconds in the Retry-After header of 429
+        :param float no_route_rate: fraction of the targets without a path,
+            always the same ones for the same coordinates
+        :param int geometry_size: number of positions in a route geometry
+        :param seed: seed of the random errors and latencies
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.no_route_rate = no_route_rate
+        self.geometry_size = geometry_size
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0,
+                      'bytes_sent': 0}
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        server = self
+
+        class Handler(_MockHandler):
+            mock = server
+
+        self.httpd = _Server((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base URL of the server, e.g. http://127.0.0.1:8000"""
+        host, port = self.httpd.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        LOGGER.info("Mock routing server listening on %s", self.url)
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def admit(self):
+        """Count a request and decide how to answer it.
+
+        :return: the HTTP status code to answer with, 200, 429 or 503
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            if self.rate_limit is not None:
+                second = int(time.monotonic())
+                start, count = self._window
+                if second != start:
+                    start, count = second, 0
+                self._window = (start, count + 1)
+                if count >= self.rate_limit:
+                    self.stats['rate_limited'] += 1
+                    return 429
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return 503
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return 200
+
+    def has_route(self, lng, lat):
+        """Whether there is a path to a target, deterministic."""
+        key = '{0:.6f},{1:.6f}'.format(lng, lat).encode('ascii')
+        return (zlib.crc32(key) % 10000) >= self.no_route_rate * 10000
+
+    def route(self, source, target):
+        """Make up the duration, distance and geometry of a path."""
+        distance = _haversine(source[0], source[1], target[0], target[1]) * \
+            DETOUR
+        n = max(2, self.geometry_size)
+        geometry = [[source[0] + (target[0] - source[0]) * i / (n - 1),
+                     source[1] + (target[1] - source[1]) * i / (n - 1)]
+                    for i in range(n)]
+        return distance / SPEED, distance, geometry
+
+
+def _parse_positions(text, sep, latlng=False):
+    positions = []
+    for p in unquote(text).split(sep):
+        a, b = (float(v) for v in p.split(','))
+        positions.append((b, a) if latlng else (a, b))
+    return positions
+
+
+class _Server(ThreadingHTTPServer):
+    # Many clients connect at once, the default backlog of 5 connections
+    # would make them wait for a SYN retransmission
+    request_queue_size = 1024
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, which would wait for
+    # the delayed ACK of the client on keep-alive connections
+    disable_nagle_algorithm = True
+    mock = None
+
+    def log_message(self, fmt, *args):
+        LOGGER.debug(fmt, *args)
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def reply(self, status, body, headers=None):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        # Counted first, the client may be done before the write returns
+        with self.mock._lock:
+            self.mock.stats['bytes_sent'] += len(content)
+        self.wfile.write(content)
+
+    def handle_api(self, method):
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = None
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+        parts = [p for p in url.path.split('/') if p]
+        if parts[:3] == ['directions', 'v5', 'mapbox'] and len(parts) == 5:
+            handler = self.mapbox_directions
+        elif parts[:3] == ['directions-matrix', 'v1', 'mapbox'] and \
+                len(parts) == 5:
+            handler = self.mapbox_matrix
+        elif parts == ['directions']:
+            handler = self.ors_directions
+        elif parts == ['matrix'] and method == 'POST':
+            handler = self.ors_matrix
+        elif parts == ['maps', 'api', 'directions', 'json']:
+            handler = self.google_directions
+        else:
+            self.reply(404, {'message': 'Not Found'})
+            return
+        status = self.mock.admit()
+        if status == 429 and handler == self.google_directions:
+            # Google tells about exceeded quota in the body
+            self.reply(200, {'status': 'OVER_QUERY_LIMIT', 'routes': []})
+        elif status == 429:
+            self.reply(429, {'message': 'Too Many Requests'},
+                       {'Retry-After': str(self.mock.retry_after)})
+        elif status != 200:
+            self.reply(status, {'message': 'Service Unavailable'})
+        else:
+            handler(parts, query, body)
+
+    def mapbox_directions(self, parts, query, body):
+        source, target = _parse_positions(parts[4], ';')
+        if not self.mock.has_route(*target):
+            self.reply(200, {'code': 'NoRoute',
+                             'message': 'No route found'})
+            return
+        duration, distance, geometry = self.mock.route(source, target)
+        route = {
+            'duration': duration,
+            'distance': distance,
+            'legs': [{'duration': duration, 'distance': distance,
+                      'steps': [], 'summary': ''}]
+        }
+        if query.get('overview') != 'false':
+            route['geometry'] = {'type': 'LineString',
+                                 'coordinates': geometry}
+        self.reply(200, {
+            'code': 'Ok',
+            'routes': [route],
+            'waypoints': [{'location': list(source)},
+                          {'location': list(target)}]
+        })
+
+    def matrix(self, positions, sources, destinations):
+        durations, distances = [], []
+        for s in sources:
+            row_t, row_d = [], []
+            for d in destinations:
+                if self.mock.has_route(*positions[d]):
+                    t, m, _ = self.mock.route(positions[s], positions[d])
+                else:
+                    t, m = None, None
+                row_t.append(t)
+                row_d.append(m)
+            durations.append(row_t)
+            distances.append(row_d)
+        return durations, distances
+
+    def mapbox_matrix(self, parts, query, body):
+        positions = _parse_positions(parts[4], ';')
+        sources = [int(i) for i in query.get('sources', '0').split(';')]
+        destinations = [int(i) for i in query['destinations'].split(';')]
+        durations, distances = self.matrix(positions, sources, destinations)
+        self.reply(200, {'code': 'Ok', 'durations': durations,
+                         'distances': distances})
+
+    def ors_directions(self, parts, query, body):
+        source, target = _parse_positions(query['coordinates'], '|')
+        if not self.mock.has_route(*target):
+            self.reply(404, {'error': {
+                'code': 2009,
+                'message': 'Route could not be found'}})
+            return
+        duration, distance, geometry = self.mock.route(source, target)
+        route = {'summary': {'duration': duration, 'distance': distance}}
+        if query.get('geometry') != 'false':
+            route.update({
+                'geometry_format': 'geojson',
+                'geometry': {'type': 'LineString', 'coordinates': geometry}
+            })
+        if query.get('instructions') != 'false':
+            route['segments'] = []
+        self.reply(200, {'routes': [route], 'info': {'service': 'routing'}})
+
+    def ors_matrix(self, parts, query, body):
+        positions = [tuple(p) for p in body['locations']]
+        durations, distances = self.matrix(positions, body['sources'],
+                                           body['destinations'])
+        self.reply(200, {'durations': durations, 'distances': distances,
+                         'info': {'service': 'matrix'}})
+
+    def google_directions(self, parts, query, body):
+        source = _parse_positions(query['origin'], '|', latlng=True)[0]
+        target = _parse_positions(query['destination'], '|', latlng=True)[0]
+        if not self.mock.has_route(*target):
+            self.reply(200, {'status': 'ZERO_RESULTS', 'routes': []})
+            return
+        duration, distance, geometry = self.mock.route(source, target)
+        self.reply(200, {
+            'status': 'OK',
+            'routes': [{
+                'legs': [{
+                    'duration': {'value': int(duration)},
+                    'distance': {'value': int(distance)},
+                    'steps': [{'start_location': {'lat': lat, 'lng': lng}}
+                              for lng, lat in geometry]
+                }],
+                'summary': ''
+            }]
+        })
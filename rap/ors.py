@@ -2,13 +2,15 @@
 """
 
 import logging
-import json
-from time import sleep
 from uritemplate import URITemplate
+from . import errors
 from .base import RoutingService
 
 LOGGER = logging.getLogger(__name__)
 
+# Error codes of OpenRouteService for a route or a point not found
+NO_ROUTE_CODES = (2009, 2010)
+
 
 class OpenRouteServiceRouter(RoutingService):
     """ Wrapper class of OpenRouteService directions http API v4.3.0
@@ -23,6 +25,14 @@ class OpenRouteServiceRouter(RoutingService):
 
     ors_baseuri = "https://api.openrouteservice.org/directions"
     api_uri_template = URITemplate(ors_baseuri)
+    matrix_uri_template = URITemplate("https://api.openrouteservice.org/matrix")
+    # At most 2500 routes (sources x destinations) in one matrix request
+    matrix_max_locations = 2500
+    # The summary of a route is returned without its geometry
+    summary_params = {
+        'geometry': 'false',
+        'instructions': 'false'
+    }
     profile_dict = {
         "driving": ["driving-car", "driving-hgv"],
         "driving.car": "driving-car",
@@ -46,7 +56,8 @@ class OpenRouteServiceRouter(RoutingService):
         "cycling.ebike": "cycling-electric"
     }
 
-    def __init__(self, profile, api_key, rate_limit=-1, cache=None):
+    def __init__(self, profile, api_key, rate_limit=-1, cache=None,
+                 pool_size=None, route_cache=None, http=None):
         LOGGER.debug(
             "OpenRouteServiceRouter __init__ with %s, %s, %s and %s arguments passed in",
             profile, api_key, cache, rate_limit)
@@ -59,42 +70,114 @@ class OpenRouteServiceRouter(RoutingService):
         LOGGER.debug("The input profile %s has been converted to %s",
                      profile, self.profile)
         super(OpenRouteServiceRouter, self).__init__(
-            api_key, cache, rate_limit)
+            api_key, cache, rate_limit, pool_size, route_cache, http)
 
-    def find_path(self, source_lng, source_lat, target_lng, target_lat,
-                  params=None):
-        """ Find the optimal path with OpenRouteService Directions HTTP API
+    def set_base_url(self, base_url):
+        self.api_uri_template = URITemplate(base_url + "/directions")
+        self.matrix_uri_template = URITemplate(base_url + "/matrix")
+
+    def path_request(self, source_lng, source_lat, target_lng, target_lat,
+                     params=None):
+        """ Build the request to OpenRouteService Directions HTTP API
 
         :param float source_lng: longitude value of the starting position
         :param float source_lat: latitude value of the starting position
         :param float target_lng: longitude value of the ending position
         :param float target_lat: latitude value of the ending position
         :param Dict params: the other query parameters for the OpenRouteService router
-        :return: None for no path found; a JSON object for the found path info
+        :return: (url, query) of the request
         """
-        self.coordinates = "{0},{1}|{2},{3}".format(source_lng, source_lat,
-                                                    target_lng, target_lat)
-        self.params = {} if params is None else params
-        self.params.update({'api_key': self.api_key})
-        self.params.update({'profile': self.profile})
-        self.params.update({'coordinates': self.coordinates})
+        # Keep the request state local, the router may be shared by threads
+        coordinates = "{0},{1}|{2},{3}".format(source_lng, source_lat,
+                                               target_lng, target_lat)
+        query = {} if params is None else dict(params)
+        query.update({'api_key': self.api_key})
+        query.update({'profile': self.profile})
+        query.update({'coordinates': coordinates})
 
         LOGGER.info("Sending request to OpenRouteService Directions API server")
-        LOGGER.debug("Query string parameters are: %s", str(self.params))
-        if self.rate_limit > 0:
-            sleep(1 / self.rate_limit)
-        resp = self.session.get(self.api_uri_template, params=self.params)
-        LOGGER.debug("Get response %s", resp.text)
+        LOGGER.debug("Query string parameters are: %s", query)
+        return self.api_uri_template, query
+
+    def parse_path(self, resp):
+        """ Get the found path from a response of OpenRouteService Directions HTTP API
+
+        :raises RoutingError: the request failed, see `raise_for_failure`
+        :return: None for no path found; a JSON object for the found path info
+        """
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            # Decoding a big response is costly, only do it when logged
+            LOGGER.debug("Get response %s", resp.text)
         if resp.status_code != 200:
             LOGGER.error("Error occurs with code %s", resp.status_code)
             try:
-                error_info = json.loads(resp.text)
+                error_info = resp.json()
+                # The error details may be wrapped in an `error` object
+                error_info = error_info.get('error', error_info)
                 LOGGER.info("ORS error code: %s", error_info["code"])
                 LOGGER.info("ORS error message: %s", error_info["message"])
-            except ValueError:
+                if error_info["code"] in NO_ROUTE_CODES:
+                    return None
+            except (ValueError, KeyError, AttributeError, TypeError):
                 LOGGER.info(
                     "No ORS backend error message found in the response")
+            self.raise_for_failure(resp)
             return None
 
         self.handle_http_error(resp)
-        return json.loads(resp.text)
+        try:
+            return resp.json()
+        except ValueError:
+            raise errors.TransientError(
+                "OpenRouteService answered an invalid body: {0}".format(
+                    resp.text[:200]))
+
+    def request_matrix(self, source, targets, params=None):
+        """ Find the optimal paths to many targets with OpenRouteService Matrix API
+
+        The locations are posted in the JSON body because the URL of a GET
+        request with thousands of coordinates would be too long.
+
+        :param tuple source: (lng, lat) of the starting position
+        :param list targets: (lng, lat) of the ending positions, at most
+            `matrix_max_locations` - 1 of them
+        :param Dict params: the other parameters for the OpenRouteService router
+        :return: a list aligned with targets, None for no path found or a
+            dict with the duration and distance of the path
+        """
+        body = {} if params is None else dict(params)
+        body.update({
+            'profile': self.profile,
+            'locations': [list(source)] + [list(t) for t in targets],
+            'sources': [0],
+            'destinations': list(range(1, len(targets) + 1)),
+            'metrics': ['duration', 'distance'],
+            'units': 'm'
+        })
+        LOGGER.info("Sending request to OpenRouteService Matrix API server")
+        resp = self.send_request(self.matrix_uri_template,
+                                 params={'api_key': self.api_key},
+                                 method='POST', json=body)
+        if resp.status_code != 200:
+            LOGGER.error("Error occurs with code %s", resp.status_code)
+            self.raise_for_failure(resp)
+            return [None] * len(targets)
+        try:
+            matrix = resp.json()
+        except ValueError:
+            LOGGER.info("No information from ORS found in the response")
+            raise errors.TransientError(
+                "OpenRouteService answered an invalid body: {0}".format(
+                    resp.text[:200]))
+        durations = matrix['durations'][0]
+        distances = matrix.get('distances', [[None] * len(targets)])[0]
+        return [None if t is None else {'duration': t, 'distance': d}
+                for t, d in zip(durations, distances)]
+
+    def route_summary(self, route):
+        """Extract the duration and distance of the first route found."""
+        if route is None:
+            return None
+        summary = route['routes'][0].get('summary', {})
+        return {'duration': summary.get('duration'),
+                'distance': summary.get('distance')}
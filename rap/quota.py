@@ -0,0 +1,189 @@
+"""Daily and monthly request budgets of the routing services, kept across
+runs in a SQLite database
+"""
+
+import asyncio
+import calendar
+import logging
+import sqlite3
+import threading
+import time
+from . import errors
+
+LOGGER = logging.getLogger(__name__)
+
+# Raise QuotaExceededError when a budget is used up
+STOP = 'stop'
+# Wait until the budget used up is reset
+PAUSE = 'pause'
+ACTIONS = (STOP, PAUSE)
+
+# Supported budgets and the format of the key of their current period
+PERIODS = {
+    'per_day': 'day:%Y-%m-%d',
+    'per_month': 'month:%Y-%m'
+}
+
+
+def period_key(period, now, utc_offset=0.0):
+    """Get the key of the period a budget is counted in.
+
+    :param str period: one of `PERIODS`
+    :param float now: UNIX timestamp
+    :param float utc_offset: hours between UTC and the time zone in which
+        the provider resets its quotas at midnight
+    """
+    return time.strftime(PERIODS[period],
+                         time.gmtime(now + utc_offset * 3600))
+
+
+def seconds_to_reset(period, now, utc_offset=0.0):
+    """Get the number of seconds until the next period of a budget."""
+    local = now + utc_offset * 3600
+    t = time.gmtime(local)
+    if period == 'per_day':
+        start = calendar.timegm((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0))
+        return start + 86400 - local
+    year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 \
+        else (t.tm_year, t.tm_mon + 1)
+    return calendar.timegm((year, month, 1, 0, 0, 0)) - local
+
+
+class QuotaTracker(object):
+    """Requests sent to a routing service, counted against its budgets.
+
+    The counts are kept in a SQLite database, so that they add up over the
+    runs and the processes sharing it, and start over when the provider
+    resets its quota at the beginning of a day or month.
+    """
+
+    def __init__(self, path, provider, per_day=None, per_month=None,
+                 utc_offset=0.0, action=STOP, timeout=60):
+        """Opens or creates the database of the budgets.
+
+        :param str path: path of the SQLite database file
+        :param str provider: name of the routing service
+        :param int per_day: number of requests allowed a day, if limited
+        :param int per_month: number of requests allowed a month, if limited
+        :param float utc_offset: hours between UTC and the time zone of the
+            provider, see `period_key`
+        :param str action: `STOP` or `PAUSE` when a budget is used up
+        :param float timeout: seconds to wait for the database to be unlocked
+            by another process
+        """
+        if action not in ACTIONS:
+            raise errors.InvalidParameterError(
+                "Quota action should be one of {0}".format(', '.join(ACTIONS)))
+        self.path = path
+        self.provider = provider
+        self.limits = {p: n for p, n in (('per_day', per_day),
+                                         ('per_month', per_month))
+                       if n is not None and n > 0}
+        self.utc_offset = utc_offset
+        self.action = action
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None, timeout=timeout)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS usage ("
+                           "provider TEXT NOT NULL, period TEXT NOT NULL, "
+                           "used INTEGER NOT NULL, "
+                           "PRIMARY KEY (provider, period))")
+
+    @classmethod
+    def from_conf(cls, path, provider, quota, action=STOP):
+        """Create a tracker from the `quota` settings of a router.
+
+        :param dict quota: any of the `per_day` and `per_month` budgets and
+            the `utc_offset` of the provider
+        :return: the tracker, None without any budget
+        """
+        if not quota or not any(quota.get(p, -1) > 0 for p in PERIODS):
+            return None
+        return cls(path, provider, quota.get('per_day'),
+                   quota.get('per_month'), quota.get('utc_offset', 0.0),
+                   action)
+
+    def reserve(self, requests=1, now=None):
+        """Count requests against the budgets if all of them allow it.
+
+        :return: 0 if the requests are counted, otherwise the seconds until
+            the budgets used up are reset
+        """
+        now = time.time() if now is None else now
+        keys = {p: period_key(p, now, self.utc_offset) for p in self.limits}
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            wait = 0.0
+            for period, key in keys.items():
+                row = self._conn.execute(
+                    "SELECT used FROM usage WHERE provider = ? AND "
+                    "period = ?", (self.provider, key)).fetchone()
+                if (row[0] if row else 0) + requests > self.limits[period]:
+                    wait = max(wait, seconds_to_reset(period, now,
+                                                      self.utc_offset))
+            if wait:
+                return wait
+            for key in keys.values():
+                self._conn.execute(
+                    "INSERT INTO usage VALUES (?, ?, ?) ON CONFLICT "
+                    "(provider, period) DO UPDATE SET used = used + ?",
+                    (self.provider, key, requests, requests))
+        return 0.0
+
+    def _exhausted(self, wait):
+        if self.action == STOP:
+            raise errors.QuotaExceededError(
+                "Quota of {0} is used up, reset in {1:.0f} seconds".format(
+                    self.provider, wait))
+        LOGGER.warning("Quota of %s is used up, pause for %.0f seconds",
+                       self.provider, wait)
+
+    def spend(self, requests=1):
+        """Block the current thread until the budgets allow the requests.
+
+        :raises QuotaExceededError: if a budget is used up with `STOP`
+        :return: seconds waited
+        """
+        waited = 0.0
+        while True:
+            wait = self.reserve(requests)
+            if not wait:
+                return waited
+            self._exhausted(wait)
+            # Check again a bit after the reset, the clock may be off
+            time.sleep(wait + 1)
+            waited += wait + 1
+
+    async def spend_async(self, requests=1):
+        """Same as `spend`, suspending the current coroutine."""
+        waited = 0.0
+        while True:
+            wait = self.reserve(requests)
+            if not wait:
+                return waited
+            self._exhausted(wait)
+            await asyncio.sleep(wait + 1)
+            waited += wait + 1
+
+    def usage(self, now=None):
+        """Get the requests counted in the current periods.
+
+        :return: dict of the `used` and `limit` requests of every budget
+        """
+        now = time.time() if now is None else now
+        usage = {}
+        with self._lock:
+            for period, limit in self.limits.items():
+                row = self._conn.execute(
+                    "SELECT used FROM usage WHERE provider = ? AND "
+                    "period = ?", (self.provider,
+                                   period_key(period, now,
+                                              self.utc_offset))).fetchone()
+                usage[period] = {'used': row[0] if row else 0,
+                                 'limit': limit}
+        return usage
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
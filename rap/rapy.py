@@ -1,6 +1,10 @@
 """
 Usage:
-    rapy -r ROUTER -p PROFILE -f LANDMARK -t POINTS [-o OUTPUT_DIR] [-x PARAMS] [-v | --verbose]
+    rapy -r ROUTER -p PROFILE -f LANDMARK (-t POINTS | -b TESTBED) [options]
+    rapy queue QUEUE_DB -r ROUTER -p PROFILE -f LANDMARK (-t POINTS | -b TESTBED) [options]
+    rapy worker QUEUE_DB [options]
+    rapy collect QUEUE_DB [options]
+    rapy requeue QUEUE_DB [options]
     rapy -h | --help
     rapy --version
 
@@ -11,48 +15,234 @@ parameters for different routing services can be provided in the json file
 specified by the PARAMS argument. The test area information are configured
 in `appconf.json` file.
 
+A large job can be shared by several worker processes on different hosts.
+With `queue`, the probing of every point from every landmark is added as a
+task to the work queue QUEUE_DB instead of being done. Any number of `worker`
+processes then claim batches of tasks, probe them with the router of the job
+configured in their own routerconf.json, and report their results to
+QUEUE_DB, until all the tasks are done. The tasks of a worker which does not
+report their results within LEASE seconds are handed out again. `collect`
+writes the results reported so far to OUTPUT_DIR/ROUTER.csv. A task is dead
+when its point was given up by the worker, or when it was handed out
+ATTEMPTS times without a result. The dead tasks are written to
+OUTPUT_DIR/ROUTER-failed.csv by `collect`, and put back in the queue by
+`requeue` to be probed again.
+
 Options:
-    -r ROUTER      Set routing service provider (required)
+    -r ROUTER      Set routing service provider, or several comma separated
+                   ones to compare them on the same points (required)
     -p PROFILE     Set the preferred routing profile indicating the
                    transportation mode to use for routing (required)
                    [default: walking]
     -f LANDMARK    Set the source location of the path searching job in a
                    geojson format file, which is usually a landmark within
-                   the test area (required)
-    -t POINTS      Set the input csv file containing all the points (required)
+                   the test area, or several of them (required)
+    -t POINTS      Set the input csv file containing all the points (required
+                   unless TESTBED is given)
+    -b --testbed=TESTBED
+                   Generate the stub points on a grid over a test area
+                   configured in appconf.json instead of reading POINTS
+    --spacing=DEGREES
+                   Set the distance between two stub points of the grid,
+                   default to the stubspacing of TESTBED (optional)
+    --mask=POLYGONS
+                   Only probe the grid points inside the polygons of a
+                   GeoJSON file (optional)
+    --adaptive=COARSE
+                   Probe a grid with the spacing COARSE first, then refine
+                   the cells down to the spacing of the TESTBED grid only
+                   where their corners disagree on the accessibility
+                   (optional, cannot be resumed)
+    --order=ORDER  Set the order in which the points are probed, either `file`
+                   for the order of POINTS or of the grid, or `spread` for
+                   coarse to fine over the whole area, so that the points
+                   probed by an interrupted run cover it evenly. Cannot be
+                   used with --adaptive (optional) [default: file]
+    --threshold=SECONDS
+                   Also refine the cells of an adaptive grid whose corners
+                   differ by more than SECONDS in travel time, which are
+                   only known with --acc-only or --summary (optional)
     -o OUTPUT_DIR  Set the directory for saving routing results, create a new
                    directory if not exists (optional) [default: ./output]
     -x PARAMS      Extra parameters for the router, a plain text file in JSON
                    format (optional)
+    -w --workers=WORKERS
+                   Set the number of concurrent requests sent to the router,
+                   the rate limit of the router is still respected, or a
+                   comma separated number for each ROUTER (optional)
+                   [default: 1]
+    --async        Send the requests from one event loop instead of a thread
+                   per request, with up to WORKERS of them in flight. Needs
+                   aiohttp, and cannot be used with --acc-only (optional)
+    -a --acc-only  Only calculate the accessibilities with the travel time
+                   and distance of the paths, without saving the routes. The
+                   matrix API of the router is used if it has one, and PARAMS
+                   are then sent to the matrix API (optional)
+    -S --summary   Only ask the directions API of the router for the travel
+                   time and distance of the paths, without their geometry
+                   and steps where the router allows it, and write them to
+                   the results without saving the routes. Cannot be used
+                   with --acc-only (optional)
+    -c --cache=CACHE_DB
+                   Look up the paths in a persistent route cache first, a
+                   SQLite database file created if not exists (optional)
+    --cache-ttl=DAYS
+                   Set the number of days before a cached path expires
+                   (optional)
+    --cache-size=ROUTES
+                   Set the maximum number of cached paths, the least
+                   recently used ones are evicted (optional)
+    --snap=DECIMALS
+                   Round the coordinates of the landmark and the points to
+                   DECIMALS decimal places, e.g. 4 for cells of about 10 m,
+                   and send only one request for all the points rounded to
+                   the same position. Cannot be used with --acc-only
+                   (optional)
+    --record=ARCHIVE
+                   Send all the requests and record the responses in
+                   ARCHIVE, a SQLite database file created if not exists
+                   (optional)
+    --replay=ARCHIVE
+                   Answer the requests recorded in ARCHIVE from it, without
+                   rate limit, and send and record the others (optional)
+    --strict       Fail on any request not recorded in the ARCHIVE
+                   replayed, so that nothing is sent (optional)
+    --quota=QUOTA_DB
+                   Count the requests sent to the router against its daily
+                   and monthly `quota` in routerconf.json, in a SQLite
+                   database file created if not exists and shared by all
+                   the runs. Their retries are counted, the responses
+                   replayed or cached are not (optional)
+    --on-quota=ACTION
+                   Either `stop` the run when the quota is used up, so that
+                   it can be resumed later, or `pause` it until the quota
+                   is reset (optional) [default: stop]
+    -s --store=STORE
+                   Set how the found routes are saved, either `files` for
+                   one JSON file per route or `sqlite` for a single database
+                   (optional) [default: files]
+    --resume       Resume an interrupted run, only probe the points missing
+                   in the results of OUTPUT_DIR, which are written as they
+                   are done (optional)
+    --retries=ROUNDS
+                   Probe the points whose request failed with a server
+                   error, a timeout or a rejection by the rate limit again
+                   once all the others are done, up to ROUNDS times with a
+                   growing backoff. The points still failing and those
+                   whose request was refused, e.g. as invalid, are not
+                   taken as inaccessible but written to
+                   OUTPUT_DIR/ROUTER-failed.csv, and probed again by a
+                   run with --resume (optional) [default: 3]
+    --processes=PROCESSES
+                   Split the probing into shards of the landmarks and the
+                   points, run by PROCESSES worker processes sharing the
+                   rate limit of the router, and merge their results. Used
+                   for several landmarks, cannot be used with --adaptive
+                   and --metrics (optional) [default: 1]
+    --shard-size=SIZE
+                   Set the number of points in a shard (optional)
+                   [default: 1000]
+    --batch=TASKS  Set the number of tasks a worker claims at once
+                   (optional) [default: 100]
+    --lease=LEASE  Set the number of seconds a worker has to report the
+                   results of the tasks it claimed, which should be enough
+                   for a batch (optional) [default: 600]
+    --attempts=ATTEMPTS
+                   Set the number of times a task is handed out to workers
+                   before it is dead (optional) [default: 3]
+    -m --metrics=FILE
+                   Print a summary of the request times, response sizes,
+                   status codes, rate limit waits and cache hits at the
+                   end, and export them to FILE, in the Prometheus text
+                   format if it ends with .prom, otherwise appended as a
+                   line of JSON (optional)
     -v --verbose   Show running log in detail
     -h --help      Show this help
     --version      Show version number
 
 Arguments:
     ROUTER         Routing service API provider name. The valid values are
-                   configured in appconf.json file
+                   configured in appconf.json file, and their routers must
+                   be shipped with rap or registered by another package as
+                   a `rap.routers` entry point. The `graph` router searches
+                   the paths offline in the road network file configured
+                   in routerconf.json, the synthetic street grid
+                   input/munich-grid-roads.csv by default, see `rap.graph`
+                   for extracting a real one from OpenStreetMap. Several
+                   routers probe the points at the same time, each one with
+                   its own workers and rate limit, and their results are
+                   joined in OUTPUT_DIR/ROUTER1-ROUTER2.csv with the columns
+                   of every router prefixed by its name. They cannot be
+                   used with several landmarks or processes, or with an
+                   adaptive grid of the --adaptive option
     PROFILE        Routing profile name indicating what kind of transportation
                    mode should be use, default to walking
     LANDMARK       Point information file in geojson format. Must be a valid
                    GeoJSON Point `Feature`. It will be used as the
+                   source/origin/starting location of the probing job. A
+                   `FeatureCollection` of them probes the points from every
+                   landmark, the results then have a `landmark` column with
+                   the id of the feature, or its index in the collection
     POINTS         Points information file in csv format. Must have `x`, `y`,
                    and `id` fields at least to record the longtitude and
                    latitude coordinates and id
-                   source/origin/starting location of the probing job.
-    OUTPUT_DIR     Directory for saving routing results, default to ./output
+    TESTBED        Location name, or a part of it, or index of a test area in
+                   the `testbeds` of appconf.json. The points are numbered
+                   row by row from the top left corner of its bbox
+    OUTPUT_DIR     Directory for saving routing results, default to ./output.
+                   The found routes are saved in the sub-directory
+                   ROUTER/PROFILE/YYYY-MM-DD, as SOURCE_TARGET.json files or
+                   in a routes.db SQLite database depending on STORE. The
+                   results of the shards are kept in shards/ROUTER, and the
+                   results of every router in ROUTER.csv
     PARAMS         JSON file containing extra parameters for the router
+    WORKERS        Number of worker threads sharing the router connection
+                   pool, default to 1 for probing the points one by one
+    CACHE_DB       SQLite database file caching the paths found by any
+                   router, so that probing unchanged points again is free
+    QUEUE_DB       SQLite database file of the work queue of a job, created
+                   by `queue`, which must be reachable by all the workers,
+                   e.g. on a shared file system
 
 Examples:
     rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/munich.csv
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -b munich --spacing 0.0005
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -b munich --spacing 0.001 --adaptive 0.016 -a --threshold 300
     rapy -r graphhopper -p driving -f ./input/heidelberg-hbf.json -t ./input/heidelberg.csv -o ./gh_results -v
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -w 16
+    rapy -r openrouteservice -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -a
+    rapy -r google -p walking -f ./input/muenchen-hbf.json -t ./input/munich.csv -c ./routes.db --cache-ttl 7
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -w 16 --resume
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -s sqlite
+    rapy -r openrouteservice -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -w 256 --async
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -w 16 --summary
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -w 16 --snap 4
+    rapy -r mapbox -p walking -f ./input/munich-stations.json -t ./input/munich.csv -w 8 --processes 4 --summary
+    rapy -r mapbox,openrouteservice,google -p walking -f ./input/muenchen-hbf.json -t ./input/munich.csv -w 16,4,8 --summary
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/munich.csv --record ./munich.archive
+    rapy -r mapbox -p walking -f ./input/muenchen-hbf.json -t ./input/munich.csv --replay ./munich.archive --strict
+    rapy -r google -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv --order spread --quota ./quota.db --resume
+    rapy -r graph -p walking -f ./input/muenchen-hbf.json -t ./input/dense-munich.csv -a
+    rapy queue ./job.db -r mapbox -p walking -f ./input/munich-stations.json -t ./input/dense-munich.csv --summary
+    rapy worker ./job.db -w 16
+    rapy collect ./job.db -o ./results
+    rapy requeue ./job.db
 """
 import json
 import geojson
 import os
+import asyncio
 import csv
+import collections
 import datetime
+import functools
+import itertools
 import logging.config
 import logging
+import socket
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from docopt import docopt, DocoptExit
 try:
     from schema import Schema, And, Or, Optional, Use, SchemaError
@@ -60,7 +250,20 @@ except ImportError:
     exit('This example requires that `schema` data-validation library'
          ' is installed: \n    pip install schema\n'
          'https://github.com/halst/schema')
-from rap import __version__, RoutingServiceFactory
+from rap import __version__, errors, RoutingServiceFactory
+from rap.cache import RouteCache
+from rap.dedup import Deduplicator
+from rap.adaptive import iter_adaptive
+from rap.base import RawRoute
+from rap.grid import grid_points, load_mask, spread_order
+from rap.journal import ResultJournal
+from rap.metrics import export_metrics
+from rap.quota import PAUSE, STOP, QuotaTracker
+from rap.ratelimit import RateLimiter
+from rap.replay import RECORD, REPLAY, STRICT, Archive
+from rap.servicefactory import get_router_class, load_router_conf
+from rap.store import DirectoryStore, SQLiteStore
+from rap.workqueue import LEASED, WorkQueue
 
 LOGGING_CONF_FILE = 'logging.json'
 DEFAULT_LOGGING_LVL = logging.WARNING
@@ -78,24 +281,71 @@ else:
         level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Columns of the results csv file
+ACC_FIELDNAMES = ['id', 'x', 'y', 'acc']
+MATRIX_FIELDNAMES = ACC_FIELDNAMES + ['duration', 'distance']
+# Columns of the csv file of the points given up, see `probe_with_retries`
+FAILED_FIELDNAMES = ['id', 'x', 'y', 'error', 'message']
+
+# Failures of a request telling nothing about the accessibility of a point
+PROBE_ERRORS = (errors.TransientError, errors.PermanentError)
+# Seconds before probing the failed points again, doubled every round
+RETRY_BACKOFF = 10.0
+
+
+def find_testbed(conf, name):
+    """Find a test area in appconf.json by its index or location name."""
+    if name.isdigit() and int(name) < len(conf['testbeds']):
+        return conf['testbeds'][int(name)]
+    for testbed in conf['testbeds']:
+        if str.lower(name) in str.lower(testbed['location']):
+            return testbed
+    raise ValueError("No testbed {0}".format(name))
+
 
 def validate_arguments(raw_args, conf):
     logger.info("Validating input arguments")
     sch = Schema({
-        '-r': And(Use(str.lower),
-                  lambda r: str.lower(r) in conf['routers'],
-                  error="ROUTER should be one of {0}".format(', '.join(conf[
-                      'routers']))),
+        '-r': Or(None,
+                 And(Use(str.lower),
+                     lambda r: all(name in conf['routers']
+                                   for name in r.split(','))),
+                 error="ROUTER should be one of {0}".format(', '.join(conf[
+                     'routers']))),
         '-p': And(Use(str.lower),
                   lambda p: str.lower(p) in conf['profiles'],
                   error="PROFILE should be one of {0}".format(', '.join(conf[
                       'profiles']))),
-        '-f':
-        And(lambda f: os.path.isfile(f),
+        '-f': Or(
+            None,
+            lambda f: os.path.isfile(f),
             error="LANDMARK file {0} does not exist".format(raw_args['-f'])),
-        '-t': And(
+        '-t': Or(
+            None,
             lambda t: os.path.isfile(t),
             error="POINTS file {0} does not exist".format(raw_args['-t'])),
+        Optional('--testbed'): Or(
+            None,
+            Use(lambda b: find_testbed(conf, b)),
+            error="TESTBED {0} is not configured in appconf.json".format(
+                raw_args.get('--testbed'))),
+        Optional('--spacing'): Or(
+            None, And(Use(float), lambda d: d > 0),
+            error="DEGREES should be a positive number"),
+        Optional('--adaptive'): Or(
+            None, And(Use(float), lambda d: d > 0),
+            error="COARSE should be a positive number"),
+        Optional('--order', default='file'): And(
+            Use(str.lower), lambda o: o in ('file', 'spread'),
+            error="ORDER should be either file or spread"),
+        Optional('--threshold'): Or(
+            None, And(Use(float), lambda t: t > 0),
+            error="SECONDS should be a positive number"),
+        Optional('--mask'): Or(
+            None,
+            lambda m: os.path.isfile(m),
+            error="Mask file {0} does not exist".format(
+                raw_args.get('--mask'))),
         Optional(
             '-o', default='./output'): And(
                 lambda o: os.path.isdir(o),
@@ -104,8 +354,64 @@ def validate_arguments(raw_args, conf):
             None,
             lambda x: os.path.isfile(x),
             error="Parameters file {0} does not exist".format(raw_args['-x'])),
+        Optional('--workers', default=1): And(
+            Use(lambda w: [int(n) for n in str(w).split(',')]),
+            lambda ws: all(w > 0 for w in ws),
+            error="WORKERS should be positive integers"),
         Optional('--help'): Or(True, False),
         Optional('--version'): Or(True, False),
+        Optional('--acc-only'): Or(True, False),
+        Optional('--summary'): Or(True, False),
+        Optional('--cache'): Or(None, str),
+        Optional('--cache-ttl'): Or(
+            None, And(Use(float), lambda d: d > 0),
+            error="DAYS should be a positive number"),
+        Optional('--cache-size'): Or(
+            None, And(Use(int), lambda n: n > 0),
+            error="ROUTES should be a positive integer"),
+        Optional('--snap'): Or(
+            None, And(Use(int), lambda d: d >= 0),
+            error="DECIMALS should be a non-negative integer"),
+        Optional('--record'): Or(None, str),
+        Optional('--replay'): Or(
+            None,
+            lambda a: os.path.isfile(a),
+            error="ARCHIVE {0} does not exist".format(
+                raw_args.get('--replay'))),
+        Optional('--strict'): Or(True, False),
+        Optional('--quota'): Or(None, str),
+        Optional('--on-quota', default=STOP): And(
+            Use(str.lower), lambda a: a in (STOP, PAUSE),
+            error="ACTION should be either stop or pause"),
+        Optional('--store', default='files'): And(
+            Use(str.lower), lambda s: s in ('files', 'sqlite'),
+            error="STORE should be either files or sqlite"),
+        Optional('--resume'): Or(True, False),
+        Optional('--retries', default=3): And(
+            Use(int), lambda n: n >= 0,
+            error="ROUNDS should be a non-negative integer"),
+        Optional('--processes', default=1): And(
+            Use(int), lambda n: n > 0,
+            error="PROCESSES should be a positive integer"),
+        Optional('--shard-size', default=1000): And(
+            Use(int), lambda n: n > 0,
+            error="SIZE should be a positive integer"),
+        Optional('--batch', default=100): And(
+            Use(int), lambda n: n > 0,
+            error="TASKS should be a positive integer"),
+        Optional('--lease', default=600): And(
+            Use(float), lambda t: t > 0,
+            error="LEASE should be a positive number"),
+        Optional('--attempts', default=3): And(
+            Use(int), lambda n: n > 0,
+            error="ATTEMPTS should be a positive integer"),
+        Optional('queue'): Or(True, False),
+        Optional('worker'): Or(True, False),
+        Optional('collect'): Or(True, False),
+        Optional('requeue'): Or(True, False),
+        Optional('QUEUE_DB'): Or(None, str),
+        Optional('--async'): Or(True, False),
+        Optional('--metrics'): Or(None, str),
         Optional('--verbose'): Or(True, False)
     })
     try:
@@ -120,51 +426,1020 @@ def validate_arguments(raw_args, conf):
     return args
 
 
-def save_route_to(route, filepath):
-    logger.debug("Save the found route information to {0} ".format(filepath))
-    with open(filepath, 'w') as f:
-        json.dump(route, f)
+def read_points(points_file):
+    """Read the stub points from a csv file lazily, one row at a time.
+    """
+    with open(points_file, 'r') as f:
+        logger.debug("Data file %s has been opened for reading", points_file)
+        for r in csv.DictReader(f):
+            logger.debug("Current row in the points info file: %s", r)
+            yield {
+                'x': float(r['x']),
+                'y': float(r['y']),
+                'id': int(r['id'])
+            }
+
+
+def order_points(points, order='file'):
+    """Put the points in the order they are probed in.
+
+    :param str order: `file` to keep their order, or `spread` for the
+        coarse to fine order of `rap.grid.spread_order`
+    :return: the points, a list if they are reordered
+    """
+    if order != 'spread':
+        return points
+    points = list(points)
+    logger.info("Order %s points from coarse to fine", len(points))
+    xs = np.fromiter((p['x'] for p in points), dtype=float, count=len(points))
+    ys = np.fromiter((p['y'] for p in points), dtype=float, count=len(points))
+    return [points[i] for i in spread_order(xs, ys).tolist()]
+
+
+def open_dead_letters(path):
+    """Open the csv file of the points given up, see `probe_with_retries`."""
+    return ResultJournal(path, FAILED_FIELDNAMES)
+
+
+def close_dead_letters(dead_letters, report=True):
+    """Close the csv file of the points given up, and remove it if there are
+    none.
+
+    :param bool report: print the number of points given up, if any
+    """
+    dead_letters.close()
+    if not dead_letters.written:
+        os.remove(dead_letters.path)
+    elif report:
+        print("{0} points failed and are left out of the results, see "
+              "{1}".format(dead_letters.written, dead_letters.path))
+
+
+def open_store(kind, output_dir):
+    """Open the store for the found routes of a job.
+
+    :param str kind: `files` for one JSON file per route in output_dir, or
+        `sqlite` for a single database output_dir/routes.db
+    """
+    if kind == 'sqlite':
+        return SQLiteStore(os.path.join(output_dir, 'routes.db'))
+    return DirectoryStore(output_dir)
+
+
+def try_touching(router, source, target, store, params=None):
+    """Search for a path from source to target and save it in the store.
+
+    :param store: a route store of `rap.store`, or a directory for saving one
+        JSON file per route
+    :return: 1 if a path is found, otherwise 0
+    """
+    logger.debug("Try searching for a path from %s to %s", source, target)
+    res = router.find_path_raw(source['x'], source['y'], target['x'],
+                               target['y'], params)
+    return save_route(store, source, target, res)
 
 
-def try_touching(router, source, target, output_dir, params=None):
-    logger.debug("Try searching for a path from {0} to {1}".format(
-        str(source), str(target)))
-    res = router.find_path(source['x'], source['y'], target['x'], target['y'],
-                           params)
+def save_route(store, source, target, res):
+    """Save the path found from source to target, see `try_touching`.
+
+    The response body of a RawRoute is saved as it is.
+
+    :return: 1 if a path is found, otherwise 0
+    """
     if res is None:
         return 0
-    # The found routes will be stored in a directory like
-    # /OUTPUT_DIR_ROOT/ROUTER/PROFILE/YYYY-MM-DD/SOURCE_TARGET.json
-    os.makedirs(output_dir, exist_ok=True)
-    save_route_to(res,
-                  os.path.join(output_dir, '{0}_{1}.json'.format(
-                      source['id'], target['id'])))
+    if isinstance(store, str):
+        store = DirectoryStore(store)
+    if isinstance(res, RawRoute):
+        res = res.body
+    store.save(source['id'], target['id'], res)
     return 1
 
 
-def cal_accessibility(router, source, all_pts, output_dir, params=None):
+def map_in_order(func, items, workers=1, window=None):
+    """Apply func to all the items, concurrently with more than one worker.
+
+    The results are yielded in the order of items in any case, each one as
+    soon as it and all the ones before it are done. The items are consumed
+    lazily, with at most `window` of them (twice the workers by default)
+    being processed or waiting to be yielded at any time.
+    """
+    if workers <= 1:
+        for i in items:
+            yield func(i)
+        return
+    items = iter(items)
+    window = window or workers * 2
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(executor.submit(func, i)
+                                    for i in itertools.islice(items, window))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for i in itertools.islice(items, 1):
+                    pending.append(executor.submit(func, i))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_accessibility(router, source, all_pts, store, params=None,
+                       workers=1):
+    """Probe the accessibilities of all the points from the source location.
+
+    The points can be any iterable, e.g. `read_points`, and the results are
+    yielded in the same order as soon as they are known, so that memory use
+    does not grow with the number of points. With more than one worker the
+    points are probed concurrently by a thread pool sharing the router. The
+    found routes are saved in the store, see `try_touching`.
+    """
     print("Calculating the accessibilities from the landmark location {0}...".
           format(str(source['geometry']['coordinates'])))
     s = {
-        'id': -1,
+        'id': source.get('id', -1),
         'x': source['geometry']['coordinates'][0],
         'y': source['geometry']['coordinates'][1]
     }
-    pt_acc_list = []
-    for p in all_pts:
-        pt_acc_list.append({
+
+    def touch(p):
+        try:
+            acc = try_touching(router, s, p, store, params)
+        except PROBE_ERRORS as e:
+            return failed_row(p, e)
+        return {
             'id': p['id'],
             'x': p['x'],
             'y': p['y'],
-            'acc': try_touching(router, s, p, output_dir, params)
-            })
+            'acc': acc
+            }
+
+    return map_in_order(touch, all_pts, workers)
+
+
+def iter_accessibility_matrix(router, source, all_pts, params=None,
+                              workers=1):
+    """Probe the accessibilities of all the points with matrix requests.
+
+    The points are sent in batches as large as the matrix API of the router
+    allows, so that one request covers many points. The routes are not
+    saved, but the travel time and distance of the paths are kept. The
+    results are yielded like in `iter_accessibility`.
+    """
+    print("Calculating the accessibilities from the landmark location {0}...".
+          format(str(source['geometry']['coordinates'])))
+    s = tuple(source['geometry']['coordinates'][:2])
+    if router.matrix_max_locations:
+        batch_size = router.matrix_max_locations - 1
+    else:
+        batch_size = 1
+    pts = iter(all_pts)
+    batches = iter(lambda: list(itertools.islice(pts, batch_size)), [])
+
+    def touch(batch):
+        try:
+            res = router.find_paths_matrix(
+                s, [(p['x'], p['y']) for p in batch], params)
+        except PROBE_ERRORS as e:
+            return [failed_row(p, e) for p in batch]
+        return [summary_row(p, r) for p, r in zip(batch, res)]
+
+    for batch in map_in_order(touch, batches, workers):
+        for pt in batch:
+            yield pt
+
+
+def summary_row(target, summary):
+    """Build the result of a point from the summary of the path to it.
+
+    :param dict summary: None for no path found, or the `duration` and the
+        `distance` of the path
+    """
+    return {
+        'id': target['id'],
+        'x': target['x'],
+        'y': target['y'],
+        'acc': 0 if summary is None else 1,
+        'duration': None if summary is None else summary['duration'],
+        'distance': None if summary is None else summary['distance']
+        }
+
+
+def failed_row(target, error):
+    """Build the result of a point whose request failed.
+
+    :param Exception error: one of `PROBE_ERRORS`
+    :return: dict with the `id`, `x` and `y` of the point, the kind of
+        `error`, either `rate_limit`, `transient` or `permanent`, and its
+        `message`
+    """
+    if isinstance(error, errors.RateLimitError):
+        kind = 'rate_limit'
+    elif isinstance(error, errors.TransientError):
+        kind = 'transient'
+    else:
+        kind = 'permanent'
+    return {
+        'id': target['id'],
+        'x': target['x'],
+        'y': target['y'],
+        'error': kind,
+        'message': str(error)
+        }
+
+
+def probe_with_retries(probe, points, dead_letter, rounds=3,
+                       backoff=RETRY_BACKOFF):
+    """Probe the points, and again those which failed for a while.
+
+    The results of the points probed are yielded as they come. The points
+    whose request failed for a transient reason, see `failed_row`, are
+    probed again once all the others are done, up to `rounds` more times,
+    after `backoff` seconds doubled every round. The points still failing
+    and those refused for good are given to `dead_letter` instead of being
+    yielded, so that they are never taken as inaccessible.
+
+    :param probe: function probing the points of an iterable, see
+        `make_probe`
+    :param dead_letter: function called with the `failed_row` of every point
+        given up
+    """
+    failed = []
+    for attempt in range(rounds + 1):
+        if attempt:
+            if not failed:
+                return
+            wait = backoff * 2 ** (attempt - 1)
+            logger.warning("Probe %s failed points again in %s seconds",
+                           len(failed), wait)
+            time.sleep(wait)
+            points = [{'id': f['id'], 'x': f['x'], 'y': f['y']}
+                      for f in failed]
+            failed = []
+        for pt in probe(points):
+            if 'error' not in pt:
+                yield pt
+            elif pt['error'] == 'permanent' or attempt == rounds:
+                dead_letter(pt)
+            else:
+                failed.append(pt)
+
+
+def iter_accessibility_summary(router, source, all_pts, params=None,
+                               workers=1):
+    """Probe the travel times and distances of the paths to all the points.
+
+    Same as `iter_accessibility`, but the router is only asked for the
+    duration and distance of every path, see `find_summary`, and no route
+    is saved. The results are the same as those of
+    `iter_accessibility_matrix`.
+    """
+    print("Calculating the accessibilities from the landmark location {0}...".
+          format(str(source['geometry']['coordinates'])))
+    s = source['geometry']['coordinates']
+
+    def touch(p):
+        try:
+            return summary_row(p, router.find_summary(s[0], s[1], p['x'],
+                                                      p['y'], params))
+        except PROBE_ERRORS as e:
+            return failed_row(p, e)
+
+    return map_in_order(touch, all_pts, workers)
+
+
+async def map_in_order_async(func, items, concurrency=100):
+    """Same as `map_in_order` for a coroutine function, in an event loop.
+
+    Up to `concurrency` items are processed at once, and the results are
+    yielded by an async generator.
+    """
+    items = iter(items)
+    pending = collections.deque(asyncio.ensure_future(func(i))
+                                for i in itertools.islice(items, concurrency))
+    try:
+        while pending:
+            result = await pending.popleft()
+            for i in itertools.islice(items, 1):
+                pending.append(asyncio.ensure_future(func(i)))
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def iter_accessibility_async(router, source, all_pts, store,
+                                   params=None, concurrency=100):
+    """Probe the accessibilities of all the points from an event loop.
+
+    Same as `iter_accessibility`, but the requests are sent with
+    `find_path_raw_async`, up to `concurrency` of them at once, without a
+    thread per request. The results are yielded by an async generator.
+    """
+    print("Calculating the accessibilities from the landmark location {0}...".
+          format(str(source['geometry']['coordinates'])))
+    s = {
+        'id': source.get('id', -1),
+        'x': source['geometry']['coordinates'][0],
+        'y': source['geometry']['coordinates'][1]
+    }
+
+    async def touch(p):
+        try:
+            res = await router.find_path_raw_async(s['x'], s['y'], p['x'],
+                                                   p['y'], params)
+        except PROBE_ERRORS as e:
+            return failed_row(p, e)
+        return {
+            'id': p['id'],
+            'x': p['x'],
+            'y': p['y'],
+            'acc': save_route(store, s, p, res)
+            }
+
+    async for result in map_in_order_async(touch, all_pts, concurrency):
+        yield result
+
+
+async def iter_accessibility_summary_async(router, source, all_pts,
+                                           params=None, concurrency=100):
+    """Same as `iter_accessibility_summary` in an event loop, see
+    `iter_accessibility_async`.
+    """
+    print("Calculating the accessibilities from the landmark location {0}...".
+          format(str(source['geometry']['coordinates'])))
+    s = source['geometry']['coordinates']
+
+    async def touch(p):
+        try:
+            return summary_row(p, await router.find_summary_async(
+                s[0], s[1], p['x'], p['y'], params))
+        except PROBE_ERRORS as e:
+            return failed_row(p, e)
+
+    async for result in map_in_order_async(touch, all_pts, concurrency):
+        yield result
+
+
+def iter_event_loop(router, results):
+    """Iterate over an async generator of results from synchronous code.
+
+    The generator is run in a new event loop, closed together with the async
+    session of the router when the iteration is over.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.run_until_complete(router.close_async())
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+def cal_accessibility(router, source, all_pts, store, params=None,
+                      workers=1, journal=None):
+    """Probe the accessibilities of all the points from the source location.
 
+    Same as `iter_accessibility`, but returns the list of all the results.
+    Every result is also written to the journal as soon as it is known.
+    """
+    pt_acc_list = []
+    for pt in iter_accessibility(router, source, all_pts, store,
+                                 params, workers):
+        if journal is not None:
+            journal.write(pt)
+        pt_acc_list.append(pt)
+    return pt_acc_list
+
+
+def cal_accessibility_matrix(router, source, all_pts, params=None, workers=1,
+                             journal=None):
+    """Probe the accessibilities of all the points with matrix requests.
+
+    Same as `iter_accessibility_matrix`, but returns the list of all the
+    results. Every result is also written to the journal as soon as it is
+    known.
+    """
+    pt_acc_list = []
+    for pt in iter_accessibility_matrix(router, source, all_pts, params,
+                                        workers):
+        if journal is not None:
+            journal.write(pt)
+        pt_acc_list.append(pt)
+    return pt_acc_list
+
+
+async def cal_accessibility_async(router, source, all_pts, store,
+                                  params=None, concurrency=100,
+                                  journal=None):
+    """Probe the accessibilities of all the points from an event loop.
+
+    Same as `iter_accessibility_async`, but returns the list of all the
+    results. Every result is also written to the journal as soon as it is
+    known.
+    """
+    pt_acc_list = []
+    async for pt in iter_accessibility_async(router, source, all_pts, store,
+                                             params, concurrency):
+        if journal is not None:
+            journal.write(pt)
+        pt_acc_list.append(pt)
     return pt_acc_list
 
 
+def iter_accessibility_in_event_loop(router, source, all_pts, store,
+                                     params=None, concurrency=100):
+    """Same as `iter_accessibility_async`, but a plain generator."""
+    return iter_event_loop(router, iter_accessibility_async(
+        router, source, all_pts, store, params, concurrency))
+
+
+def iter_accessibility_summary_in_event_loop(router, source, all_pts,
+                                             params=None, concurrency=100):
+    """Same as `iter_accessibility_summary_async`, but a plain generator."""
+    return iter_event_loop(router, iter_accessibility_summary_async(
+        router, source, all_pts, params, concurrency))
+
+
+def read_landmarks(landmark_file):
+    """Read the landmarks from a GeoJSON file.
+
+    The file is either a Point `Feature` or a `FeatureCollection` of them.
+    The landmarks get their index in the file as `id`, unless they have an
+    integer id already.
+
+    :return: a list of GeoJSON Point features
+    """
+    with open(landmark_file, 'r') as f:
+        data = geojson.load(f)
+    features = data['features'] if data.get('type') == 'FeatureCollection' \
+        else [data]
+    landmarks = []
+    for i, feature in enumerate(features):
+        if (feature.get('geometry') or {}).get('type') != 'Point':
+            raise errors.InvalidFileError(
+                "Landmark {0} of {1} is not a Point".format(i, landmark_file))
+        if not isinstance(feature.get('id'), int):
+            feature['id'] = i
+        landmarks.append(feature)
+    return landmarks
+
+
+def open_route_cache(path, ttl_days=None, max_entries=None):
+    """Open the route cache of a job, None without a path."""
+    if not path:
+        return None
+    logger.info("Open route cache %s", path)
+    return RouteCache(path, ttl=ttl_days and ttl_days * 86400,
+                      max_entries=max_entries)
+
+
+def archive_settings(args):
+    """Get the path and the mode of the archive of the exchanges asked for
+    on the command line, (None, None) without one.
+    """
+    if args['--record']:
+        return args['--record'], RECORD
+    if args['--replay']:
+        return args['--replay'], STRICT if args['--strict'] else REPLAY
+    return None, None
+
+
+def open_archive(path, mode=None):
+    """Open the archive of the exchanges of a job, None without a path."""
+    if not path:
+        return None
+    logger.info("Open archive %s to %s", path, mode)
+    return Archive(path)
+
+
+def print_archive_stats(archive):
+    print("Archive: {hits} responses replayed, {misses} requests not "
+          "recorded, {entries} responses".format(**archive.stats()))
+
+
+def print_quota_usage(name, router):
+    if router.quota is None:
+        return
+    for period, usage in sorted(router.quota.usage().items()):
+        print("Quota of {0} {1}: {used} of {limit} requests used".format(
+            name, period.replace('_', ' '), **usage))
+
+
+def make_router(name, profile, workers=1, route_cache=None, snap=None,
+                share=1.0, archive=None, archive_mode=REPLAY, quota=None,
+                on_quota=STOP):
+    """Create the router of a job.
+
+    :param int snap: decimal places of the deduplicated positions, see
+        `rap.dedup.Deduplicator`, no deduplication if None
+    :param float share: fraction of the rate limit of the router granted to
+        this process
+    :param Archive archive: archive recording or replaying the exchanges
+        of the router in `archive_mode`, see `rap.replay`
+    :param str quota: SQLite database file counting the requests against
+        the `quota` of the router in routerconf.json, see `rap.quota`
+    :param str on_quota: `stop` or `pause` when the quota is used up
+    """
+    router = RoutingServiceFactory(name, profile, pool_size=workers,
+                                   route_cache=route_cache)
+    logger.debug("Router %s instance has been created",
+                 router.__class__.__name__)
+    if share != 1.0:
+        router.limiter = RateLimiter.from_conf(router.rate_limit, share)
+    if snap is not None:
+        router.dedup = Deduplicator(snap)
+    if archive is not None:
+        router.use_archive(archive, archive_mode)
+    if quota:
+        router.quota = QuotaTracker.from_conf(
+            quota, name, load_router_conf().get(name, {}).get('quota'),
+            on_quota)
+        if router.quota is None:
+            logger.warning("No quota of %s in routerconf.json", name)
+    return router
+
+
+def make_probe(router, landmark, store, params=None, workers=1,
+               mode='routes', use_async=False, dead_letter=None, retries=0):
+    """Choose how the points are probed from the landmark.
+
+    :param str mode: `routes` to save the found routes in the store,
+        `summary` for the travel times and distances from the directions
+        API, or `matrix` for those from the matrix API
+    :param bool use_async: send the requests from an event loop, with up to
+        `workers` of them in flight
+    :param dead_letter: function called with the points given up after
+        `retries` more rounds, see `probe_with_retries`, otherwise the
+        results of the failed points are yielded too, see `failed_row`
+    :return: a function probing the points of an iterable, yielding their
+        results in order
+    """
+    probe = _make_probe(router, landmark, store, params, workers, mode,
+                        use_async)
+    if dead_letter is None:
+        return probe
+    return functools.partial(probe_with_retries, probe,
+                             dead_letter=dead_letter, rounds=retries)
+
+
+def _make_probe(router, landmark, store, params, workers, mode, use_async):
+    if use_async:
+        router.max_in_flight = workers
+    if mode == 'matrix':
+        return functools.partial(iter_accessibility_matrix, router,
+                                 landmark, params=params, workers=workers)
+    if mode == 'summary':
+        if use_async:
+            return functools.partial(
+                iter_accessibility_summary_in_event_loop, router, landmark,
+                params=params, concurrency=workers)
+        return functools.partial(iter_accessibility_summary, router,
+                                 landmark, params=params, workers=workers)
+    if use_async:
+        return functools.partial(iter_accessibility_in_event_loop, router,
+                                 landmark, store=store, params=params,
+                                 concurrency=workers)
+    return functools.partial(iter_accessibility, router, landmark,
+                             store=store, params=params, workers=workers)
+
+
+def make_shards(landmarks, points, shard_size):
+    """Split the probing of all the points from all the landmarks.
+
+    Every shard covers the points of a range of at most `shard_size` of
+    them, in their order, from one landmark.
+
+    :return: a list of dicts with the `name`, the `landmark` and the
+        `points` of every shard
+    """
+    shards = []
+    for landmark in landmarks:
+        for i in range(0, len(points), shard_size):
+            chunk = points[i:i + shard_size]
+            shards.append({
+                'name': '{0}_{1}-{2}'.format(landmark['id'], chunk[0]['id'],
+                                             chunk[-1]['id']),
+                'landmark': landmark,
+                'points': chunk
+            })
+    return shards
+
+
+def probe_shard(job, shard):
+    """Probe the points of a shard from its landmark, in a worker process.
+
+    The router is created by the process. The results are written to the
+    csv file SHARD.csv in the `shards_dir` of the job, and the routes of a
+    sqlite store to SHARD.db next to it. A shard started before is resumed
+    with `resume`.
+
+    :param dict job: the settings of the run shared by all the shards
+    :param dict shard: a shard made by `make_shards`
+    :return: the numbers of points probed and of accessible ones
+    """
+    route_cache = open_route_cache(job['cache'], job['cache_ttl'],
+                                   job['cache_size'])
+    archive = open_archive(job['archive'], job['archive_mode'])
+    router = make_router(job['router'], job['profile'], job['workers'],
+                         route_cache, job['snap'], job['share'], archive,
+                         job['archive_mode'], job['quota'], job['on_quota'])
+    store = None
+    if job['mode'] == 'routes':
+        if job['store'] == 'sqlite':
+            store = SQLiteStore(os.path.join(job['shards_dir'],
+                                             shard['name'] + '.db'))
+        else:
+            store = DirectoryStore(job['routes_dir'])
+    dead_letters = open_dead_letters(os.path.join(
+        job['shards_dir'], shard['name'] + '-failed.csv'))
+    probe = make_probe(router, shard['landmark'], store, job['params'],
+                       job['workers'], job['mode'], job['async'],
+                       dead_letters.write, job['retries'])
+    probed = accessible = 0
+    try:
+        with ResultJournal(os.path.join(job['shards_dir'],
+                                        shard['name'] + '.csv'),
+                           job['fieldnames'],
+                           resume=job['resume']) as journal:
+            points = [p for p in shard['points'] if p['id'] not in
+                      journal.done]
+            for pt in probe(points):
+                journal.write(pt)
+                probed += 1
+                accessible += pt['acc']
+    finally:
+        close_dead_letters(dead_letters, report=False)
+        if store is not None:
+            store.close()
+        if route_cache is not None:
+            route_cache.close()
+        if archive is not None:
+            archive.close()
+        if router.quota is not None:
+            router.quota.close()
+    return probed, accessible
+
+
+def merge_shards(shards, shards_dir, results_file, fieldnames, suffix=''):
+    """Concatenate the results of the shards into one csv file.
+
+    A `landmark` column with the id of the landmark is added, the rows are
+    in the order of the shards.
+
+    :param str suffix: suffix of the names of the csv files of the shards,
+        e.g. `-failed` for the points given up
+    :return: the number of rows
+    """
+    logger.info("Merge the results of %s shards into %s", len(shards),
+                results_file)
+    rows = 0
+    with open(results_file, 'w', newline='') as out:
+        writer = csv.DictWriter(out, ['landmark'] + list(fieldnames))
+        writer.writeheader()
+        for shard in shards:
+            path = os.path.join(shards_dir, shard['name'] + suffix + '.csv')
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    row['landmark'] = shard['landmark']['id']
+                    writer.writerow(row)
+                    rows += 1
+    return rows
+
+
+def probe_sharded(args, landmarks, points, params, mode, fieldnames,
+                  routes_dir):
+    """Probe all the points from all the landmarks on a process pool.
+
+    The shards made by `make_shards` are run by `probe_shard` in
+    `--processes` worker processes, which share the rate limit of the
+    router, and their results are merged into OUTPUT_DIR/ROUTER.csv. The
+    intermediate results are kept in OUTPUT_DIR/shards/ROUTER.
+    """
+    processes = args['--processes']
+    shards_dir = os.path.join(args['-o'], 'shards', args['-r'])
+    os.makedirs(shards_dir, exist_ok=True)
+    job = {
+        'router': args['-r'],
+        'profile': args['-p'],
+        'params': params,
+        'workers': args['--workers'],
+        'mode': mode,
+        'async': args['--async'],
+        'store': args['--store'],
+        'routes_dir': routes_dir,
+        'shards_dir': shards_dir,
+        'fieldnames': fieldnames,
+        'cache': args['--cache'],
+        'cache_ttl': args['--cache-ttl'],
+        'cache_size': args['--cache-size'],
+        'snap': args['--snap'],
+        'share': 1.0 / processes,
+        'archive': archive_settings(args)[0],
+        'archive_mode': archive_settings(args)[1],
+        'quota': args['--quota'],
+        'on_quota': args['--on-quota'],
+        'retries': args['--retries'],
+        'resume': args['--resume']
+    }
+    shards = make_shards(landmarks, points, args['--shard-size'])
+    print("Probing {0} points from {1} landmarks in {2} shards with {3} "
+          "processes...".format(len(points), len(landmarks), len(shards),
+                                processes))
+    probed = accessible = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(probe_shard, job, shard)
+                   for shard in shards]
+        for done, future in enumerate(futures, 1):
+            n, acc = future.result()
+            probed += n
+            accessible += acc
+            logger.info("Shard %s of %s done", done, len(shards))
+    print("{0} points probed, {1} accessible".format(probed, accessible))
+    merge_shards(shards, shards_dir,
+                 os.path.join(args['-o'], '{0}.csv'.format(args['-r'])),
+                 fieldnames)
+    failed_file = os.path.join(args['-o'],
+                               '{0}-failed.csv'.format(args['-r']))
+    failed = merge_shards(shards, shards_dir, failed_file, FAILED_FIELDNAMES,
+                          '-failed')
+    if failed:
+        print("{0} points failed and are left out of the results, see "
+              "{1}".format(failed, failed_file))
+    else:
+        os.remove(failed_file)
+    if mode == 'routes' and args['--store'] == 'sqlite':
+        store = SQLiteStore(os.path.join(routes_dir, 'routes.db'))
+        try:
+            for shard in shards:
+                path = os.path.join(shards_dir, shard['name'] + '.db')
+                if os.path.isfile(path):
+                    store.merge(path)
+        finally:
+            store.close()
+
+
+def join_results(names, results_dir, joined_file, points, fieldnames):
+    """Join the results of several routers into one csv file.
+
+    The results of every router are read from ROUTER.csv in `results_dir`.
+    The joined rows have the `id`, `x` and `y` of the points, in their
+    order, followed by the other fields of every router prefixed by its
+    name, e.g. `mapbox_acc`, left empty for the points it did not probe.
+    """
+    logger.info("Join the results of %s into %s", ', '.join(names),
+                joined_file)
+    fields = [f for f in fieldnames if f not in ('id', 'x', 'y')]
+    tables = []
+    for name in names:
+        with open(os.path.join(results_dir, '{0}.csv'.format(name)), 'r',
+                  newline='') as f:
+            tables.append({row['id']: row for row in csv.DictReader(f)})
+    columns = ['id', 'x', 'y'] + ['{0}_{1}'.format(name, field)
+                                  for name in names for field in fields]
+    with open(joined_file, 'w', newline='') as out:
+        writer = csv.DictWriter(out, columns)
+        writer.writeheader()
+        for p in points:
+            row = {'id': p['id'], 'x': p['x'], 'y': p['y']}
+            for name, table in zip(names, tables):
+                result = table.get(str(p['id']), {})
+                for field in fields:
+                    row['{0}_{1}'.format(name, field)] = result.get(field, '')
+            writer.writerow(row)
+
+
+def compare_routers(args, names, workers, landmark, points, params, mode,
+                    fieldnames):
+    """Probe the points with several routers at the same time.
+
+    Every router probes all the points in a thread of its own, with its own
+    `workers`, connection pool and rate limit, and writes its results to
+    OUTPUT_DIR/ROUTER.csv as it goes, so that a slow router does not hold
+    up the others. The results are then joined by `join_results`.
+
+    :return: the routers
+    """
+    route_cache = open_route_cache(args['--cache'], args['--cache-ttl'],
+                                   args['--cache-size'])
+    archive_path, archive_mode = archive_settings(args)
+    archive = open_archive(archive_path, archive_mode)
+    routers = [make_router(name, args['-p'], n, route_cache, args['--snap'],
+                           archive=archive, archive_mode=archive_mode,
+                           quota=args['--quota'], on_quota=args['--on-quota'])
+               for name, n in zip(names, workers)]
+    today = datetime.date.today().isoformat()
+
+    def run(name, router, n):
+        store = None
+        if mode == 'routes':
+            store = open_store(args['--store'], os.path.join(
+                args['-o'], name, args['-p'], today))
+        dead_letters = open_dead_letters(
+            os.path.join(args['-o'], '{0}-failed.csv'.format(name)))
+        probe = make_probe(router, landmark, store, params, n, mode,
+                           args['--async'], dead_letters.write,
+                           args['--retries'])
+        try:
+            with ResultJournal(
+                    os.path.join(args['-o'], '{0}.csv'.format(name)),
+                    fieldnames, resume=args['--resume']) as journal:
+                for pt in probe(p for p in points
+                                if p['id'] not in journal.done):
+                    journal.write(pt)
+        finally:
+            close_dead_letters(dead_letters)
+            if store is not None:
+                store.close()
+        logger.info("Router %s is done", name)
+
+    print("Probing {0} points with {1}...".format(len(points),
+                                                   ', '.join(names)))
+    try:
+        with ThreadPoolExecutor(max_workers=len(routers)) as executor:
+            futures = [executor.submit(run, name, router, n)
+                       for name, router, n in zip(names, routers, workers)]
+            for future in futures:
+                future.result()
+    finally:
+        if args['--metrics']:
+            for router in routers:
+                print(router.metrics.summary())
+            export_metrics([router.metrics for router in routers],
+                           args['--metrics'])
+        if route_cache is not None:
+            print("Route cache: {hits} hits, {misses} misses, {entries} "
+                  "paths".format(**route_cache.stats()))
+            route_cache.close()
+        if archive is not None:
+            print_archive_stats(archive)
+            archive.close()
+        for name, router in zip(names, routers):
+            print_quota_usage(name, router)
+    join_results(names, args['-o'],
+                 os.path.join(args['-o'], '{0}.csv'.format('-'.join(names))),
+                 points, fieldnames)
+    return routers
+
+
+def enqueue_job(args, names, landmarks, points, params, mode):
+    """Add the tasks of the job to the work queue QUEUE_DB."""
+    if len(names) > 1:
+        exit("A work queue is probed by a single router")
+    if args['--adaptive']:
+        exit("Adaptive probing cannot be queued")
+    queue = WorkQueue(args['QUEUE_DB'], args['--lease'], args['--attempts'])
+    try:
+        settings = {
+            'router': args['-r'],
+            'profile': args['-p'],
+            'mode': mode,
+            'params': params
+        }
+        try:
+            added = queue.enqueue(settings, landmarks, points)
+        except errors.InvalidParameterError as e:
+            exit(e)
+        print("{0} tasks queued, {pending} pending, {leased} leased, {done} "
+              "done, {dead} dead".format(added, **queue.progress()))
+    finally:
+        queue.close()
+
+
+def run_worker(args, queue, poll_seconds=10):
+    """Probe the tasks claimed from a work queue until all are done.
+
+    The routes are saved in OUTPUT_DIR of the worker. When the other
+    workers hold all the tasks left, the worker polls the queue every
+    `poll_seconds` to take over the tasks of the workers which died.
+
+    :return: the router
+    """
+    settings = queue.settings()
+    landmarks = queue.landmarks()
+    worker = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+    route_cache = open_route_cache(args['--cache'], args['--cache-ttl'],
+                                   args['--cache-size'])
+    archive_path, archive_mode = archive_settings(args)
+    archive = open_archive(archive_path, archive_mode)
+    router = make_router(settings['router'], settings['profile'],
+                         args['--workers'], route_cache, args['--snap'],
+                         archive=archive, archive_mode=archive_mode,
+                         quota=args['--quota'], on_quota=args['--on-quota'])
+    store = None
+    if settings['mode'] == 'routes':
+        store = open_store(args['--store'], os.path.join(
+            args['-o'], settings['router'], settings['profile'],
+            datetime.date.today().isoformat()))
+    logger.info("Worker %s starts on %s", worker, queue.path)
+    probed = 0
+    try:
+        while True:
+            tasks = queue.claim(worker, args['--batch'])
+            if not tasks:
+                if not queue.progress()[LEASED]:
+                    break
+                time.sleep(min(poll_seconds, queue.lease_seconds))
+                continue
+            try:
+                for landmark, group in itertools.groupby(
+                        tasks, key=lambda t: t[0]):
+                    # The points given up are done too, collected apart
+                    failed = []
+                    probe = make_probe(router, landmarks[landmark], store,
+                                       settings['params'], args['--workers'],
+                                       settings['mode'], args['--async'],
+                                       failed.append, args['--retries'])
+                    results = list(probe([p for _, p in group]))
+                    queue.complete(worker, landmark, results + failed)
+                    probed += len(results)
+            except BaseException:
+                queue.release(worker, tasks)
+                raise
+            logger.info("%s points probed by %s", probed, worker)
+    finally:
+        if store is not None:
+            store.close()
+        if route_cache is not None:
+            route_cache.close()
+        if archive is not None:
+            print_archive_stats(archive)
+            archive.close()
+        print_quota_usage(settings['router'], router)
+        if args['--metrics']:
+            print(router.metrics.summary())
+            router.metrics.export(args['--metrics'])
+    print("{0} points probed by {1}".format(probed, worker))
+    return router
+
+
+def collect_results(queue, output_dir):
+    """Write the results reported to a work queue so far.
+
+    The results are written to OUTPUT_DIR/ROUTER.csv in the order of the
+    landmarks and of the points, with a `landmark` column if there are
+    several of them, and the points given up to OUTPUT_DIR/ROUTER-failed.csv,
+    which is left out if there are none.
+    """
+    settings = queue.settings()
+    fieldnames = ACC_FIELDNAMES if settings['mode'] == 'routes' \
+        else MATRIX_FIELDNAMES
+    failed_fieldnames = FAILED_FIELDNAMES
+    if len(queue.landmarks()) > 1:
+        fieldnames = ['landmark'] + fieldnames
+        failed_fieldnames = ['landmark'] + failed_fieldnames
+    results_file = os.path.join(output_dir,
+                                '{0}.csv'.format(settings['router']))
+    failed_file = os.path.join(output_dir,
+                               '{0}-failed.csv'.format(settings['router']))
+    logger.info("Collect the results of %s into %s", queue.path,
+                results_file)
+    failed = 0
+    with open(results_file, 'w', newline='') as out, \
+            open(failed_file, 'w', newline='') as failed_out:
+        writer = csv.DictWriter(out, fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        failed_writer = csv.DictWriter(failed_out, failed_fieldnames,
+                                       extrasaction='ignore')
+        failed_writer.writeheader()
+        for landmark, result in queue.results():
+            result['landmark'] = landmark
+            if 'error' in result:
+                failed_writer.writerow(result)
+                failed += 1
+            else:
+                writer.writerow(result)
+    if not failed:
+        os.remove(failed_file)
+    print("{done} tasks done, {pending} pending, {leased} leased, {dead} "
+          "dead".format(**queue.progress()))
+
+
 def main():
     """Entrypoint of command line interface.
     """
+    try:
+        run()
+    except errors.QuotaExceededError as e:
+        exit("{0}. The results so far are kept, run again with --resume "
+             "once the quota is reset".format(e))
+    except errors.InvalidFileError as e:
+        exit(e)
+    except errors.NotRecordedError as e:
+        exit("Cannot replay the job, {0}. The results so far are kept, "
+             "record the missing requests with --replay and run again "
+             "with --resume".format(e))
+
+
+def run():
+    """Run the job of the command line arguments."""
     args = docopt(__doc__, version=__version__)
     if args['--verbose']:
         logging.getLogger().setLevel(logging.DEBUG)
@@ -174,35 +1449,75 @@ def main():
         logger.info("Project page: http://github.com/tumluliu/rap")
         logger.info("Contact: Lu Liu via nudtlliu@gmail.com")
         logger.info("Start working...")
-        logger.debug("Arguments for rapy: {0}".format(str(args)))
+        logger.debug("Arguments for rapy: %s", args)
     else:
         logging.getLogger().setLevel(logging.WARNING)
     with open('appconf.json', 'r') as f:
         appconf = json.load(f)
     args = validate_arguments(args, appconf)
-    logger.debug("Arguments after validation: {0}".format(args))
-    router = RoutingServiceFactory(args['-r'], args['-p'])
-    logger.debug("Router {0} instance has been created".format(
-        router.__class__.__name__))
-    stub_pts = []
-    logger.info("Open input data file with stub points")
-    with open(args['-t'], 'r') as f:
-        logger.debug("Data file {0} has been opened for reading".format(args[
-            '-t']))
-        pf = csv.DictReader(f)
-        for r in pf:
-            logger.debug("Current row in the points info file: {0}".format(
-                str(r)))
-            stub_pts.append({
-                'x': float(r['x']),
-                'y': float(r['y']),
-                'id': int(r['id'])
-            })
+    logger.debug("Arguments after validation: %s", args)
+    names = args['-r'].split(',') if args['-r'] else []
+    workers = args['--workers']
+    if len(workers) == 1:
+        workers = workers * max(len(names), 1)
+    elif len(workers) != len(names):
+        exit("Give one WORKERS for all the routers or one for each of them")
+    args['--workers'] = workers[0]
+    for name in names:
+        try:
+            get_router_class(name)
+        except errors.InvalidParameterError as e:
+            exit(e)
+    if args['worker'] or args['collect'] or args['requeue']:
+        if not os.path.isfile(args['QUEUE_DB']):
+            exit("Work queue {0} does not exist".format(args['QUEUE_DB']))
+        queue = WorkQueue(args['QUEUE_DB'], args['--lease'],
+                          args['--attempts'])
+        try:
+            if queue.settings() is None:
+                exit("Nothing is queued in {0}".format(args['QUEUE_DB']))
+            if args['worker']:
+                run_worker(args, queue)
+            elif args['requeue']:
+                print("{0} dead tasks queued again, {pending} pending, "
+                      "{leased} leased, {done} done, {dead} dead".format(
+                          queue.requeue_dead(), **queue.progress()))
+            else:
+                collect_results(queue, args['-o'])
+        finally:
+            queue.close()
+        logger.info("All done!")
+        return
+    if args['--adaptive'] and not args['--testbed']:
+        exit("Adaptive probing needs a TESTBED to refine the grid of")
+    if args['--adaptive'] and args['--resume']:
+        exit("Adaptive probing cannot be resumed")
+    if args['--async'] and args['--acc-only']:
+        exit("The matrix requests of --acc-only are not sent asynchronously")
+    if args['--summary'] and args['--acc-only']:
+        exit("Either the matrix API with --acc-only or the directions API "
+             "with --summary can be used")
+    if args['--snap'] is not None and args['--acc-only']:
+        exit("The matrix requests of --acc-only are not deduplicated")
+    if args['--record'] and args['--replay']:
+        exit("Either record the requests or replay them")
+    if args['--strict'] and not args['--replay']:
+        exit("Only the replayed requests can be strict")
+    if args['--adaptive'] and args['--order'] != 'file':
+        exit("Adaptive probing follows the grid")
+    if args['-t']:
+        logger.info("Open input data file with stub points")
+        stub_pts = read_points(args['-t'])
+    else:
+        testbed = args['--testbed']
+        logger.info("Generate stub points for %s", testbed['location'])
+        mask = load_mask(args['--mask']) if args['--mask'] else None
+        spacing = args['--spacing'] or testbed['stubspacing']
+        stub_pts = grid_points(testbed['bbox'], spacing, mask)
+    stub_pts = order_points(stub_pts, args['--order'])
 
-    landmark = {}
     logger.info("Open landmark geojson file.")
-    with open(args['-f'], 'r') as f:
-        landmark = geojson.load(f)
+    landmarks = read_landmarks(args['-f'])
 
     logger.info("Load extra parameter file for the current router")
     if args['-x'] is None:
@@ -211,20 +1526,100 @@ def main():
         with open(args['-x']) as f:
             params = json.load(f)
 
+    if args['--acc-only']:
+        mode = 'matrix'
+    elif args['--summary']:
+        mode = 'summary'
+    else:
+        mode = 'routes'
+    fieldnames = ACC_FIELDNAMES if mode == 'routes' else MATRIX_FIELDNAMES
+    # The found routes will be stored in a directory like
+    # /OUTPUT_DIR_ROOT/ROUTER/PROFILE/YYYY-MM-DD/
+    routes_dir = os.path.join(args['-o'], args['-r'], args['-p'],
+                              datetime.date.today().isoformat())
+    if args['queue']:
+        enqueue_job(args, names, landmarks, stub_pts, params, mode)
+        return
+    if len(names) > 1:
+        if len(landmarks) > 1 or args['--processes'] > 1:
+            exit("Several routers are compared from a single landmark and "
+                 "process")
+        if args['--adaptive']:
+            exit("Adaptive probing needs a single router")
+        routers = compare_routers(args, names, workers, landmarks[0],
+                                  list(stub_pts), params, mode, fieldnames)
+        for name, router in zip(names, routers):
+            if router.dedup is not None:
+                print("Deduplicated requests of {name}: {hits} answered "
+                      "again, {coalesced} coalesced, {misses} sent".format(
+                          name=name, **router.dedup.stats()))
+        logger.info("All done!")
+        return
+    if len(landmarks) > 1 or args['--processes'] > 1:
+        if args['--adaptive']:
+            exit("Adaptive probing needs a single landmark and process")
+        if args['--metrics']:
+            exit("The request metrics are only kept by a single process")
+        probe_sharded(args, landmarks, list(stub_pts), params, mode,
+                      fieldnames, routes_dir)
+        logger.info("All done!")
+        return
+    landmark = landmarks[0]
+    route_cache = open_route_cache(args['--cache'], args['--cache-ttl'],
+                                   args['--cache-size'])
+    archive_path, archive_mode = archive_settings(args)
+    archive = open_archive(archive_path, archive_mode)
+    router = make_router(args['-r'], args['-p'], args['--workers'],
+                         route_cache, args['--snap'], archive=archive,
+                         archive_mode=archive_mode, quota=args['--quota'],
+                         on_quota=args['--on-quota'])
+
     logger.info(
         "Calculate accessibilities for all the stub points from the landmark")
-    points_with_accessibility = cal_accessibility(
-        router, landmark, stub_pts,
-        os.path.join(args['-o'], args['-r'], args['-p'],
-                     datetime.date.today().isoformat()), params)
-    logger.debug("And we get the points with accessibilities: {0}".format(
-        str(points_with_accessibility)))
-
-    with open(os.path.join(args['-o'], '{0}.csv'.format(args['-r'])),
-              'w') as f:
-        fieldnames = points_with_accessibility[0].keys()
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(points_with_accessibility)
+    with ResultJournal(
+            os.path.join(args['-o'], '{0}.csv'.format(args['-r'])),
+            fieldnames, resume=args['--resume']) as journal:
+        if journal.done:
+            print("Resuming with {0} points done".format(len(journal.done)))
+            stub_pts = (p for p in stub_pts if p['id'] not in journal.done)
+        store = None
+        if mode == 'routes':
+            store = open_store(args['--store'], routes_dir)
+        dead_letters = open_dead_letters(os.path.join(
+            args['-o'], '{0}-failed.csv'.format(args['-r'])))
+        probe = make_probe(router, landmark, store, params,
+                           args['--workers'], mode, args['--async'],
+                           dead_letters.write, args['--retries'])
+        if args['--adaptive']:
+            points_with_accessibility = iter_adaptive(
+                probe, testbed['bbox'], args['--adaptive'], spacing,
+                args['--threshold'], mask)
+        else:
+            points_with_accessibility = probe(stub_pts)
+        # Stream the results to the csv file as they come
+        try:
+            for pt in points_with_accessibility:
+                journal.write(pt)
+        finally:
+            close_dead_letters(dead_letters)
+            if store is not None:
+                store.close()
+            print_quota_usage(args['-r'], router)
+            if args['--metrics']:
+                print(router.metrics.summary())
+                router.metrics.export(args['--metrics'])
+
+    if router.dedup is not None:
+        print("Deduplicated requests: {hits} answered again, {coalesced} "
+              "coalesced, {misses} sent".format(**router.dedup.stats()))
+
+    if route_cache is not None:
+        print("Route cache: {hits} hits, {misses} misses, {entries} paths".
+              format(**route_cache.stats()))
+        route_cache.close()
+
+    if archive is not None:
+        print_archive_stats(archive)
+        archive.close()
 
     logger.info("All done!")
@@ -0,0 +1,269 @@
+"""Token bucket rate limiter and circuit breaker shared by the requests of a
+routing service
+"""
+
+import asyncio
+import collections
+import email.utils
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Length in seconds of the supported rate limit windows
+WINDOWS = {
+    'per_second': 1.0,
+    'per_minute': 60.0,
+    'per_hour': 3600.0,
+    'per_day': 86400.0
+}
+
+
+def retry_after_seconds(headers):
+    """Get the number of seconds to wait from the headers of a response.
+
+    Both the delay-seconds and the HTTP-date forms of the `Retry-After`
+    header are supported, as well as the `X-Rate-Limit-Reset` header with
+    a UNIX timestamp used by Mapbox.
+
+    :param headers: the headers of an HTTP response
+    :return: seconds to wait, or None if the server does not tell
+    """
+    value = headers.get('Retry-After')
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    value = headers.get('X-Rate-Limit-Reset')
+    if value is not None:
+        try:
+            return max(0.0, float(value) - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+class TokenBucket(object):
+    """Token bucket granting `rate` tokens every `per` seconds.
+
+    Up to `capacity` tokens can be saved up for bursts, by default the
+    allowance of a whole window.
+    """
+
+    def __init__(self, rate, per=1.0, capacity=None):
+        self.rate = float(rate) / per
+        self.capacity = float(capacity) if capacity else max(1.0, float(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now, factor=1.0):
+        """Add the tokens granted since the last refill."""
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity,
+                          self.tokens + elapsed * self.rate * factor)
+        self.updated = now
+
+    def take(self, tokens, factor=1.0):
+        """Take tokens, possibly going into debt.
+
+        :return: seconds to wait until the debt is paid off
+        """
+        self.tokens -= tokens
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / (self.rate * factor)
+
+
+class RateLimiter(object):
+    """Thread- and asyncio-safe rate limiter made of several token buckets.
+
+    A request has to wait for a token from every bucket, so a per-second
+    burst limit and a daily allowance can be combined. The refill rate
+    is scaled down by half whenever the provider rejects a request for
+    exceeding its rate limit (HTTP 429), and grows back additively with
+    every accepted request until the configured rate is reached again.
+    """
+
+    # Pause after a rejection without Retry-After, doubled for every
+    # consecutive rejection up to max_pause
+    first_pause = 0.5
+    max_pause = 60.0
+
+    def __init__(self, buckets=None, min_factor=1.0 / 64, increase=0.02):
+        self.buckets = list(buckets or [])
+        self.factor = 1.0
+        self.min_factor = min_factor
+        self.increase = increase
+        self.blocked_until = 0.0
+        self.rejections = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, rate_limit, share=1.0):
+        """Create a rate limiter from the configuration of a router.
+
+        :param rate_limit: either the maximum number of requests per second,
+            no limit if it is not positive, or a dict with any of the
+            `per_second`, `per_minute`, `per_hour` and `per_day` limits and
+            an optional `burst` capacity for the shortest window
+        :param float share: fraction of the limits granted to this limiter,
+            when several processes send requests to the same provider
+        """
+        if not rate_limit:
+            return cls()
+        if not isinstance(rate_limit, dict):
+            if rate_limit <= 0:
+                return cls()
+            return cls([TokenBucket(rate_limit * share, capacity=1)])
+        windows = sorted((per, rate_limit[name] * share)
+                         for name, per in WINDOWS.items()
+                         if rate_limit.get(name, -1) > 0)
+        burst = rate_limit.get('burst')
+        buckets = [TokenBucket(rate, per, burst if i == 0 else None)
+                   for i, (per, rate) in enumerate(windows)]
+        return cls(buckets)
+
+    def reserve(self, tokens=1):
+        """Reserve tokens for a request without blocking.
+
+        :return: seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            for b in self.buckets:
+                b.refill(now, self.factor)
+                wait = max(wait, b.take(tokens, self.factor))
+        return wait
+
+    def acquire(self, tokens=1):
+        """Block the current thread until the request is allowed.
+
+        :return: seconds waited
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens=1):
+        """Suspend the current coroutine until the request is allowed.
+
+        :return: seconds waited
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def backoff(self, retry_after=None):
+        """Slow down after the provider rejected a request.
+
+        :param float retry_after: seconds to pause all the requests for, as
+            told by the provider, otherwise an exponential backoff is used
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.factor = max(self.min_factor, self.factor / 2)
+            self.rejections += 1
+            for b in self.buckets:
+                b.refill(now, self.factor)
+                b.tokens = min(b.tokens, 0.0)
+            if retry_after is None:
+                retry_after = min(self.max_pause, self.first_pause *
+                                  2 ** (self.rejections - 1))
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            LOGGER.info("Rate limited, scale the request rate down to %s",
+                        self.factor)
+
+    def recover(self):
+        """Speed up again after a request has been accepted."""
+        if self.factor >= 1.0 and not self.rejections:
+            return
+        with self._lock:
+            self.rejections = 0
+            self.factor = min(1.0, self.factor + self.increase)
+
+
+class CircuitBreaker(object):
+    """Thread- and asyncio-safe pause of all the requests to a provider
+    failing too often.
+
+    The outcomes of the last `window` requests are kept. When more than
+    `threshold` of them failed with a server error or without a response,
+    the breaker opens and no request is sent for `cooldown` seconds, doubled
+    for every consecutive opening up to `max_cooldown`. The requests sent
+    after the pause are counted anew.
+    """
+
+    def __init__(self, threshold=0.5, window=50, cooldown=30.0,
+                 max_cooldown=600.0):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.outcomes = collections.deque(maxlen=window)
+        self.open_until = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_conf(cls, conf=None):
+        """Create a circuit breaker from the configuration of a router.
+
+        :param conf: None for the defaults, False for no circuit breaker, or
+            a dict with any of the `threshold`, `window`, `cooldown` and
+            `max_cooldown` arguments
+        """
+        if conf is False:
+            return None
+        return cls(**(conf or {}))
+
+    def record(self, failed):
+        """Count the outcome of a request, and open the breaker if too many
+        requests failed.
+        """
+        with self._lock:
+            self.outcomes.append(bool(failed))
+            if len(self.outcomes) < self.window:
+                return
+            if sum(self.outcomes) <= self.threshold * self.window:
+                self.trips = 0
+                return
+            pause = min(self.max_cooldown, self.cooldown * 2 ** self.trips)
+            self.trips += 1
+            self.outcomes.clear()
+            self.open_until = max(self.open_until, time.monotonic() + pause)
+        LOGGER.warning("Too many requests failed, pause all of them for %s "
+                       "seconds", pause)
+
+    def wait_time(self):
+        """Get the seconds left before the requests can be sent again."""
+        return max(0.0, self.open_until - time.monotonic())
+
+    def wait(self):
+        """Block the current thread while the breaker is open.
+
+        :return: seconds waited
+        """
+        wait = self.wait_time()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def wait_async(self):
+        """Suspend the current coroutine while the breaker is open.
+
+        :return: seconds waited
+        """
+        wait = self.wait_time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
@@ -0,0 +1,208 @@
+"""Archive of the HTTP exchanges with the routing services, for replaying
+them instead of sending the requests again
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import requests
+from requests.adapters import BaseAdapter
+from . import errors
+from .cache import IGNORED_PARAMS
+
+LOGGER = logging.getLogger(__name__)
+
+# Send all the requests and record their responses
+RECORD = 'record'
+# Answer the recorded requests, send and record the others
+REPLAY = 'replay'
+# Only answer the recorded requests, fail on the others
+STRICT = 'strict'
+MODES = (RECORD, REPLAY, STRICT)
+
+
+def request_key(method, url, body=None):
+    """Build the key of a request in an archive.
+
+    The query parameters are sorted and the API keys and the host left
+    out, so that a job recorded with one key, or against a mirror of the
+    service, can be replayed with another.
+
+    :param str method: HTTP method
+    :param str url: full URL of the request, with its query string
+    :param body: bytes or str of the request body, if any
+    :return: a hex digest
+    """
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query,
+                                                keep_blank_values=True)
+                   if k not in IGNORED_PARAMS)
+    normalized = urlunsplit(('', '', parts.path, urlencode(query), ''))
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    digest = hashlib.sha1(method.upper().encode('utf-8') + b' ' +
+                          normalized.encode('utf-8'))
+    if body:
+        digest.update(b'\n' + body)
+    return digest.hexdigest()
+
+
+def not_recorded(method, url, path):
+    """Build the error of a request missing from an archive in STRICT mode.
+
+    The API keys are left out of the URL in the message.
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query,
+                                          keep_blank_values=True)
+             if k not in IGNORED_PARAMS]
+    return errors.NotRecordedError("{0} {1} is not recorded in {2}".format(
+        method, urlunsplit(parts._replace(query=urlencode(query))), path))
+
+
+class Archive(object):
+    """Responses of the routing services kept in a SQLite database.
+
+    The responses are indexed by `request_key` and their bodies compressed
+    with zlib. The server errors and the responses rejected by the rate
+    limit (HTTP 429) are not worth replaying and are never recorded.
+    """
+
+    def __init__(self, path):
+        """Opens or creates an archive.
+
+        :param str path: path of the SQLite database file
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS exchanges ("
+                           "key TEXT PRIMARY KEY, method TEXT NOT NULL, "
+                           "url TEXT NOT NULL, status INTEGER NOT NULL, "
+                           "headers TEXT NOT NULL, content BLOB NOT NULL, "
+                           "recorded REAL NOT NULL)")
+
+    @staticmethod
+    def worth_recording(status):
+        return status != 429 and status < 500
+
+    def get(self, method, url, body=None):
+        """Look up the response to a request.
+
+        :return: (status, headers, content) of the recorded response, or
+            None if the request was not recorded
+        """
+        key = request_key(method, url, body)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, headers, content FROM exchanges "
+                "WHERE key = ?", (key, )).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0], json.loads(row[1]), zlib.decompress(row[2])
+
+    def contains(self, method, url, body=None):
+        """Tell whether the response to a request is recorded."""
+        key = request_key(method, url, body)
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM exchanges WHERE key = ?",
+                (key, )).fetchone() is not None
+
+    def put(self, method, url, body, status, headers, content):
+        """Record the response to a request.
+
+        :param dict headers: headers of the response
+        :param bytes content: decoded body of the response
+        """
+        if not self.worth_recording(status):
+            return
+        key = request_key(method, url, body)
+        # The content is stored decoded, it must not be decoded again
+        headers = {k: v for k, v in headers.items()
+                   if k.lower() not in ('content-encoding', 'content-length',
+                                        'transfer-encoding')}
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO exchanges VALUES (?, ?, ?, ?, ?, ?, "
+                "?)", (key, method.upper(), url, status, json.dumps(headers),
+                       zlib.compress(content), time.time()))
+
+    def stats(self):
+        """Get the numbers of responses replayed, of requests not recorded,
+        and of responses in the archive.
+        """
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM exchanges").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': entries}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ArchiveAdapter(BaseAdapter):
+    """Transport adapter recording or replaying the exchanges of another
+    adapter in an archive.
+    """
+
+    def __init__(self, archive, mode=REPLAY, adapter=None):
+        """Wraps a transport adapter.
+
+        :param Archive archive: the archive of the responses
+        :param str mode: one of `MODES`
+        :param adapter: the adapter sending the requests, whose retries are
+            not recorded
+        """
+        if mode not in MODES:
+            raise errors.InvalidParameterError(
+                "Archive mode should be one of {0}".format(', '.join(MODES)))
+        super(ArchiveAdapter, self).__init__()
+        self.archive = archive
+        self.mode = mode
+        self.adapter = adapter or requests.adapters.HTTPAdapter()
+
+    def send(self, request, **kwargs):
+        if self.mode != RECORD:
+            found = self.archive.get(request.method, request.url,
+                                     request.body)
+            if found is not None:
+                return replayed_response(request, *found)
+            if self.mode == STRICT:
+                raise not_recorded(request.method, request.url,
+                                   self.archive.path)
+        resp = self.adapter.send(request, **kwargs)
+        self.archive.put(request.method, request.url, request.body,
+                         resp.status_code, resp.headers, resp.content)
+        return resp
+
+    def close(self):
+        self.adapter.close()
+
+
+def replayed_response(request, status, headers, content):
+    """Build the response of requests to a request from a recorded one."""
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers)
+    resp._content = content
+    resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+    resp.elapsed = datetime.timedelta(0)
+    resp.request = request
+    resp.url = request.url
+    return resp
@@ -1,36 +1,141 @@
 """Factory of RoutingService classes
+
+The routers are registered by name and only imported when they are first
+created, so that the dependencies of the other routers are never loaded.
+Other packages can register their routers with an entry point of the
+`rap.routers` group, e.g. in their setup.py::
+
+    entry_points={
+        'rap.routers': ['graphhopper = mypackage.gh:GraphHopperRouter']
+    }
 """
 
+import functools
+import importlib
 import json
 import logging
-from .mapbox import MapboxRouter
-from .ors import OpenRouteServiceRouter
-from .google import GoogleMapsRouter
+import os
+import threading
+from . import errors
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    entry_points = None
 
 LOGGER = logging.getLogger(__name__)
 
+ENTRY_POINT_GROUP = 'rap.routers'
+
+# Routers shipped with rap, as `module:class` paths imported on first use
+BUILTIN_ROUTERS = {
+    'mapbox': 'rap.mapbox:MapboxRouter',
+    'openrouteservice': 'rap.ors:OpenRouteServiceRouter',
+    'google': 'rap.google:GoogleMapsRouter',
+    'graph': 'rap.graph:GraphRouter'
+}
+
+_routers = dict(BUILTIN_ROUTERS)
+_plugins_loaded = False
+_router_confs = {}
+_lock = threading.RLock()
+
+
+def register_router(name, router):
+    """Register a router under a name.
+
+    :param str name: name of the routing service provider
+    :param router: RoutingService subclass, or its `module:class` path to
+        import on first use
+    """
+    LOGGER.debug("Register router %s", name)
+    with _lock:
+        _routers[name] = router
+
+
+def _load_plugins():
+    # Add the routers of the installed entry points, the ones registered
+    # by name take precedence
+    global _plugins_loaded
+    with _lock:
+        if _plugins_loaded:
+            return
+        _plugins_loaded = True
+        if entry_points is None:
+            return
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, [])
+        for ep in eps:
+            LOGGER.debug("Router %s is provided by %s", ep.name, ep.value)
+            _routers.setdefault(ep.name, ep.value)
+
 
-def RoutingServiceFactory(service_name, profile):
+def router_names():
+    """Get the names of all the registered routers."""
+    _load_plugins()
+    with _lock:
+        return sorted(_routers)
+
+
+def get_router_class(service_name):
+    """Get the class of a registered router, imported on first use.
+
+    :param str service_name: name of the routing service provider
+    :raises InvalidParameterError: if no router has this name
+    """
+    with _lock:
+        if service_name not in _routers:
+            _load_plugins()
+        router = _routers.get(service_name)
+        if router is None:
+            raise errors.InvalidParameterError(
+                "No router is registered as {0}".format(service_name))
+        if isinstance(router, str):
+            LOGGER.debug("Import router %s from %s", service_name, router)
+            module, _, attrs = router.partition(':')
+            router = functools.reduce(getattr, attrs.split('.'),
+                                      importlib.import_module(module))
+            _routers[service_name] = router
+        return router
+
+
+def load_router_conf(path='routerconf.json'):
+    """Read the settings of the routers, only once for every file.
+
+    :param str path: the json file with the settings of every router
+    """
+    path = os.path.abspath(path)
+    with _lock:
+        if path not in _router_confs:
+            LOGGER.debug("Load the router settings from %s", path)
+            with open(path, 'r') as f:
+                _router_confs[path] = json.load(f)
+        return _router_confs[path]
+
+
+def RoutingServiceFactory(service_name, profile, pool_size=None,
+                          route_cache=None, conf_file='routerconf.json'):
     """ Factary method for creating concrete router instance
+
+    :param str service_name: name of the routing service provider
+    :param str profile: routing profile name
+    :param int pool_size: size of the HTTP connection pool, should match the
+        number of concurrent workers using the router
+    :param RouteCache route_cache: persistent cache of the found paths
+    :param str conf_file: the json file with the settings of the routers
+    :return: the router, None if no router has this name
     """
     LOGGER.debug("Create concrete router for %s with profile %s",
                  service_name, profile)
-    with open('routerconf.json', 'r') as f:
-        service_provider_conf = json.load(f)
-    # TODO(lliu): The following stuff of course should be prettified
-    # ATTENTION!! A pile of ugly things are coming...
-    if service_name == 'mapbox':
-        LOGGER.info("Create mapbox router")
-        return MapboxRouter(profile,
-                            service_provider_conf['mapbox']['key'],
-                            service_provider_conf['mapbox']['rate_limit'])
-    elif service_name == 'openrouteservice':
-        LOGGER.info("Create openrouteservice router")
-        return OpenRouteServiceRouter(profile,
-                                      service_provider_conf['openrouteservice']['key'],
-                                      service_provider_conf['openrouteservice']['rate_limit'])
-    elif service_name == 'google':
-        LOGGER.info("Create google maps router")
-        return GoogleMapsRouter(profile,
-                                service_provider_conf['google']['key'],
-                                service_provider_conf['google']['rate_limit'])
+    try:
+        router_class = get_router_class(service_name)
+    except errors.InvalidParameterError as e:
+        LOGGER.error(e)
+        return None
+    LOGGER.info("Create %s router", service_name)
+    return router_class.from_conf(profile,
+                                  load_router_conf(conf_file)[service_name],
+                                  pool_size=pool_size,
+                                  route_cache=route_cache)
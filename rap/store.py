@@ -0,0 +1,148 @@
+"""Storage backends for the routes found by probing jobs
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+
+class DirectoryStore(object):
+    """One JSON file per route, named SOURCE_TARGET.json, in a directory.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self._dir_created = False
+
+    def save(self, source_id, target_id, route):
+        """Save the route found from the source to the target.
+
+        :param route: the path info, or the JSON response body as bytes
+            which is written as it is
+        """
+        if not self._dir_created:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._dir_created = True
+        filepath = os.path.join(self.output_dir, '{0}_{1}.json'.format(
+            source_id, target_id))
+        LOGGER.debug("Save the found route information to %s", filepath)
+        if isinstance(route, bytes):
+            with open(filepath, 'wb') as f:
+                f.write(route)
+        else:
+            with open(filepath, 'w') as f:
+                json.dump(route, f)
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(object):
+    """All the routes of a job in one SQLite database indexed by target id.
+
+    The routes are compressed with zlib and inserted in batches of
+    `batch_size` in one transaction, which is much cheaper for the file
+    system than writing tens of thousands of small files.
+    """
+
+    def __init__(self, path, batch_size=500):
+        """Opens or creates a route store.
+
+        :param str path: path of the SQLite database file
+        :param int batch_size: number of routes written per transaction
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._batch = []
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS routes ("
+                           "target_id INTEGER NOT NULL, "
+                           "source_id INTEGER NOT NULL, "
+                           "route BLOB NOT NULL, "
+                           "PRIMARY KEY (target_id, source_id))")
+        self._conn.commit()
+
+    def save(self, source_id, target_id, route):
+        """Save the route found from the source to the target.
+
+        :param route: the path info, or the JSON response body as bytes
+            which is compressed as it is
+        """
+        if not isinstance(route, bytes):
+            route = json.dumps(route).encode('utf-8')
+        blob = zlib.compress(route)
+        with self._lock:
+            self._batch.append((target_id, source_id, blob))
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if self._batch:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO routes VALUES (?, ?, ?)",
+                    self._batch)
+            self._batch = []
+
+    def merge(self, path):
+        """Copy all the routes of another SQLiteStore database file."""
+        LOGGER.debug("Merge the routes of %s", path)
+        with self._lock:
+            self._flush()
+            self._conn.execute("ATTACH DATABASE ? AS other", (path, ))
+            try:
+                with self._conn:
+                    self._conn.execute("INSERT OR REPLACE INTO routes "
+                                       "SELECT * FROM other.routes")
+            finally:
+                self._conn.execute("DETACH DATABASE other")
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+
+def _decode(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class SQLiteStoreReader(object):
+    """Read the routes of a SQLiteStore, memory-mapping the database.
+    """
+
+    def __init__(self, path, mmap_size=2 ** 30):
+        self._conn = sqlite3.connect('file:{0}?mode=ro'.format(path),
+                                     uri=True)
+        self._conn.execute("PRAGMA mmap_size={0:d}".format(mmap_size))
+
+    def get(self, target_id, source_id=-1):
+        """Get the route to a target, None if no route has been saved."""
+        row = self._conn.execute(
+            "SELECT route FROM routes WHERE target_id = ? AND source_id = ?",
+            (target_id, source_id)).fetchone()
+        return None if row is None else _decode(row[0])
+
+    def target_ids(self):
+        """Get the ids of all the targets with a saved route."""
+        return [r[0] for r in self._conn.execute(
+            "SELECT DISTINCT target_id FROM routes ORDER BY target_id")]
+
+    def __iter__(self):
+        """Stream (source_id, target_id, route) in the order of target ids."""
+        for target_id, source_id, blob in self._conn.execute(
+                "SELECT target_id, source_id, route FROM routes "
+                "ORDER BY target_id, source_id"):
+            yield source_id, target_id, _decode(blob)
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,230 @@
+"""Work queue sharing the probing of a job between worker processes
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from . import errors
+
+LOGGER = logging.getLogger(__name__)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+DEAD = 'dead'
+
+
+class WorkQueue(object):
+    """Tasks of probing a point from a landmark, kept in a SQLite database.
+
+    A coordinator enqueues the tasks of a job with its settings, and any
+    number of workers, on any host reaching the database file, claim
+    batches of them. A claimed task is leased to its worker for
+    `lease_seconds`, and is handed out again if its result is not reported
+    by then, e.g. because the worker was killed. A task is dead when its
+    point was given up by the worker, or when it was handed out
+    `max_attempts` times without a result. Dead tasks are kept apart from
+    the tasks done until they are put back in the queue by `requeue_dead`.
+    Every claim is a short write transaction, so the database is not held
+    by a worker while it probes.
+
+    The database is not switched to WAL, which would not work on a network
+    file system.
+    """
+
+    def __init__(self, path, lease_seconds=600, max_attempts=3, timeout=60):
+        """Opens or creates a work queue.
+
+        :param str path: path of the SQLite database file
+        :param float lease_seconds: seconds a worker has to report the
+            results of the tasks it claimed
+        :param int max_attempts: number of times a task is handed out
+            before it is dead
+        :param float timeout: seconds to wait for another process holding
+            the database
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS job ("
+                           "key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS landmarks ("
+                           "id INTEGER PRIMARY KEY, feature TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                           "seq INTEGER PRIMARY KEY, "
+                           "landmark INTEGER NOT NULL, "
+                           "point INTEGER NOT NULL, "
+                           "x REAL NOT NULL, y REAL NOT NULL, "
+                           "state TEXT NOT NULL, worker TEXT, "
+                           "expires REAL, attempts INTEGER NOT NULL, "
+                           "result TEXT, "
+                           "UNIQUE (landmark, point))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_state "
+                           "ON tasks (state, seq)")
+
+    def enqueue(self, settings, landmarks, points):
+        """Add the tasks of probing all the points from all the landmarks.
+
+        The tasks already in the queue are kept as they are, so a job can
+        be enqueued again after adding points.
+
+        :param dict settings: JSON serializable settings of the job, the
+            same for all the tasks of the queue
+        :param list landmarks: GeoJSON Point features with an integer `id`
+        :param points: iterable of points with `id`, `x` and `y`
+        :return: the number of tasks added
+        :raises InvalidParameterError: if the queue holds another job
+        """
+        points = list(points)
+        value = json.dumps(settings, sort_keys=True)
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT value FROM job WHERE key = 'settings'").fetchone()
+            if row is not None and row[0] != value:
+                raise errors.InvalidParameterError(
+                    "The queue {0} holds another job: {1}".format(
+                        self.path, row[0]))
+            self._conn.execute(
+                "INSERT OR IGNORE INTO job VALUES ('settings', ?)", (value, ))
+            before = self._count()
+            for landmark in landmarks:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO landmarks VALUES (?, ?)",
+                    (landmark['id'], json.dumps(landmark)))
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO tasks (landmark, point, x, y, "
+                    "state, attempts) VALUES (?, ?, ?, ?, ?, 0)",
+                    ((landmark['id'], p['id'], p['x'], p['y'], PENDING)
+                     for p in points))
+            added = self._count() - before
+        LOGGER.info("%s tasks added to %s", added, self.path)
+        return added
+
+    def _count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def settings(self):
+        """Get the settings of the job, None if nothing is enqueued."""
+        row = self._conn.execute(
+            "SELECT value FROM job WHERE key = 'settings'").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def landmarks(self):
+        """Get the landmarks of the job by id."""
+        return {i: json.loads(feature) for i, feature in self._conn.execute(
+            "SELECT id, feature FROM landmarks ORDER BY id")}
+
+    def claim(self, worker, batch_size=100):
+        """Lease a batch of pending tasks, or of tasks whose lease expired.
+
+        The tasks whose lease expired for the `max_attempts` time are dead
+        instead, with a result telling so.
+
+        :param str worker: unique name of the worker
+        :param int batch_size: maximum number of tasks claimed
+        :return: list of (landmark id, point) in the order of the queue
+        """
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            expired = self._conn.execute(
+                "SELECT seq, point, x, y FROM tasks WHERE state = ? "
+                "AND expires < ? AND attempts >= ?",
+                (LEASED, now, self.max_attempts)).fetchall()
+            self._conn.executemany(
+                "UPDATE tasks SET state = ?, result = ? WHERE seq = ?",
+                ((DEAD, json.dumps(self._expired_result(point, x, y)), seq)
+                 for seq, point, x, y in expired))
+            if expired:
+                LOGGER.warning("%s tasks are dead after %s attempts",
+                               len(expired), self.max_attempts)
+            rows = self._conn.execute(
+                "SELECT seq, landmark, point, x, y FROM tasks "
+                "WHERE state = ? OR (state = ? AND expires < ?) "
+                "ORDER BY seq LIMIT ?",
+                (PENDING, LEASED, now, batch_size)).fetchall()
+            self._conn.executemany(
+                "UPDATE tasks SET state = ?, worker = ?, expires = ?, "
+                "attempts = attempts + 1 WHERE seq = ?",
+                ((LEASED, worker, now + self.lease_seconds, r[0])
+                 for r in rows))
+        LOGGER.debug("%s claimed %s tasks", worker, len(rows))
+        return [(landmark, {'id': point, 'x': x, 'y': y})
+                for _, landmark, point, x, y in rows]
+
+    def _expired_result(self, point, x, y):
+        # Same columns as the points given up by a worker
+        return {'id': point, 'x': x, 'y': y, 'error': 'expired',
+                'message': 'Not reported after {0} attempts'.format(
+                    self.max_attempts)}
+
+    def complete(self, worker, landmark, results):
+        """Report the results of tasks claimed by a worker.
+
+        A result reported after the lease expired is still taken if no
+        other worker has reported one for the task in the meantime, or if
+        the task is dead.
+
+        :param int landmark: id of the landmark the points were probed from
+        :param results: the rows of the results, with the `id` of the points,
+            and an `error` for the points given up, whose tasks are dead
+        """
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "UPDATE tasks SET state = ?, worker = ?, result = ? "
+                "WHERE landmark = ? AND point = ? AND state != ?",
+                ((DEAD if 'error' in r else DONE, worker, json.dumps(r),
+                  landmark, r['id'], DONE) for r in results))
+
+    def release(self, worker, tasks):
+        """Put back the tasks of a worker which will not probe them.
+
+        The claim of the tasks is not counted as an attempt.
+        """
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "UPDATE tasks SET state = ?, worker = NULL, expires = NULL, "
+                "attempts = attempts - 1 "
+                "WHERE landmark = ? AND point = ? AND state = ? "
+                "AND worker = ?",
+                ((PENDING, landmark, p['id'], LEASED, worker)
+                 for landmark, p in tasks))
+
+    def requeue_dead(self):
+        """Put the dead tasks back in the queue with all their attempts.
+
+        :return: the number of tasks put back
+        """
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            requeued = self._conn.execute(
+                "UPDATE tasks SET state = ?, worker = NULL, expires = NULL, "
+                "attempts = 0, result = NULL WHERE state = ?",
+                (PENDING, DEAD)).rowcount
+        LOGGER.info("%s dead tasks put back in %s", requeued, self.path)
+        return requeued
+
+    def progress(self):
+        """Get the numbers of pending, leased, done and dead tasks."""
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, DEAD: 0}
+        counts.update(self._conn.execute(
+            "SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+        return counts
+
+    def results(self):
+        """Stream (landmark id, result) of the tasks done or dead, in the
+        order of the landmarks and the points.
+        """
+        for landmark, result in self._conn.execute(
+                "SELECT landmark, result FROM tasks WHERE state IN (?, ?) "
+                "ORDER BY landmark, seq", (DONE, DEAD)):
+            yield landmark, json.loads(result)
+
+    def close(self):
+        self._conn.close()
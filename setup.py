@@ -29,6 +29,10 @@ setup(
     author_email=contact,
     license=license,
     packages=['rap'],
+    extras_require={
+        # The event loop of --async and find_path_async
+        'async': ['aiohttp>=3.0']
+    },
     entry_points={
         'console_scripts': [
             'rapy=rap.rapy:main'
@@ -0,0 +1,39 @@
+"""Offline stand-ins shared by the test cases"""
+
+import json
+import requests
+from requests.adapters import BaseAdapter
+
+
+class ScriptedAdapter(BaseAdapter):
+    """Transport adapter answering with a fixed list of responses.
+
+    Each response is a status code or a (status code, JSON body) tuple, the
+    last one is repeated once the list is exhausted.
+    """
+
+    def __init__(self, responses, headers=None):
+        super(ScriptedAdapter, self).__init__()
+        self.responses = list(responses)
+        self.headers = headers or {}
+        self.requests = []
+
+    @property
+    def sent(self):
+        return len(self.requests)
+
+    def send(self, request, **kwargs):
+        scripted = self.responses[min(self.sent, len(self.responses) - 1)]
+        status, body = scripted if isinstance(scripted, tuple) \
+            else (scripted, {})
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers.update(self.headers)
+        resp._content = json.dumps(body).encode('utf-8')
+        resp.request = request
+        resp.url = request.url
+        self.requests.append(request)
+        return resp
+
+    def close(self):
+        pass
@@ -0,0 +1,47 @@
+import json
+from unittest import TestCase, main
+from rap.adaptive import iter_adaptive
+from rap.grid import grid_shape
+
+
+class AdaptiveProbingTestCase(TestCase):
+
+    def setUp(self):
+        with open('./appconf.json') as f:
+            self.bbox = json.load(f)['testbeds'][0]['bbox']
+        self.probed = []
+
+    def probe(self, pts):
+        # Accessible west of a north-south barrier, 5 minutes per 0.01 deg
+        for p in pts:
+            self.probed.append(p['id'])
+            yield {'id': p['id'], 'acc': int(p['x'] < 11.5555),
+                   'duration': (p['x'] - 11.45) * 30000}
+
+    def test_refines_only_along_the_boundary(self):
+        res = list(iter_adaptive(self.probe, self.bbox, 0.016, 0.001))
+        rows, cols = grid_shape(self.bbox, 0.001)
+        self.assertEqual(len(self.probed), len(set(self.probed)))
+        self.assertLess(len(res), rows * cols / 5)
+        # The columns on both sides of the barrier are probed in every row
+        west, east = 105, 106
+        probed = set(self.probed)
+        for r in range(rows):
+            self.assertIn(r * cols + west, probed)
+            self.assertIn(r * cols + east, probed)
+
+    def test_threshold_refines_more(self):
+        plain = len(list(iter_adaptive(self.probe, self.bbox, 0.016, 0.001)))
+        self.probed = []
+        timed = len(list(iter_adaptive(self.probe, self.bbox, 0.016, 0.001,
+                                       threshold=60)))
+        self.assertGreater(timed, plain)
+
+    def test_uniform_area_stays_coarse(self):
+        res = list(iter_adaptive(self.probe, self.bbox, 0.05, 0.01))
+        self.assertEqual(sorted(r['id'] for r in res), sorted(self.probed))
+        self.assertLess(len(res), 14 * 26)
+
+
+if __name__ == "__main__":
+    main()
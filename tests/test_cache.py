@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase, main
+from rap.base import RoutingService
+from rap.cache import RouteCache
+
+
+class CountingRouter(RoutingService):
+    """Router finding a path to every target, counting the requests."""
+
+    profile = 'walking'
+    matrix_max_locations = 10
+
+    def __init__(self, route_cache):
+        super(CountingRouter, self).__init__(route_cache=route_cache)
+        self.fetched = 0
+        self.matrix_targets = 0
+
+    def fetch_path(self, source_lng, source_lat, target_lng, target_lat,
+                   params=None):
+        self.fetched += 1
+        if target_lng < 0:
+            return None
+        return {'routes': [[source_lng, source_lat], [target_lng, target_lat]]}
+
+    def request_matrix(self, source, targets, params=None):
+        self.matrix_targets += len(targets)
+        return [{'duration': lng, 'distance': lat} for lng, lat in targets]
+
+
+class RouteCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'routes.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key_normalization(self):
+        cache = RouteCache(self.path)
+        key = cache.make_key('route', 'mapbox', 'walking', (11.5, 48.1),
+                             (11.6, 48.2), {'access_token': 'a', 'steps': 0})
+        self.assertEqual(key, cache.make_key(
+            'route', 'mapbox', 'walking', (11.50000001, 48.1), (11.6, 48.2),
+            {'steps': 0, 'access_token': 'b'}))
+        self.assertNotEqual(key, cache.make_key(
+            'route', 'mapbox', 'cycling', (11.5, 48.1), (11.6, 48.2),
+            {'steps': 0}))
+        cache.close()
+
+    def test_persistence_and_counters(self):
+        cache = RouteCache(self.path)
+        cache.put('k', {'routes': []})
+        self.assertEqual(cache.get('k'), (True, {'routes': []}))
+        self.assertEqual(cache.get('missing'), (False, None))
+        cache.close()
+        cache = RouteCache(self.path)
+        self.assertEqual(cache.get('k'), (True, {'routes': []}))
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 0, 'entries': 1})
+        cache.close()
+
+    def test_expiry(self):
+        cache = RouteCache(self.path, ttl=0.01)
+        cache.put('k', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('k'), (False, None))
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = RouteCache(self.path, max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        time.sleep(0.01)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.stats()['entries'], 2)
+        cache.close()
+
+    def test_size_is_bounded_after_every_put(self):
+        cache = RouteCache(self.path, max_entries=3)
+        for i in range(10):
+            cache.put(str(i), i)
+            cache.put(str(i), i)
+            self.assertLessEqual(cache.stats()['entries'], 3)
+        cache.close()
+        # The entries over the limit when opened are evicted at the next put
+        other = RouteCache(self.path)
+        for i in range(10, 15):
+            other.put(str(i), i)
+        other.close()
+        cache = RouteCache(self.path, max_entries=3)
+        cache.put('a', 1)
+        self.assertEqual(cache.stats()['entries'], 3)
+        self.assertEqual(cache.get('a'), (True, 1))
+        cache.close()
+
+    def test_router_find_path_hits_cache(self):
+        router = CountingRouter(RouteCache(self.path))
+        first = router.find_path(11.5, 48.1, 11.6, 48.2, {'steps': 'false'})
+        second = router.find_path(11.5, 48.1, 11.6, 48.2, {'steps': 'false'})
+        self.assertEqual(first, second)
+        self.assertEqual(router.fetched, 1)
+        router.route_cache.close()
+
+    def test_no_path_found_is_cached(self):
+        router = CountingRouter(RouteCache(self.path))
+        self.assertIsNone(router.find_path(11.5, 48.1, -11.6, 48.2))
+        self.assertIsNone(router.find_path(11.5, 48.1, -11.6, 48.2))
+        self.assertIsNone(router.find_path_raw(11.5, 48.1, -11.6, 48.2))
+        self.assertIsNone(router.find_path_raw(11.5, 48.1, -11.6, 48.2))
+        self.assertEqual(router.fetched, 2)
+        router.route_cache.close()
+
+    def test_router_find_path_raw_hits_cache(self):
+        router = CountingRouter(RouteCache(self.path))
+        first = router.find_path_raw(11.5, 48.1, 11.6, 48.2)
+        second = router.find_path_raw(11.5, 48.1, 11.6, 48.2)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(second.json(), router.find_path(11.5, 48.1, 11.6,
+                                                         48.2))
+        self.assertEqual(router.fetched, 2)
+        router.route_cache.close()
+
+    def test_router_matrix_only_requests_missing_targets(self):
+        router = CountingRouter(RouteCache(self.path))
+        targets = [(float(i), 48.0) for i in range(15)]
+        router.find_paths_matrix((0.0, 0.0), targets[:10])
+        res = router.find_paths_matrix((0.0, 0.0), targets)
+        self.assertEqual(router.matrix_targets, 15)
+        self.assertEqual([r['duration'] for r in res], list(range(15)))
+        router.route_cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, main
+from rap.base import RoutingService
+from rap.dedup import Deduplicator
+
+
+class SlowRouter(RoutingService):
+    """Router finding a path to every target after a delay."""
+
+    def __init__(self, delay=0.0):
+        super(SlowRouter, self).__init__()
+        self.delay = delay
+        self.targets = []
+        self.lock = threading.Lock()
+
+    def fetch_path(self, source_lng, source_lat, target_lng, target_lat,
+                   params=None):
+        with self.lock:
+            self.targets.append((target_lng, target_lat))
+        time.sleep(self.delay)
+        if target_lng < 0:
+            raise ValueError("No such place")
+        return {'target': [target_lng, target_lat]}
+
+    async def fetch_path_async(self, source_lng, source_lat, target_lng,
+                               target_lat, params=None):
+        self.targets.append((target_lng, target_lat))
+        await asyncio.sleep(self.delay)
+        return {'target': [target_lng, target_lat]}
+
+
+class DeduplicatorTestCase(TestCase):
+
+    def test_snapped_requests_are_sent_once(self):
+        router = SlowRouter()
+        router.dedup = Deduplicator(precision=3)
+        first = router.find_path(11.5, 48.1, 11.60001, 48.2)
+        second = router.find_path(11.5, 48.1, 11.59998, 48.20004)
+        self.assertEqual(first, second)
+        self.assertEqual(router.targets, [(11.6, 48.2)])
+        router.find_path(11.5, 48.1, 11.6, 48.2, {'steps': 'false'})
+        router.find_path_raw(11.5, 48.1, 11.6, 48.2)
+        self.assertEqual(len(router.targets), 3)
+        self.assertEqual(router.dedup.stats(),
+                         {'hits': 1, 'coalesced': 0, 'misses': 3})
+
+    def test_requests_in_flight_are_coalesced(self):
+        router = SlowRouter(delay=0.05)
+        router.dedup = Deduplicator(precision=2)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(
+                lambda i: router.find_path(11.5, 48.1, 11.6 + i * 1e-4, 48.2),
+                range(8)))
+        self.assertEqual(router.targets, [(11.6, 48.2)])
+        self.assertEqual(results, [{'target': [11.6, 48.2]}] * 8)
+        stats = router.dedup.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'] + stats['coalesced'], 7)
+
+    def test_async_requests_in_flight_are_coalesced(self):
+        router = SlowRouter(delay=0.01)
+        router.dedup = Deduplicator(precision=2)
+
+        async def find_paths():
+            return await asyncio.gather(*[router.find_path_async(
+                11.5, 48.1, 11.6 + i * 1e-4, 48.2) for i in range(8)])
+
+        results = asyncio.run(find_paths())
+        self.assertEqual(router.targets, [(11.6, 48.2)])
+        self.assertEqual(results, [{'target': [11.6, 48.2]}] * 8)
+        self.assertEqual(router.dedup.stats(),
+                         {'hits': 0, 'coalesced': 7, 'misses': 1})
+
+    def test_least_recently_used_results_are_dropped(self):
+        router = SlowRouter()
+        router.dedup = Deduplicator(precision=4, max_entries=2)
+        for lng in [1.0, 2.0, 1.0, 3.0, 2.0]:
+            router.find_path(0.0, 0.0, lng, 0.0)
+        self.assertEqual([t[0] for t in router.targets], [1.0, 2.0, 3.0, 2.0])
+
+    def test_failed_requests_are_not_remembered(self):
+        router = SlowRouter()
+        router.dedup = Deduplicator()
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                router.find_path(0.0, 0.0, -1.0, 0.0)
+        self.assertEqual(len(router.targets), 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+import numpy as np
+from rap import errors
+from rap.graph import GraphRouter, GridIndex, RoadGraph, haversine
+from rap.rapy import iter_accessibility_matrix
+
+
+def grid_graph(n=10, spacing=0.001):
+    """Road network of the streets of a square grid of n x n nodes."""
+    x1, y1, x2, y2 = [], [], [], []
+    for i in range(n):
+        for j in range(n):
+            if i + 1 < n:
+                x1.append(i * spacing), y1.append(j * spacing)
+                x2.append((i + 1) * spacing), y2.append(j * spacing)
+            if j + 1 < n:
+                x1.append(i * spacing), y1.append(j * spacing)
+                x2.append(i * spacing), y2.append((j + 1) * spacing)
+    return x1, y1, x2, y2
+
+
+class GridIndexTestCase(TestCase):
+
+    def test_nearest_matches_brute_force(self):
+        rng = np.random.RandomState(0)
+        xs, ys = rng.uniform(11.4, 11.7, 500), rng.uniform(48.0, 48.2, 500)
+        index = GridIndex(xs, ys)
+        for x, y in zip(rng.uniform(11.3, 11.8, 50),
+                        rng.uniform(47.9, 48.3, 50)):
+            i, d = index.nearest(x, y)
+            distances = haversine(x, y, xs, ys)
+            self.assertEqual(i, int(np.argmin(distances)))
+            self.assertAlmostEqual(d, distances.min())
+
+    def test_nothing_within_max_distance(self):
+        index = GridIndex([11.5, 11.6], [48.1, 48.1])
+        self.assertEqual(index.nearest(11.5, 48.2, max_distance=1000),
+                         (None, None))
+        self.assertEqual(index.nearest(11.5, 48.1001, 1000)[0], 0)
+
+
+class RoadGraphTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.graph = RoadGraph.from_edges(*grid_graph())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def node(self, x, y):
+        return self.graph.index.nearest(x, y)[0]
+
+    def test_shortest_paths_follow_the_streets(self):
+        source = self.node(0.0, 0.0)
+        costs, lengths, preds = self.graph.shortest_paths(
+            source, self.graph.lengths)
+        target = self.node(0.003, 0.004)
+        self.assertAlmostEqual(lengths[target], 7 * 0.001 * np.pi *
+                               6371008.8 / 180, delta=1.0)
+        path = self.graph.path(preds, target)
+        self.assertEqual((path[0], path[-1], len(path)), (source, target, 8))
+
+    def test_one_way_edges(self):
+        graph = RoadGraph.from_edges([0.0, 0.001], [0.0, 0.0],
+                                     [0.001, 0.002], [0.0, 0.0],
+                                     oneway=[True, False])
+        costs = graph.shortest_paths(2, graph.lengths)[0]
+        self.assertEqual(np.isfinite(costs).tolist(), [False, True, True])
+        costs = graph.shortest_paths(0, graph.lengths)[0]
+        self.assertTrue(np.isfinite(costs).all())
+
+    def test_load_csv_and_npz(self):
+        path = os.path.join(self.tmp_dir, 'roads.csv')
+        with open(path, 'w') as f:
+            f.write("x1,y1,x2,y2,length,oneway,speed\n"
+                    "0.0,0.0,0.001,0.0,200,,30\n"
+                    "0.001,0.0,0.002,0.0,,1,\n")
+        graph = RoadGraph.load(path)
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(len(graph.indices), 3)
+        self.assertEqual(sorted(graph.lengths.round().tolist()),
+                         [111, 200, 200])
+        npz = os.path.join(self.tmp_dir, 'roads.npz')
+        graph.save(npz)
+        loaded = RoadGraph.load(npz)
+        for name in ('xs', 'ys', 'indptr', 'indices', 'lengths', 'speeds'):
+            np.testing.assert_array_equal(getattr(loaded, name),
+                                          getattr(graph, name))
+
+    def test_load_edges_without_coordinates(self):
+        path = os.path.join(self.tmp_dir, 'roads.csv')
+        with open(path, 'w') as f:
+            f.write("u,v,length\n1,2,100\n")
+        with self.assertRaises(errors.InvalidFileError):
+            RoadGraph.load(path)
+
+    def test_missing_graph_file(self):
+        path = os.path.join(self.tmp_dir, 'missing.csv')
+        with self.assertRaises(errors.InvalidFileError) as ctx:
+            GraphRouter.from_conf('walking', {'graph': path})
+        self.assertIn(path, str(ctx.exception))
+
+    def test_sample_road_network(self):
+        router = GraphRouter.from_conf('walking', {
+            'graph': './input/munich-grid-roads.csv'})
+        route = router.find_path(11.557766, 48.140458, 11.62, 48.11)
+        self.assertGreater(route['distance'], 0)
+
+
+class GraphRouterTestCase(TestCase):
+
+    def setUp(self):
+        self.router = GraphRouter('walking',
+                                  graph=RoadGraph.from_edges(*grid_graph()),
+                                  max_snap=100)
+
+    def test_find_path(self):
+        route = self.router.find_path(0.0, 0.0, 0.003, 0.004)
+        self.assertAlmostEqual(route['distance'], 778, delta=1)
+        self.assertAlmostEqual(route['duration'],
+                               route['distance'] / (5 / 3.6))
+        self.assertEqual(route['geometry']['coordinates'][-1],
+                         [0.003, 0.004])
+        summary = self.router.find_summary(0.0, 0.0, 0.003, 0.004)
+        self.assertEqual(summary, self.router.route_summary(route))
+        self.assertIsNone(self.router.find_path(0.0, 0.0, 0.5, 0.5))
+
+    def test_matrix_is_answered_from_one_search(self):
+        targets = [(i * 0.0005, 0.0021) for i in range(19)] + [(1.0, 1.0)]
+        results = self.router.find_paths_matrix((0.0001, 0.0), targets)
+        self.assertEqual(len(self.router._searches), 1)
+        self.assertIsNone(results[-1])
+        for target, result in zip(targets[:5], results):
+            self.assertEqual(result, self.router.route_summary(
+                self.router.find_path(0.0001, 0.0, target[0], target[1])))
+        self.assertEqual(len(self.router._searches), 1)
+
+    def test_accessibility_of_points(self):
+        landmark = {'geometry': {'coordinates': [0.0045, 0.0045]}}
+        points = [{'id': i, 'x': i * 0.001, 'y': 0.009 - i * 0.002}
+                  for i in range(10)]
+        rows = list(iter_accessibility_matrix(self.router, landmark, points))
+        self.assertEqual([r['acc'] for r in rows], [1] * 5 + [0] * 5)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(errors.InvalidProfileError):
+            GraphRouter('transit', graph=self.router.graph)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+import numpy as np
+from rap import errors
+from rap.grid import grid_coords, grid_points, grid_shape, iter_grid, \
+    load_mask, points_in_polygons, spread_order
+from rap.rapy import read_points
+
+
+class GridTestCase(TestCase):
+
+    def setUp(self):
+        with open('./appconf.json') as f:
+            self.testbed = json.load(f)['testbeds'][0]
+
+    def test_same_as_munich_csv(self):
+        pts = list(grid_points(self.testbed['bbox'],
+                               self.testbed['stubspacing']))
+        self.assertEqual(pts, list(read_points('./input/munich.csv')))
+
+    def test_same_as_dense_munich_csv(self):
+        pts = list(grid_points(self.testbed['bbox'], 0.001, chunk_size=1000))
+        self.assertEqual(pts, list(read_points('./input/dense-munich.csv')))
+
+    def test_chunks(self):
+        chunks = list(iter_grid(self.testbed['bbox'], 0.01, chunk_size=100))
+        self.assertEqual([len(ids) for ids, xs, ys in chunks],
+                         [100, 100, 100, 64])
+        self.assertEqual(grid_shape(self.testbed['bbox'], 0.01), (14, 26))
+        with self.assertRaises(errors.InvalidParameterError):
+            grid_shape(self.testbed['bbox'], 0)
+
+    def test_points_in_polygon_with_hole(self):
+        square = [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]
+        hole = [[1, 1], [3, 1], [3, 3], [1, 3], [1, 1]]
+        xs = np.array([0.5, 2.0, 3.5, 5.0])
+        ys = np.array([0.5, 2.0, 3.5, 2.0])
+        self.assertEqual(points_in_polygons(xs, ys, [[square, hole]]).tolist(),
+                         [True, False, True, False])
+
+    def test_masked_grid_keeps_ids(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'mask.json')
+            with open(path, 'w') as f:
+                json.dump({'type': 'Feature', 'properties': {},
+                           'geometry': {'type': 'Polygon', 'coordinates': [
+                               [[11.445, 48.205], [11.475, 48.205],
+                                [11.475, 48.185], [11.445, 48.185],
+                                [11.445, 48.205]]]}}, f)
+            pts = list(grid_points(self.testbed['bbox'], 0.01,
+                                   load_mask(path)))
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual([p['id'] for p in pts], [0, 1, 2, 26, 27, 28])
+
+
+class SpreadOrderTestCase(TestCase):
+
+    def test_grid_is_probed_from_coarse_to_fine(self):
+        bbox = {'left': 0.0, 'right': 1.0, 'top': 1.0, 'bottom': 0.0}
+        xs, ys = grid_coords(bbox, 0.125, np.arange(81))
+        order = spread_order(xs, ys)
+        self.assertEqual(sorted(order.tolist()), list(range(81)))
+        # The corners of the quadrants, then of their quadrants
+        self.assertEqual([(xs[i], ys[i]) for i in order[:4]],
+                         [(0.0, 0.0), (0.5, 0.0), (0.0, 0.5), (0.5, 0.5)])
+        self.assertEqual(sorted((xs[i], ys[i]) for i in order[:16]),
+                         [(x, y) for x in (0.0, 0.25, 0.5, 0.75)
+                          for y in (0.0, 0.25, 0.5, 0.75)])
+
+    def test_every_part_covers_the_area(self):
+        rng = np.random.RandomState(0)
+        xs, ys = rng.uniform(11.4, 11.7, 2000), rng.uniform(48.0, 48.2, 2000)
+        first = spread_order(xs, ys)[:200]
+        # Every point is near one of the first points probed, unlike with
+        # the first points of a file sorted by rows
+        gap = np.hypot(xs[:, None] - xs[first], ys[:, None] - ys[first])
+        self.assertLess(gap.min(axis=1).max(), 0.04)
+        by_rows = np.argsort(ys)[:200]
+        gap = np.hypot(xs[:, None] - xs[by_rows], ys[:, None] - ys[by_rows])
+        self.assertGreater(gap.min(axis=1).max(), 0.1)
+
+    def test_same_positions(self):
+        self.assertEqual(spread_order([1.0, 1.0, 2.0], [0.0, 0.0, 0.0])
+                         .tolist(), [0, 2, 1])
+        self.assertEqual(spread_order([], []).tolist(), [])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from rap import errors
+from rap.journal import ResultJournal
+
+FIELDNAMES = ['id', 'x', 'y', 'acc']
+
+
+class ResultJournalTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'mapbox.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_rows(self, ids, resume=False):
+        with ResultJournal(self.path, FIELDNAMES, resume=resume,
+                           sync_every=2) as journal:
+            for i in ids:
+                journal.write({'id': i, 'x': 11.5, 'y': 48.1, 'acc': 1})
+        return journal
+
+    def read_ids(self):
+        with open(self.path, newline='') as f:
+            return [int(r['id']) for r in csv.DictReader(f)]
+
+    def test_rows_are_synced_in_batches(self):
+        journal = ResultJournal(self.path, FIELDNAMES, sync_every=2)
+        for i in range(3):
+            journal.write({'id': i, 'x': 11.5, 'y': 48.1, 'acc': 0})
+        self.assertEqual(self.read_ids(), [0, 1])
+        journal.close()
+        self.assertEqual(self.read_ids(), [0, 1, 2])
+
+    def test_resume_appends_missing_rows(self):
+        self.write_rows(range(5))
+        journal = ResultJournal(self.path, FIELDNAMES, resume=True)
+        self.assertEqual(journal.done, set(range(5)))
+        journal.close()
+        self.write_rows(range(5, 8), resume=True)
+        self.assertEqual(self.read_ids(), list(range(8)))
+
+    def test_no_resume_starts_over(self):
+        self.write_rows(range(5))
+        self.write_rows(range(2))
+        self.assertEqual(self.read_ids(), [0, 1])
+
+    def test_resume_drops_incomplete_row(self):
+        self.write_rows(range(3))
+        with open(self.path, 'a') as f:
+            f.write('3,11.5,4')
+        journal = self.write_rows([3], resume=True)
+        self.assertEqual(journal.done, set(range(3)))
+        self.assertEqual(self.read_ids(), list(range(4)))
+
+    def test_resume_with_other_columns_fails(self):
+        self.write_rows(range(3))
+        with self.assertRaises(errors.InvalidFileError):
+            ResultJournal(self.path, FIELDNAMES + ['duration', 'distance'],
+                          resume=True)
+
+
+if __name__ == "__main__":
+    main()
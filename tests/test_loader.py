@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main, mock
+import numpy as np
+from rap import errors, loader
+from rap.loader import FOUND, INVALID, MISSING, load_index, \
+    load_point_ids, load_results, polyline_size, summarize_route
+from rap.store import DirectoryStore, SQLiteStore
+
+LINE = {'type': 'LineString', 'coordinates': [[11.5, 48.1], [11.6, 48.2]]}
+
+
+def mapbox_route(duration):
+    return {'code': 'Ok', 'routes': [
+        {'duration': duration, 'distance': duration * 2, 'geometry': LINE}]}
+
+
+class SummarizeRouteTestCase(TestCase):
+
+    def test_providers(self):
+        self.assertEqual(summarize_route(mapbox_route(5)), (5, 10, 2))
+        self.assertEqual(summarize_route({'routes': [{
+            'summary': {'duration': 5, 'distance': 10},
+            'geometry': '_p~iF~ps|U_ulLnnqC_mqNvxq`@'}]}), (5, 10, 3))
+        self.assertEqual(summarize_route({'status': 'OK', 'routes': [{
+            'legs': [{'duration': {'value': 2}, 'distance': {'value': 4}},
+                     {'duration': {'value': 3}, 'distance': {'value': 6}}],
+            'overview_polyline': {'points': '_p~iF~ps|U'}}]}), (5, 10, 1))
+        duration, distance, size = summarize_route({'duration': 5,
+                                                    'distance': None})
+        self.assertEqual((duration, size), (5, 0))
+        self.assertTrue(np.isnan(distance))
+        self.assertIsNone(summarize_route({'code': 'Ok', 'routes': []}))
+
+    def test_polyline_size(self):
+        self.assertEqual(polyline_size(''), 0)
+        self.assertEqual(polyline_size('_p~iF~ps|U_ulLnnqC'), 2)
+
+
+class LoadResultsTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.routes_dir = os.path.join(self.tmp_dir, 'routes')
+        self.db = os.path.join(self.tmp_dir, 'routes.db')
+        files = DirectoryStore(self.routes_dir)
+        db = SQLiteStore(self.db)
+        for target in (8, 2, 4):
+            for store in (files, db):
+                store.save(-1, target, mapbox_route(target))
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_results_are_aligned_with_the_ids(self):
+        with open(os.path.join(self.routes_dir, '-1_6.json'), 'w') as f:
+            f.write('{"code": "Ok", "rout')
+        ids = [1, 2, 4, 6, 8, 9]
+        for store in (self.routes_dir, self.db):
+            res = load_results(store, ids, workers=1)
+            self.assertEqual(res['id'].tolist(), ids)
+            np.testing.assert_array_equal(
+                res['duration'], [np.nan, 2, 4, np.nan, 8, np.nan])
+            self.assertEqual(res['geometry_size'].tolist(),
+                             [0, 2, 2, 0, 2, 0])
+        self.assertEqual(res['status'].tolist(),
+                         [MISSING, FOUND, FOUND, MISSING, FOUND, MISSING])
+        res = load_results(self.routes_dir, ids, workers=1)
+        self.assertEqual(res['status'][3], INVALID)
+
+    def test_index_is_used_until_the_routes_change(self):
+        index = os.path.join(self.tmp_dir, 'routes.npz')
+        self.assertEqual(len(load_index(self.db, index)['target']), 3)
+        self.assertTrue(os.path.isfile(index))
+        db = SQLiteStore(self.db)
+        db.save(-1, 10, mapbox_route(10))
+        db.close()
+        res = load_results(self.db, [10], index=index)
+        self.assertEqual(res['distance'].tolist(), [20])
+        load_results(self.routes_dir, [2], index=True)
+        self.assertTrue(os.path.isfile(os.path.join(self.routes_dir,
+                                                    'index.npz')))
+        res = load_results(self.routes_dir, [2, 3], index=True)
+        self.assertEqual(res['status'].tolist(), [FOUND, MISSING])
+
+    def test_several_landmarks(self):
+        DirectoryStore(self.routes_dir).save(7, 2, mapbox_route(1))
+        with self.assertRaises(errors.InvalidParameterError):
+            load_results(self.routes_dir, [2])
+        res = load_results(self.routes_dir, [2, 4], source_id=7, workers=1)
+        self.assertEqual(res['duration'][0], 1)
+        self.assertEqual(res['status'].tolist(), [FOUND, MISSING])
+
+    def test_parallel_scan(self):
+        with mock.patch.object(loader, 'CHUNK_SIZE', 1):
+            res = load_results(self.routes_dir, [2, 4, 8], workers=2)
+        self.assertEqual(res['duration'].tolist(), [2, 4, 8])
+
+    def test_load_point_ids(self):
+        self.assertEqual(load_point_ids('./input/mini_munich.csv').tolist(),
+                         [0, 1, 2, 3])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import json
 from unittest import TestCase, main
+from rap import errors
 from rap.mapbox import MapboxRouter
+from stubs import ScriptedAdapter
 
 
 class MapboxRouterTestCase(TestCase):
@@ -19,6 +21,37 @@ class MapboxRouterTestCase(TestCase):
                                     params)
         self.assertIsNotNone(res)
 
+    def test_find_paths_matrix_in_batches(self):
+        targets = [(11.5 + i * 0.01, 48.1) for i in range(30)]
+
+        def matrix(n):
+            return (200, {'code': 'Ok',
+                          'durations': [[60.0] * (n - 1) + [None]],
+                          'distances': [[100.0] * (n - 1) + [None]]})
+
+        adapter = ScriptedAdapter([matrix(24), matrix(6)])
+        self.router.session.mount('https://', adapter)
+        res = self.router.find_paths_matrix((11.55, 48.18), targets)
+        self.assertEqual(adapter.sent, 2)
+        self.assertEqual(len(res), 30)
+        self.assertIsNone(res[23])
+        self.assertEqual(res[0], {'duration': 60.0, 'distance': 100.0})
+        self.assertIn('destinations=1%3B2%3B3', adapter.requests[0].url)
+
+    def test_failures_are_classified(self):
+        self.router.rate_limit_retries = 0
+        self.router.session.mount('https://', ScriptedAdapter([
+            (422, {'code': 'NoSegment'}), (422, {'code': 'InvalidInput'}),
+            429, 503]))
+        for expected in (None, errors.PermanentError, errors.RateLimitError,
+                         errors.TransientError):
+            if expected is None:
+                self.assertIsNone(self.router.fetch_path(11.55, 48.18, 11.62,
+                                                         48.11))
+                continue
+            with self.assertRaises(expected):
+                self.router.fetch_path(11.55, 48.18, 11.62, 48.11)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, main
+from rap.metrics import Histogram, Metrics, exponential_bounds, \
+    prometheus_text
+
+
+class HistogramTestCase(TestCase):
+
+    def test_quantiles_are_interpolated_in_buckets(self):
+        h = Histogram(exponential_bounds(1, 2, 10))
+        for v in range(1, 101):
+            h.observe(v)
+        snap = h.snapshot()
+        self.assertEqual(snap['count'], 100)
+        self.assertEqual(snap['sum'], 5050)
+        self.assertEqual((snap['min'], snap['max']), (1, 100))
+        self.assertAlmostEqual(snap['p50'], 50, delta=8)
+        self.assertAlmostEqual(snap['p99'], 99, delta=2)
+
+    def test_overflow_bucket(self):
+        h = Histogram([1, 2])
+        h.observe(10)
+        h.observe(20)
+        self.assertEqual(h.counts, [0, 0, 2])
+        self.assertEqual(h.quantile(1.0), 20)
+
+    def test_empty(self):
+        self.assertIsNone(Histogram([1]).quantile(0.5))
+
+    def test_concurrent_observations(self):
+        h = Histogram(exponential_bounds(0.001, 2, 10))
+
+        def observe():
+            for _ in range(1000):
+                h.observe(0.01)
+
+        threads = [threading.Thread(target=observe) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(h.count, 8000)
+        self.assertEqual(sum(h.counts), 8000)
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics('FakeRouter')
+        for status, seconds in [(200, 0.01), (200, 0.02), (404, 0.5)]:
+            self.metrics.observe_response(seconds, status, 1000)
+        self.metrics.observe_throttle(0.25)
+        self.metrics.observe_cache(True)
+        self.metrics.observe_cache(False)
+        self.metrics.observe_retry(503)
+        self.metrics.observe_retry('ConnectTimeoutError')
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_summary(self):
+        summary = self.metrics.summary()
+        self.assertIn("3 requests", summary)
+        self.assertIn("200: 2, 404: 1", summary)
+        self.assertIn("Rate limit wait: 0.2s", summary)
+        self.assertIn("1 hits, 1 misses", summary)
+        self.assertIn("Retries: 503: 1, ConnectTimeoutError: 1", summary)
+
+    def test_prometheus(self):
+        text = self.metrics.to_prometheus()
+        self.assertIn('rap_request_seconds_bucket{router="FakeRouter",'
+                      'le="+Inf"} 3', text)
+        self.assertIn('rap_request_seconds_count{router="FakeRouter"} 3',
+                      text)
+        self.assertIn('rap_responses_total{router="FakeRouter",'
+                      'status="404"} 1', text)
+        self.assertIn('rap_route_cache_total{router="FakeRouter",'
+                      'result="hit"} 1', text)
+        self.assertIn('rap_retries_total{router="FakeRouter",'
+                      'reason="503"} 1', text)
+        buckets = [int(l.rsplit(' ', 1)[1]) for l in text.splitlines()
+                   if l.startswith('rap_request_seconds_bucket')]
+        self.assertEqual(buckets, sorted(buckets))
+
+    def test_export(self):
+        path = os.path.join(self.tmp_dir, 'metrics.jsonl')
+        self.metrics.export(path)
+        self.metrics.export(path)
+        with open(path) as f:
+            lines = [json.loads(l) for l in f]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['responses'], {'200': 2, '404': 1})
+        self.assertEqual(lines[0]['request_seconds']['count'], 3)
+        prom = os.path.join(self.tmp_dir, 'metrics.prom')
+        self.metrics.export(prom)
+        with open(prom) as f:
+            self.assertTrue(f.read().startswith('# TYPE'))
+
+    def test_prometheus_of_several_routers(self):
+        other = Metrics('OtherRouter')
+        other.observe_response(0.5, 200, 100)
+        text = prometheus_text([self.metrics, other])
+        self.assertEqual(text.count('# TYPE rap_responses_total counter'), 1)
+        self.assertIn('rap_responses_total{router="OtherRouter",'
+                      'status="200"} 1', text)
+        lines = text.splitlines()
+        start = lines.index('# TYPE rap_request_seconds histogram')
+        end = lines.index('# TYPE rap_response_bytes histogram')
+        self.assertEqual(len(lines[start + 1:end]), 2 * 20)
+
+
+if __name__ == "__main__":
+    main()
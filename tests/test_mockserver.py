@@ -0,0 +1,266 @@
+import asyncio
+import json
+from unittest import TestCase, main, skipIf
+from rap import base, errors
+from rap.google import GoogleMapsRouter
+from rap.mapbox import MapboxRouter
+from rap.mockserver import MockRoutingServer
+from rap.ors import OpenRouteServiceRouter
+from rap.rapy import cal_accessibility, cal_accessibility_async, \
+    iter_accessibility_summary, iter_accessibility_summary_in_event_loop
+from rap.store import DirectoryStore
+
+ORIGIN = (11.55, 48.18)
+DEST = (11.62, 48.11)
+
+
+class MockRoutingServerTestCase(TestCase):
+
+    def setUp(self):
+        self.mock = MockRoutingServer(seed=1).start()
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def router(self, cls, profile, key='KEY'):
+        router = cls(profile, key)
+        router.set_base_url(self.mock.url)
+        return router
+
+    def test_mapbox(self):
+        router = self.router(MapboxRouter, 'walking')
+        res = router.find_path(ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+        summary = router.route_summary(res)
+        self.assertAlmostEqual(summary['distance'] / summary['duration'],
+                               1.4)
+        matrix = router.find_paths_matrix(ORIGIN, [DEST] * 30)
+        self.assertEqual(len(matrix), 30)
+        self.assertAlmostEqual(matrix[0]['distance'], summary['distance'])
+        self.assertEqual(self.mock.stats['requests'], 3)
+        snap = router.metrics.snapshot()
+        self.assertEqual(snap['responses'], {'200': 3})
+        self.assertEqual(snap['response_bytes']['sum'],
+                         self.mock.stats['bytes_sent'])
+
+    def test_ors(self):
+        router = self.router(OpenRouteServiceRouter, 'walking.normal')
+        res = router.find_path(ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+        summary = router.route_summary(res)
+        matrix = router.find_paths_matrix(ORIGIN, [DEST, ORIGIN])
+        self.assertAlmostEqual(matrix[0]['duration'], summary['duration'])
+
+    def test_google(self):
+        router = self.router(GoogleMapsRouter, 'walking', 'AIza-mock')
+        res = router.find_path(ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+        self.assertEqual(router.route_summary(res)['distance'],
+                         int(self.mock.route(ORIGIN, DEST)[1]))
+        self.assertIsInstance(json.loads(res), list)
+        # The requests of the googlemaps client are recorded too
+        self.assertEqual(router.metrics.request_seconds.count, 1)
+
+    def test_raw_routes(self):
+        for cls, profile, key in [(MapboxRouter, 'walking', 'KEY'),
+                                  (OpenRouteServiceRouter, 'walking.normal',
+                                   'KEY'),
+                                  (GoogleMapsRouter, 'walking', 'AIza-mock')]:
+            router = self.router(cls, profile, key)
+            res = router.find_path(ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+            raw = router.find_path_raw(ORIGIN[0], ORIGIN[1], DEST[0],
+                                       DEST[1])
+            self.assertIsInstance(raw.body, bytes)
+            self.assertEqual(raw.summary, router.route_summary(res))
+            if cls is GoogleMapsRouter:
+                self.assertEqual(raw.json()['routes'], json.loads(res))
+            else:
+                self.assertEqual(raw.json(), res)
+        self.mock.no_route_rate = 1.0
+        for cls, profile, key in [(MapboxRouter, 'walking', 'KEY'),
+                                  (GoogleMapsRouter, 'walking', 'AIza-mock')]:
+            router = self.router(cls, profile, key)
+            self.assertIsNone(router.find_path_raw(ORIGIN[0], ORIGIN[1],
+                                                   DEST[0], DEST[1]))
+
+    def test_summaries_without_geometry(self):
+        for cls, profile in [(MapboxRouter, 'walking'),
+                             (OpenRouteServiceRouter, 'walking.normal')]:
+            router = self.router(cls, profile)
+            summary = router.find_summary(ORIGIN[0], ORIGIN[1], DEST[0],
+                                          DEST[1])
+            res = router.find_path(ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+            self.assertEqual(summary, router.route_summary(res))
+            sizes = router.metrics.response_bytes
+            self.assertLess(sizes.min * 10, sizes.max)
+        self.mock.no_route_rate = 1.0
+        self.assertIsNone(router.find_summary(ORIGIN[0], ORIGIN[1], DEST[0],
+                                              DEST[1]))
+
+    def test_no_route(self):
+        self.mock.no_route_rate = 1.0
+        for cls, profile, key in [(MapboxRouter, 'walking', 'KEY'),
+                                  (OpenRouteServiceRouter, 'walking.normal',
+                                   'KEY'),
+                                  (GoogleMapsRouter, 'walking', 'AIza-mock')]:
+            router = self.router(cls, profile, key)
+            self.assertIsNone(router.find_path(ORIGIN[0], ORIGIN[1],
+                                               DEST[0], DEST[1]))
+
+    def test_rate_limited_requests_are_retried(self):
+        self.mock.rate_limit = 2
+        router = self.router(MapboxRouter, 'walking')
+        for _ in range(4):
+            self.assertIsNotNone(router.find_path(ORIGIN[0], ORIGIN[1],
+                                                  DEST[0], DEST[1]))
+        self.assertGreater(self.mock.stats['rate_limited'], 0)
+        self.assertLess(router.limiter.factor, 1.0)
+
+
+class HTTPTransportTestCase(TestCase):
+
+    def setUp(self):
+        self.mock = MockRoutingServer(error_rate=0.3, seed=2).start()
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def router(self, http=None):
+        router = MapboxRouter('walking', 'KEY', http=dict(
+            {'backoff_factor': 0.01}, **(http or {})))
+        router.set_base_url(self.mock.url)
+        return router
+
+    def test_server_errors_are_retried(self):
+        router = self.router({'retries': 5})
+        for _ in range(10):
+            self.assertIsNotNone(router.find_path(ORIGIN[0], ORIGIN[1],
+                                                  DEST[0], DEST[1]))
+        self.assertGreater(self.mock.stats['errors'], 0)
+        self.assertEqual(router.metrics.snapshot()['retries'],
+                         {'503': self.mock.stats['errors']})
+
+    def test_last_server_error_is_raised(self):
+        self.mock.error_rate = 1.0
+        router = self.router({'retries': 2})
+        with self.assertRaises(errors.TransientError):
+            router.find_path(ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+        self.assertEqual(self.mock.stats['requests'], 3)
+
+    def test_timeout(self):
+        self.mock.error_rate = 0.0
+        self.mock.latency = 0.5
+        router = self.router({'retries': 0, 'timeout': 0.1})
+        with self.assertRaises(errors.TransientError):
+            router.find_path(ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+
+    @skipIf(base.aiohttp is None, "aiohttp is not installed")
+    def test_async_server_errors_are_retried(self):
+        router = self.router({'retries': 5})
+
+        async def find_paths():
+            try:
+                return await asyncio.gather(*[router.find_path_async(
+                    ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])
+                    for _ in range(10)])
+            finally:
+                await router.close_async()
+
+        self.assertNotIn(None, asyncio.run(find_paths()))
+        self.assertGreater(self.mock.stats['errors'], 0)
+        self.assertEqual(router.metrics.snapshot()['retries'],
+                         {'503': self.mock.stats['errors']})
+
+    def test_backoff_time_is_jittered(self):
+        self.assertEqual(base.backoff_time(0.5, 0), 0)
+        times = [base.backoff_time(0.5, 3) for _ in range(100)]
+        self.assertTrue(all(0 <= t <= 2.0 for t in times))
+        self.assertGreater(len(set(times)), 1)
+
+    def test_unknown_http_settings(self):
+        with self.assertRaises(errors.InvalidParameterError):
+            MapboxRouter('walking', 'KEY', http={'retry': 3})
+
+    def test_pool_size_overrides_settings(self):
+        router = MapboxRouter('walking', 'KEY', pool_size=32,
+                              http={'pool_size': 4, 'timeout': [1, 2]})
+        self.assertEqual(router.http['pool_size'], 32)
+        self.assertEqual(router.timeout, (1, 2))
+        adapter = router.session.get_adapter('https://api.mapbox.com')
+        self.assertEqual(adapter._pool_maxsize, 32)
+        self.assertIsInstance(adapter.max_retries, base.JitteredRetry)
+
+
+@skipIf(base.aiohttp is None, "aiohttp is not installed")
+class AsyncRoutingTestCase(TestCase):
+
+    router = MockRoutingServerTestCase.router
+
+    def setUp(self):
+        self.mock = MockRoutingServer(no_route_rate=0.3, seed=1).start()
+        self.landmark = {'geometry': {'coordinates': list(ORIGIN)}}
+        self.points = [{'id': i, 'x': 11.5 + i * 0.001, 'y': 48.1}
+                       for i in range(40)]
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def run_async(self, router, coro):
+        async def run():
+            try:
+                return await coro
+            finally:
+                await router.close_async()
+        return asyncio.run(run())
+
+    def test_find_path_async(self):
+        for cls, profile, key in [(MapboxRouter, 'walking', 'KEY'),
+                                  (OpenRouteServiceRouter, 'walking.normal',
+                                   'KEY'),
+                                  (GoogleMapsRouter, 'walking', 'AIza-mock')]:
+            router = self.router(cls, profile, key)
+            res = self.run_async(router, router.find_path_async(
+                ORIGIN[0], ORIGIN[1], DEST[0], DEST[1]))
+            self.assertEqual(router.route_summary(res),
+                             router.route_summary(router.find_path(
+                                 ORIGIN[0], ORIGIN[1], DEST[0], DEST[1])))
+
+    def test_cal_accessibility_async_matches_sync(self):
+        router = self.router(MapboxRouter, 'walking')
+        router.max_in_flight = 8
+        store = DirectoryStore(self.mock.url)
+        store.save = lambda *args: None
+        expected = cal_accessibility(router, self.landmark, self.points,
+                                     store)
+        results = self.run_async(router, cal_accessibility_async(
+            router, self.landmark, iter(self.points), store,
+            concurrency=16))
+        self.assertEqual(results, expected)
+        self.assertIn(0, [r['acc'] for r in results])
+        self.assertEqual(self.mock.stats['requests'], 80)
+        self.assertEqual(router.metrics.request_seconds.count, 80)
+
+    def test_summaries_async_match_sync(self):
+        router = self.router(OpenRouteServiceRouter, 'walking.normal')
+        expected = list(iter_accessibility_summary(router, self.landmark,
+                                                   self.points, workers=4))
+        results = list(iter_accessibility_summary_in_event_loop(
+            router, self.landmark, iter(self.points), concurrency=16))
+        self.assertEqual(results, expected)
+        self.assertIn(None, [r['duration'] for r in results])
+        self.assertEqual(self.mock.stats['requests'], 80)
+
+    def test_rate_limited_async_requests_are_retried(self):
+        self.mock.rate_limit = 5
+        router = self.router(OpenRouteServiceRouter, 'walking.normal')
+
+        async def find_paths():
+            return await asyncio.gather(*[router.find_path_async(
+                ORIGIN[0], ORIGIN[1], DEST[0], DEST[1]) for _ in range(8)])
+
+        results = self.run_async(router, find_paths())
+        self.assertNotIn(None, results)
+        self.assertGreater(self.mock.stats['rate_limited'], 0)
+        self.assertIn('429', router.metrics.snapshot()['responses'])
+        self.assertGreater(router.metrics.throttle_seconds.sum, 0)
+
+
+if __name__ == "__main__":
+    main()
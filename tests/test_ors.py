@@ -1,6 +1,8 @@
 import json
 from unittest import TestCase, main
+from rap import errors
 from rap.ors import OpenRouteServiceRouter
+from stubs import ScriptedAdapter
 
 
 class OpenRouteServiceRouterTestCase(TestCase):
@@ -19,6 +21,18 @@ class OpenRouteServiceRouterTestCase(TestCase):
                                     {"geometry_format": "geojson"})
         self.assertIsNotNone(res)
 
+    def test_failures_are_classified(self):
+        self.router.rate_limit_retries = 0
+        self.router.session.mount('https://', ScriptedAdapter([
+            (404, {'error': {'code': 2009, 'message': 'Route not found'}}),
+            (400, {'error': {'code': 2003, 'message': 'Invalid parameter'}}),
+            502]))
+        self.assertIsNone(self.router.fetch_path(11.55, 48.18, 11.62, 48.11))
+        with self.assertRaises(errors.PermanentError):
+            self.router.fetch_path(11.55, 48.18, 11.62, 48.11)
+        with self.assertRaises(errors.TransientError):
+            self.router.find_paths_matrix((11.55, 48.18), [(11.62, 48.11)])
+
 
 if __name__ == "__main__":
     main()
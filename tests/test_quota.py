@@ -0,0 +1,130 @@
+import calendar
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main, mock
+from rap import errors, quota
+from rap.google import GoogleMapsRouter
+from rap.mapbox import MapboxRouter
+from rap.mockserver import MockRoutingServer
+from rap.quota import PAUSE, STOP, QuotaTracker, period_key, \
+    seconds_to_reset
+from rap.replay import RECORD, REPLAY, Archive
+
+# 2017-12-31 23:00 UTC
+NEW_YEARS_EVE = calendar.timegm((2017, 12, 31, 23, 0, 0))
+
+
+class FakeClock(object):
+    """Clock of the quota module, moved forward by sleeping."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class QuotaTrackerTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'quota.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_periods(self):
+        self.assertEqual(period_key('per_day', NEW_YEARS_EVE),
+                         'day:2017-12-31')
+        self.assertEqual(period_key('per_month', NEW_YEARS_EVE, 2),
+                         'month:2018-01')
+        self.assertEqual(seconds_to_reset('per_day', NEW_YEARS_EVE), 3600)
+        self.assertEqual(seconds_to_reset('per_month', NEW_YEARS_EVE), 3600)
+        self.assertEqual(seconds_to_reset('per_day', NEW_YEARS_EVE, -8),
+                         9 * 3600)
+        self.assertEqual(seconds_to_reset('per_month', NEW_YEARS_EVE - 86400,
+                                          -8), 33 * 3600)
+
+    def test_usage_adds_up_over_runs(self):
+        tracker = QuotaTracker(self.path, 'google', per_day=3, per_month=4)
+        self.assertEqual(tracker.reserve(2, NEW_YEARS_EVE - 86400), 0)
+        tracker.close()
+        tracker = QuotaTracker(self.path, 'google', per_day=3, per_month=4)
+        other = QuotaTracker(self.path, 'mapbox', per_day=1)
+        self.assertEqual(other.reserve(1, NEW_YEARS_EVE), 0)
+        self.assertEqual(tracker.reserve(2, NEW_YEARS_EVE), 0)
+        # The monthly budget is used up until the new year
+        self.assertEqual(tracker.reserve(1, NEW_YEARS_EVE), 3600)
+        self.assertEqual(tracker.usage(NEW_YEARS_EVE), {
+            'per_day': {'used': 2, 'limit': 3},
+            'per_month': {'used': 4, 'limit': 4}})
+        self.assertEqual(tracker.reserve(1, NEW_YEARS_EVE + 3600), 0)
+        tracker.close()
+        other.close()
+
+    def test_stop_or_pause(self):
+        clock = FakeClock(NEW_YEARS_EVE)
+        with mock.patch.object(quota.time, 'time', clock.time), \
+                mock.patch.object(quota.time, 'sleep', clock.sleep):
+            tracker = QuotaTracker(self.path, 'google', per_day=1,
+                                   action=STOP)
+            tracker.spend()
+            with self.assertRaises(errors.QuotaExceededError):
+                tracker.spend()
+            tracker.action = PAUSE
+            self.assertEqual(tracker.spend(), 3601)
+            self.assertEqual(clock.now, NEW_YEARS_EVE + 3601)
+            tracker.close()
+
+    def test_without_budget(self):
+        self.assertIsNone(QuotaTracker.from_conf(self.path, 'mapbox', None))
+        self.assertIsNone(QuotaTracker.from_conf(self.path, 'mapbox',
+                                                 {'utc_offset': -8}))
+        with self.assertRaises(errors.InvalidParameterError):
+            QuotaTracker(self.path, 'mapbox', 10, action='wait')
+
+    def test_router_stops_at_quota(self):
+        with MockRoutingServer(seed=1) as mock_server:
+            router = MapboxRouter('walking', 'KEY')
+            router.set_base_url(mock_server.url)
+            router.quota = QuotaTracker.from_conf(self.path, 'mapbox',
+                                                  {'per_day': 3})
+            for _ in range(3):
+                router.find_path(11.55, 48.18, 11.62, 48.11)
+            with self.assertRaises(errors.QuotaExceededError):
+                router.find_path(11.55, 48.18, 11.62, 48.11)
+            self.assertEqual(mock_server.stats['requests'], 3)
+            router.quota.close()
+
+    def test_requests_sent_are_charged_once(self):
+        archive = Archive(os.path.join(self.tmp_dir, 'job.archive'))
+        with MockRoutingServer(seed=1) as mock_server:
+            for cls, key in [(MapboxRouter, 'KEY'),
+                             (GoogleMapsRouter, 'AIza-mock')]:
+                for mode in (RECORD, REPLAY):
+                    router = cls('walking', key, http={'retries': 2})
+                    router.set_base_url(mock_server.url)
+                    router.use_archive(archive, mode)
+                    router.quota = QuotaTracker(self.path, key, per_day=10)
+                    router.find_path(11.55, 48.18, 11.62, 48.11)
+                    self.assertEqual(
+                        router.quota.usage()['per_day']['used'], 1)
+                    router.quota.close()
+            # The retries of server errors are sent too
+            mock_server.error_rate = 1.0
+            router = MapboxRouter('walking', 'KEY', http={'retries': 2})
+            router.set_base_url(mock_server.url)
+            router.quota = QuotaTracker(self.path, 'failing', per_day=10)
+            with self.assertRaises(errors.TransientError):
+                router.find_path(11.55, 48.18, 11.62, 48.11)
+            self.assertEqual(router.quota.usage()['per_day']['used'], 3)
+            router.quota.close()
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+import asyncio
+import collections
+import csv
+import functools
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase, main
+from docopt import docopt
+from rap import rapy
+from rap import errors
+from rap.base import RoutingService
+from rap.journal import ResultJournal
+from rap.workqueue import WorkQueue
+from rap.rapy import ACC_FIELDNAMES, MATRIX_FIELDNAMES, cal_accessibility, \
+    cal_accessibility_matrix, close_dead_letters, collect_results, \
+    failed_row, iter_accessibility, \
+    iter_accessibility_in_event_loop, iter_accessibility_summary, \
+    join_results, make_shards, map_in_order, merge_shards, \
+    open_dead_letters, probe_with_retries, read_landmarks, read_points, \
+    validate_arguments
+
+
+class FakeRouter(RoutingService):
+    """Router answering from memory, a path is found for even target ids."""
+
+    def __init__(self, rate_limit=-1, delay=0.0):
+        super(FakeRouter, self).__init__(None, None, rate_limit)
+        self.delay = delay
+        self.threads = set()
+
+    def fetch_path(self, source_lng, source_lat, target_lng, target_lat,
+                   params=None):
+        self.throttle()
+        self.threads.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        if int(round(target_lng)) % 2:
+            return None
+        return {'source': [source_lng, source_lat],
+                'target': [target_lng, target_lat]}
+
+
+class FakeAsyncRouter(FakeRouter):
+    """Router answering from an event loop after a random delay."""
+
+    def __init__(self):
+        super(FakeAsyncRouter, self).__init__()
+        self.in_flight = 0
+        self.max_in_flight_seen = 0
+
+    async def fetch_path_async(self, source_lng, source_lat, target_lng,
+                               target_lat, params=None):
+        self.in_flight += 1
+        self.max_in_flight_seen = max(self.max_in_flight_seen,
+                                      self.in_flight)
+        await asyncio.sleep(random.uniform(0, 0.01))
+        self.in_flight -= 1
+        return self.fetch_path(source_lng, source_lat, target_lng,
+                               target_lat, params)
+
+
+class FakeMatrixRouter(FakeRouter):
+    """Router with a matrix API taking up to 5 locations per request."""
+
+    matrix_max_locations = 5
+
+    def __init__(self):
+        super(FakeMatrixRouter, self).__init__()
+        self.batches = []
+
+    def request_matrix(self, source, targets, params=None):
+        self.batches.append(len(targets))
+        return [None if int(round(lng)) % 2 else
+                {'duration': lng * 60, 'distance': lng * 100}
+                for lng, lat in targets]
+
+
+class FlakyRouter(FakeRouter):
+    """Router failing the first requests for every target, and refusing
+    the targets beyond 15.
+    """
+
+    def __init__(self, failures):
+        super(FlakyRouter, self).__init__()
+        self.failures = failures
+        self.attempts = collections.Counter()
+
+    def fetch_path(self, source_lng, source_lat, target_lng, target_lat,
+                   params=None):
+        self.attempts[target_lng] += 1
+        if target_lng > 15:
+            raise errors.PermanentError("Invalid target")
+        if self.attempts[target_lng] <= self.failures:
+            raise errors.TransientError("Service unavailable")
+        return super(FlakyRouter, self).fetch_path(
+            source_lng, source_lat, target_lng, target_lat, params)
+
+
+class CalAccessibilityTestCase(TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.landmark = {'geometry': {'coordinates': [0.0, 0.0]}}
+        self.points = [{'id': i, 'x': float(i), 'y': 0.0} for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_sequential_probing(self):
+        res = cal_accessibility(FakeRouter(), self.landmark, self.points,
+                                self.output_dir)
+        self.assertEqual([p['id'] for p in res], list(range(20)))
+        self.assertEqual([p['acc'] for p in res], [1, 0] * 10)
+
+    def test_concurrent_probing_keeps_input_order(self):
+        router = FakeRouter(delay=0.01)
+        res = cal_accessibility(router, self.landmark, self.points,
+                                self.output_dir, workers=4)
+        self.assertEqual([p['id'] for p in res], list(range(20)))
+        self.assertEqual([p['acc'] for p in res], [1, 0] * 10)
+        self.assertGreater(len(router.threads), 1)
+
+    def test_concurrent_probing_respects_rate_limit(self):
+        router = FakeRouter(rate_limit=200)
+        start = time.monotonic()
+        cal_accessibility(router, self.landmark, self.points,
+                          self.output_dir, workers=8)
+        self.assertGreaterEqual(time.monotonic() - start, 19 / 200.0)
+
+    def test_matrix_probing_in_batches(self):
+        router = FakeMatrixRouter()
+        res = cal_accessibility_matrix(router, self.landmark, self.points,
+                                       workers=2)
+        self.assertEqual(sorted(router.batches), [4] * 5)
+        self.assertEqual([p['id'] for p in res], list(range(20)))
+        self.assertEqual([p['acc'] for p in res], [1, 0] * 10)
+        self.assertEqual(res[2]['duration'], 120)
+        self.assertIsNone(res[3]['distance'])
+
+    def test_matrix_probing_falls_back_to_find_path(self):
+        res = cal_accessibility_matrix(FakeRouter(), self.landmark,
+                                       self.points)
+        self.assertEqual([p['acc'] for p in res], [1, 0] * 10)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_summary_probing_saves_no_route(self):
+        rows = iter_accessibility_summary(FakeRouter(), self.landmark,
+                                          self.points, workers=4)
+        res = list(rows)
+        self.assertEqual([p['id'] for p in res], list(range(20)))
+        self.assertEqual([p['acc'] for p in res], [1, 0] * 10)
+        self.assertEqual(set(res[0]), {'id', 'x', 'y', 'acc', 'duration',
+                                       'distance'})
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_streaming_consumes_points_lazily(self):
+        consumed = []
+
+        def points():
+            for p in self.points:
+                consumed.append(p['id'])
+                yield p
+
+        rows = iter_accessibility(FakeRouter(delay=0.001), self.landmark,
+                                  points(), self.output_dir, workers=2)
+        self.assertEqual(next(rows)['id'], 0)
+        self.assertLessEqual(len(consumed), 5)
+        self.assertEqual([p['id'] for p in rows], list(range(1, 20)))
+
+    def test_async_probing_keeps_input_order(self):
+        router = FakeAsyncRouter()
+        rows = iter_accessibility_in_event_loop(
+            router, self.landmark, iter(self.points), self.output_dir,
+            concurrency=8)
+        res = list(rows)
+        self.assertEqual([p['id'] for p in res], list(range(20)))
+        self.assertEqual([p['acc'] for p in res], [1, 0] * 10)
+        self.assertEqual(len(os.listdir(self.output_dir)), 10)
+        self.assertGreater(router.max_in_flight_seen, 1)
+        self.assertLessEqual(router.max_in_flight_seen, 8)
+        self.assertEqual(router.threads, {threading.main_thread().name})
+
+    def test_sources_are_named_after_the_landmark(self):
+        landmark = dict(self.landmark, id=3)
+        cal_accessibility(FakeRouter(), landmark, self.points[:4],
+                          self.output_dir)
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['3_0.json', '3_2.json'])
+
+    def test_read_landmarks(self):
+        landmarks = read_landmarks('./input/muenchen-hbf.json')
+        self.assertEqual([l['id'] for l in landmarks], [0])
+        landmarks = read_landmarks('./input/munich-stations.json')
+        self.assertEqual([l['id'] for l in landmarks], [0, 1, 2])
+        self.assertEqual(landmarks[0]['geometry']['type'], 'Point')
+
+    def test_shards_are_merged_in_order(self):
+        landmarks = [dict(self.landmark, id=i) for i in (5, 6)]
+        shards = make_shards(landmarks, self.points, 8)
+        self.assertEqual([s['name'] for s in shards],
+                         ['5_0-7', '5_8-15', '5_16-19', '6_0-7', '6_8-15',
+                          '6_16-19'])
+        for shard in reversed(shards):
+            journal = ResultJournal(os.path.join(
+                self.output_dir, shard['name'] + '.csv'), ACC_FIELDNAMES)
+            for pt in iter_accessibility(FakeRouter(), shard['landmark'],
+                                         shard['points'], self.output_dir):
+                journal.write(pt)
+            journal.close()
+        results = os.path.join(self.output_dir, 'results.csv')
+        merge_shards(shards, self.output_dir, results, ACC_FIELDNAMES)
+        with open(results) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([(r['landmark'], r['id']) for r in rows],
+                         [(str(l), str(i)) for l in (5, 6)
+                          for i in range(20)])
+
+    def test_results_of_routers_are_joined(self):
+        for name, router in [('slow', FakeRouter()), ('fast', FakeRouter())]:
+            with ResultJournal(os.path.join(self.output_dir, name + '.csv'),
+                               MATRIX_FIELDNAMES) as journal:
+                pts = self.points if name == 'fast' else self.points[:5]
+                for pt in iter_accessibility_summary(router, self.landmark,
+                                                     reversed(pts)):
+                    journal.write(pt)
+        results = os.path.join(self.output_dir, 'joined.csv')
+        join_results(['fast', 'slow'], self.output_dir, results, self.points,
+                     MATRIX_FIELDNAMES)
+        with open(results) as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+        self.assertEqual(reader.fieldnames,
+                         ['id', 'x', 'y', 'fast_acc', 'fast_duration',
+                          'fast_distance', 'slow_acc', 'slow_duration',
+                          'slow_distance'])
+        self.assertEqual([r['id'] for r in rows],
+                         [str(p['id']) for p in self.points])
+        self.assertEqual([r['fast_acc'] for r in rows[:4]],
+                         ['1', '0', '1', '0'])
+        self.assertEqual(rows[4]['slow_acc'], rows[4]['fast_acc'])
+        self.assertEqual(rows[5]['slow_acc'], '')
+
+    def test_failed_points_are_retried_then_given_up(self):
+        for failures, given_up in [(2, 4), (3, 20)]:
+            router = FlakyRouter(failures)
+            dead = []
+            probe = functools.partial(iter_accessibility_summary, router,
+                                      self.landmark)
+            res = list(probe_with_retries(probe, self.points, dead.append,
+                                          rounds=2, backoff=0))
+            self.assertEqual(len(res) + len(dead), 20)
+            self.assertEqual(len(dead), given_up)
+            # Refused points are not retried
+            self.assertEqual(router.attempts[16.0], 1)
+        self.assertEqual(dead[0]['error'], 'permanent')
+        self.assertEqual(dead[0]['message'], 'Invalid target')
+
+    def test_dead_letters_are_kept_only_if_any(self):
+        path = os.path.join(self.output_dir, 'fake-failed.csv')
+        close_dead_letters(open_dead_letters(path), report=False)
+        self.assertFalse(os.path.exists(path))
+        dead_letters = open_dead_letters(path)
+        dead_letters.write(failed_row(self.points[0],
+                                      errors.PermanentError('Refused')))
+        close_dead_letters(dead_letters, report=False)
+        with open(path) as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 1)
+
+    def test_collected_results_without_failures(self):
+        queue = WorkQueue(os.path.join(self.output_dir, 'job.db'))
+        queue.enqueue({'router': 'fake', 'mode': 'summary'},
+                      [dict(self.landmark, id=0)], self.points)
+        tasks = queue.claim('w', batch_size=20)
+        queue.complete('w', 0, [dict(p, acc=1) for _, p in tasks[1:]])
+        failed = os.path.join(self.output_dir, 'fake-failed.csv')
+        collect_results(queue, self.output_dir)
+        self.assertFalse(os.path.exists(failed))
+        with open(os.path.join(self.output_dir, 'fake.csv')) as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 19)
+        queue.complete('w', 0, [failed_row(tasks[0][1],
+                                           errors.PermanentError('Refused'))])
+        collect_results(queue, self.output_dir)
+        queue.close()
+        self.assertTrue(os.path.isfile(failed))
+
+    def test_map_in_order_with_window(self):
+        res = map_in_order(lambda i: i * i, iter(range(100)), workers=4,
+                           window=3)
+        self.assertEqual(list(res), [i * i for i in range(100)])
+
+    def test_read_points(self):
+        pts = read_points('./input/mini_munich.csv')
+        self.assertEqual(next(pts), {'x': 11.45, 'y': 48.2, 'id': 0})
+        self.assertEqual(len(list(pts)), 3)
+
+
+class ArgumentsTestCase(TestCase):
+
+    argv = ['-r', 'mapbox', '-p', 'walking', '-f', './input/muenchen-hbf.json',
+            '-t', './input/munich.csv']
+
+    def setUp(self):
+        with open('appconf.json', 'r') as f:
+            self.appconf = json.load(f)
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_help_lines_are_not_options(self):
+        # docopt reads every line starting with a dash as an option
+        _, _, arguments = rapy.__doc__.partition('\nArguments:')
+        for line in arguments.splitlines():
+            self.assertFalse(line.lstrip().startswith('-'), line)
+        args = docopt(rapy.__doc__, argv=self.argv + ['--adaptive', '0.016'])
+        self.assertEqual(args['--adaptive'], '0.016')
+
+    def test_defaults_are_valid(self):
+        argv = self.argv + ['-o', self.output_dir]
+        args = validate_arguments(docopt(rapy.__doc__, argv=argv),
+                                  self.appconf)
+        self.assertEqual(args['-r'], 'mapbox')
+        self.assertIsNone(args['--adaptive'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from unittest import TestCase, main
+from rap.base import RoutingService
+from rap.ratelimit import CircuitBreaker, RateLimiter, TokenBucket, \
+    retry_after_seconds
+from stubs import ScriptedAdapter
+
+
+class RateLimiterTestCase(TestCase):
+
+    def test_burst_then_steady_rate(self):
+        limiter = RateLimiter([TokenBucket(100, capacity=5)])
+        waits = [limiter.reserve() for _ in range(7)]
+        self.assertEqual(waits[:5], [0.0] * 5)
+        self.assertAlmostEqual(waits[5], 0.01, delta=0.002)
+        self.assertAlmostEqual(waits[6], 0.02, delta=0.002)
+
+    def test_from_conf(self):
+        self.assertEqual(RateLimiter.from_conf(-1).buckets, [])
+        limiter = RateLimiter.from_conf(
+            {'per_day': 2000, 'per_minute': 40, 'burst': 5})
+        self.assertEqual([b.capacity for b in limiter.buckets], [5, 2000])
+        self.assertAlmostEqual(limiter.buckets[0].rate, 40 / 60.0)
+
+    def test_from_conf_with_share(self):
+        limiter = RateLimiter.from_conf({'per_minute': 40, 'per_day': 2000},
+                                        share=0.25)
+        self.assertEqual([b.capacity for b in limiter.buckets], [10, 500])
+        self.assertAlmostEqual(limiter.buckets[0].rate, 10 / 60.0)
+        self.assertAlmostEqual(RateLimiter.from_conf(8, 0.5).buckets[0].rate,
+                               4)
+
+    def test_backoff_and_recover(self):
+        limiter = RateLimiter([TokenBucket(100)])
+        limiter.backoff(retry_after=0.05)
+        self.assertEqual(limiter.factor, 0.5)
+        self.assertGreaterEqual(limiter.reserve(), 0.04)
+        for _ in range(100):
+            limiter.recover()
+        self.assertEqual(limiter.factor, 1.0)
+
+    def test_acquire_async(self):
+        limiter = RateLimiter([TokenBucket(200, capacity=1)])
+
+        async def probe():
+            await asyncio.gather(*[limiter.acquire_async()
+                                   for _ in range(10)])
+
+        start = time.monotonic()
+        asyncio.run(probe())
+        self.assertGreaterEqual(time.monotonic() - start, 9 / 200.0)
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(retry_after_seconds({'Retry-After': '3'}), 3.0)
+        self.assertIsNone(retry_after_seconds({}))
+        later = time.time() + 10
+        self.assertAlmostEqual(
+            retry_after_seconds({'X-Rate-Limit-Reset': str(later)}), 10,
+            delta=1)
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    def test_opens_when_too_many_requests_fail(self):
+        breaker = CircuitBreaker(threshold=0.5, window=4, cooldown=10.0,
+                                 max_cooldown=15.0)
+        for failed in (True, False, True, False):
+            breaker.record(failed)
+        self.assertEqual(breaker.wait_time(), 0.0)
+        for failed in (True, True, True):
+            breaker.record(failed)
+        self.assertAlmostEqual(breaker.wait_time(), 10.0, delta=0.1)
+        # The pause doubles while the requests keep failing
+        for _ in range(4):
+            breaker.record(True)
+        self.assertAlmostEqual(breaker.wait_time(), 15.0, delta=0.1)
+        self.assertEqual(breaker.trips, 2)
+
+    def test_from_conf(self):
+        self.assertIsNone(CircuitBreaker.from_conf(False))
+        self.assertEqual(CircuitBreaker.from_conf(None).window, 50)
+        self.assertEqual(CircuitBreaker.from_conf({'window': 5}).window, 5)
+
+    def test_router_pauses_after_server_errors(self):
+        router = RoutingService()
+        router.breaker = CircuitBreaker(window=2, cooldown=0.2)
+        router.session.mount('http://', ScriptedAdapter([503, 503, 200]))
+        for _ in range(2):
+            router.send_request('http://router.test/route')
+        start = time.monotonic()
+        resp = router.send_request('http://router.test/route')
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+
+class SendRequestTestCase(TestCase):
+
+    def test_retry_on_too_many_requests(self):
+        router = RoutingService()
+        adapter = ScriptedAdapter([429, 429, 200], {'Retry-After': '0'})
+        router.session.mount('http://', adapter)
+        resp = router.send_request('http://router.test/route')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(adapter.sent, 3)
+        self.assertLess(router.limiter.factor, 1.0)
+
+    def test_give_up_after_retries(self):
+        router = RoutingService()
+        router.rate_limit_retries = 1
+        adapter = ScriptedAdapter([429], {'Retry-After': '0'})
+        router.session.mount('http://', adapter)
+        resp = router.send_request('http://router.test/route')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(adapter.sent, 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase, main, skipIf
+from rap import base, errors
+from rap.google import GoogleMapsRouter
+from rap.mapbox import MapboxRouter
+from rap.mockserver import MockRoutingServer
+from rap.replay import RECORD, REPLAY, STRICT, Archive, request_key
+from stubs import ScriptedAdapter
+
+ORIGIN = (11.55, 48.18)
+TARGETS = [(11.62, 48.11), (11.58, 48.14), (11.5, 48.2)]
+
+
+class RequestKeyTestCase(TestCase):
+
+    def test_query_order_host_and_api_keys_are_ignored(self):
+        self.assertEqual(
+            request_key('get', 'http://h/route?b=1&access_token=A&a=2'),
+            request_key('GET', 'https://m/route?a=2&b=1&access_token=B'))
+        self.assertNotEqual(request_key('GET', 'http://h/route?a=2'),
+                            request_key('GET', 'http://h/route?a=3'))
+        self.assertNotEqual(request_key('POST', 'http://h/m', '{"a": 1}'),
+                            request_key('POST', 'http://h/m', '{"a": 2}'))
+
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'job.archive')
+        self.mock = MockRoutingServer(seed=1).start()
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def router(self, archive, mode, key='KEY'):
+        router = MapboxRouter('walking', key)
+        router.set_base_url(self.mock.url)
+        router.use_archive(archive, mode)
+        return router
+
+    def find_paths(self, router):
+        return [router.find_path(ORIGIN[0], ORIGIN[1], x, y)
+                for x, y in TARGETS] + \
+            [router.find_paths_matrix(ORIGIN, TARGETS)]
+
+    def test_recorded_job_is_replayed_without_requests(self):
+        archive = Archive(self.path)
+        recorded = self.find_paths(self.router(archive, RECORD))
+        self.assertEqual(self.mock.stats['requests'], 4)
+        archive.close()
+        archive = Archive(self.path)
+        router = self.router(archive, STRICT, 'OTHER-KEY')
+        self.assertEqual(self.find_paths(router), recorded)
+        self.assertEqual(self.mock.stats['requests'], 4)
+        self.assertEqual(archive.stats(),
+                         {'hits': 4, 'misses': 0, 'entries': 4})
+        with self.assertRaises(errors.NotRecordedError) as ctx:
+            router.find_path(ORIGIN[0], ORIGIN[1], 11.7, 48.0)
+        self.assertIn('11.7%2C48.0', str(ctx.exception))
+        self.assertNotIn('OTHER-KEY', str(ctx.exception))
+        archive.close()
+
+    def test_google_replays_are_not_rate_limited(self):
+        archive = Archive(self.path)
+
+        def find_paths(mode, rate_limit=-1):
+            router = GoogleMapsRouter('walking', 'AIza-mock', rate_limit)
+            router.set_base_url(self.mock.url)
+            router.use_archive(archive, mode)
+            return [router.find_path(ORIGIN[0], ORIGIN[1], x, y)
+                    for x, y in TARGETS]
+
+        recorded = find_paths(RECORD)
+        start = time.monotonic()
+        self.assertEqual(find_paths(REPLAY, 1), recorded)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(self.mock.stats['requests'], 3)
+        router = GoogleMapsRouter('walking', 'AIza-mock')
+        router.set_base_url(self.mock.url)
+        router.use_archive(archive, STRICT)
+        with self.assertRaises(errors.NotRecordedError):
+            router.find_path(ORIGIN[0], ORIGIN[1], 11.7, 48.0)
+        archive.close()
+
+    def test_requests_not_recorded_are_sent_and_recorded(self):
+        archive = Archive(self.path)
+        router = self.router(archive, REPLAY)
+        first = router.find_path(ORIGIN[0], ORIGIN[1], *TARGETS[0])
+        second = router.find_path(ORIGIN[0], ORIGIN[1], *TARGETS[0])
+        self.assertEqual(first, second)
+        self.assertEqual(self.mock.stats['requests'], 1)
+        self.assertEqual(archive.stats()['entries'], 1)
+        archive.close()
+
+    def test_failed_requests_are_not_recorded(self):
+        archive = Archive(self.path)
+        router = MapboxRouter('walking', 'KEY')
+        router.set_base_url('http://127.0.0.1:9')
+        for prefix in list(router.session.adapters):
+            router.session.mount(prefix, ScriptedAdapter([503, 429]))
+        router.use_archive(archive, RECORD)
+        router.rate_limit_retries = 0
+        for _ in range(2):
+            try:
+                router.find_path(ORIGIN[0], ORIGIN[1], *TARGETS[0])
+            except Exception:
+                pass
+        self.assertEqual(archive.stats()['entries'], 0)
+        archive.close()
+
+    @skipIf(base.aiohttp is None, "aiohttp is not installed")
+    def test_async_requests_are_replayed(self):
+        archive = Archive(self.path)
+
+        async def find_paths(mode):
+            router = self.router(archive, mode)
+            try:
+                return await asyncio.gather(*[router.find_path_async(
+                    ORIGIN[0], ORIGIN[1], x, y) for x, y in TARGETS])
+            finally:
+                await router.close_async()
+
+        recorded = asyncio.run(find_paths(RECORD))
+        self.assertEqual(asyncio.run(find_paths(STRICT)), recorded)
+        self.assertEqual(self.mock.stats['requests'], 3)
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, main, mock
+from rap import errors, servicefactory
+from rap.base import RoutingService
+from rap.servicefactory import RoutingServiceFactory, get_router_class, \
+    register_router, router_names
+
+
+class ConfRouter(RoutingService):
+    """Router keeping the settings it is created with."""
+
+    def __init__(self, profile, api_key, rate_limit=-1, cache=None,
+                 pool_size=None, route_cache=None, http=None):
+        super(ConfRouter, self).__init__(api_key, cache, rate_limit,
+                                         pool_size, route_cache, http)
+        self.profile = profile
+        self.base_url = None
+
+    def set_base_url(self, base_url):
+        self.base_url = base_url
+
+
+class FakeEntryPoints(object):
+
+    def select(self, group):
+        ep = mock.Mock(value='test_servicefactory:ConfRouter')
+        ep.name = 'graphhopper'
+        return [ep] if group == servicefactory.ENTRY_POINT_GROUP else []
+
+
+class RoutingServiceFactoryTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.conf_file = os.path.join(self.tmp_dir, 'routerconf.json')
+        self.write_conf({'fake': {'key': 'KEY', 'rate_limit': 5,
+                                  'base_url': 'http://127.0.0.1:8000'}})
+        self.routers = mock.patch.dict(servicefactory._routers)
+        self.routers.start()
+
+    def tearDown(self):
+        self.routers.stop()
+        servicefactory._router_confs.pop(self.conf_file, None)
+        shutil.rmtree(self.tmp_dir)
+
+    def write_conf(self, conf):
+        with open(self.conf_file, 'w') as f:
+            json.dump(conf, f)
+
+    def test_routers_are_imported_on_first_use(self):
+        register_router('fake', 'test_servicefactory:ConfRouter')
+        self.assertIsInstance(servicefactory._routers['fake'], str)
+        router = RoutingServiceFactory('fake', 'walking', pool_size=4,
+                                       conf_file=self.conf_file)
+        self.assertIsInstance(router, ConfRouter)
+        self.assertIs(servicefactory._routers['fake'], ConfRouter)
+        self.assertEqual((router.profile, router.api_key, router.rate_limit),
+                         ('walking', 'KEY', 5))
+        self.assertEqual(router.base_url, 'http://127.0.0.1:8000')
+        self.assertEqual(router.pool_size, 4)
+
+    def test_router_conf_is_read_once(self):
+        register_router('fake', ConfRouter)
+        RoutingServiceFactory('fake', 'walking', conf_file=self.conf_file)
+        self.write_conf({'fake': {'key': 'OTHER-KEY'}})
+        router = RoutingServiceFactory('fake', 'walking',
+                                       conf_file=self.conf_file)
+        self.assertEqual(router.api_key, 'KEY')
+
+    def test_unknown_router(self):
+        with mock.patch.object(servicefactory, '_plugins_loaded', True):
+            self.assertIsNone(RoutingServiceFactory(
+                'nowhere', 'walking', conf_file=self.conf_file))
+            with self.assertRaises(errors.InvalidParameterError):
+                get_router_class('nowhere')
+
+    def test_routers_of_entry_points(self):
+        with mock.patch.object(servicefactory, 'entry_points',
+                               FakeEntryPoints), \
+                mock.patch.object(servicefactory, '_plugins_loaded', False):
+            self.assertIs(get_router_class('graphhopper'), ConfRouter)
+            self.assertEqual(router_names(), sorted(
+                list(servicefactory.BUILTIN_ROUTERS) + ['graphhopper']))
+
+    def test_cli_does_not_import_the_routers(self):
+        code = ("import sys; import rap.rapy; print(sorted(m for m in "
+                "('rap.mapbox', 'rap.ors', 'rap.google', 'googlemaps', "
+                "'uritemplate', 'cachecontrol') if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      universal_newlines=True)
+        self.assertEqual(out.strip(), '[]')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from rap.store import DirectoryStore, SQLiteStore, SQLiteStoreReader
+
+
+class RouteStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_directory_store(self):
+        output_dir = os.path.join(self.tmp_dir, 'mapbox', 'walking')
+        store = DirectoryStore(output_dir)
+        store.save(-1, 7, {'routes': [1, 2]})
+        store.close()
+        with open(os.path.join(output_dir, '-1_7.json')) as f:
+            self.assertEqual(json.load(f), {'routes': [1, 2]})
+
+    def test_raw_routes_are_saved_untouched(self):
+        body = b'{"code": "Ok", "routes": [1.50]}'
+        store = DirectoryStore(self.tmp_dir)
+        store.save(-1, 7, body)
+        with open(os.path.join(self.tmp_dir, '-1_7.json'), 'rb') as f:
+            self.assertEqual(f.read(), body)
+        path = os.path.join(self.tmp_dir, 'routes.db')
+        store = SQLiteStore(path)
+        store.save(-1, 7, body)
+        store.close()
+        reader = SQLiteStoreReader(path)
+        self.assertEqual(reader.get(7), {'code': 'Ok', 'routes': [1.5]})
+        reader.close()
+
+    def test_sqlite_store_merge(self):
+        paths = [os.path.join(self.tmp_dir, name) for name in ('a.db', 'b.db')]
+        for source_id, path in enumerate(paths):
+            store = SQLiteStore(path)
+            store.save(source_id, 7, {'source': source_id})
+            store.close()
+        store = SQLiteStore(paths[0])
+        store.merge(paths[1])
+        store.close()
+        reader = SQLiteStoreReader(paths[0])
+        self.assertEqual([(s, t) for s, t, r in reader], [(0, 7), (1, 7)])
+        self.assertEqual(reader.get(7, 1), {'source': 1})
+        reader.close()
+
+    def test_sqlite_store_in_batches(self):
+        path = os.path.join(self.tmp_dir, 'run', 'routes.db')
+        store = SQLiteStore(path, batch_size=3)
+        for i in range(10):
+            store.save(-1, 9 - i, {'target': 9 - i})
+        reader = SQLiteStoreReader(path)
+        self.assertEqual(len(reader.target_ids()), 9)
+        store.close()
+        self.assertEqual(reader.target_ids(), list(range(10)))
+        self.assertEqual(reader.get(4), {'target': 4})
+        self.assertIsNone(reader.get(42))
+        self.assertEqual([t for s, t, r in reader], list(range(10)))
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, main
+from rap import errors
+from rap.workqueue import WorkQueue
+
+
+class WorkQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'job.db')
+        self.settings = {'router': 'mapbox', 'profile': 'walking',
+                         'mode': 'summary', 'params': None}
+        self.landmarks = [{'id': i, 'type': 'Feature', 'geometry': {
+            'type': 'Point', 'coordinates': [11.5, 48.1]}} for i in (1, 0)]
+        self.points = [{'id': i, 'x': 11.0 + i, 'y': 48.0}
+                       for i in range(10)]
+        self.queue = WorkQueue(self.path)
+        self.queue.enqueue(self.settings, self.landmarks, self.points)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def complete(self, queue, worker, tasks):
+        for landmark, p in tasks:
+            queue.complete(worker, landmark, [dict(p, acc=1)])
+
+    def test_enqueue_is_idempotent(self):
+        self.assertEqual(self.queue.enqueue(self.settings, self.landmarks,
+                                            self.points[:5]), 0)
+        self.assertEqual(self.queue.progress(),
+                         {'pending': 20, 'leased': 0, 'done': 0, 'dead': 0})
+        self.assertEqual(self.queue.settings(), self.settings)
+        self.assertEqual(sorted(self.queue.landmarks()), [0, 1])
+        with self.assertRaises(errors.InvalidParameterError):
+            self.queue.enqueue(dict(self.settings, router='google'),
+                               self.landmarks, self.points)
+
+    def test_workers_claim_disjoint_batches(self):
+        def work(worker):
+            queue = WorkQueue(self.path)
+            claimed = []
+            while True:
+                tasks = queue.claim(worker, batch_size=3)
+                if not tasks:
+                    break
+                claimed.extend((l, p['id']) for l, p in tasks)
+                self.complete(queue, worker, tasks)
+            queue.close()
+            return claimed
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            claimed = sum(executor.map(work, ['w{0}'.format(i)
+                                              for i in range(4)]), [])
+        self.assertEqual(sorted(claimed),
+                         [(l, i) for l in (0, 1) for i in range(10)])
+        results = list(self.queue.results())
+        self.assertEqual([(l, r['id']) for l, r in results],
+                         [(l, i) for l in (0, 1) for i in range(10)])
+
+    def test_expired_leases_are_claimed_again(self):
+        dead = WorkQueue(self.path, lease_seconds=0.05)
+        lost = dead.claim('dead', batch_size=15)
+        self.complete(dead, 'dead', lost[:5])
+        dead.close()
+        self.assertEqual(len(self.queue.claim('alive', batch_size=20)), 5)
+        time.sleep(0.1)
+        tasks = self.queue.claim('alive', batch_size=20)
+        self.assertEqual(tasks, lost[5:])
+        self.complete(self.queue, 'alive', tasks)
+        self.assertEqual(self.queue.progress(),
+                         {'pending': 0, 'leased': 5, 'done': 15,
+                          'dead': 0})
+
+    def test_released_tasks_are_pending(self):
+        tasks = self.queue.claim('w', batch_size=4)
+        self.complete(self.queue, 'w', tasks[:1])
+        self.queue.release('w', tasks)
+        self.assertEqual(self.queue.progress(),
+                         {'pending': 19, 'leased': 0, 'done': 1,
+                          'dead': 0})
+        self.assertEqual(self.queue.claim('v', batch_size=3), tasks[1:])
+
+        # Released tasks do not use up their attempts
+        for _ in range(4):
+            self.queue.release('v', self.queue.claim('v', batch_size=20))
+        self.assertEqual(self.queue.progress()['dead'], 0)
+
+    def test_given_up_tasks_are_dead_until_requeued(self):
+        tasks = self.queue.claim('w', batch_size=20)
+        self.complete(self.queue, 'w', tasks[1:])
+        landmark, p = tasks[0]
+        self.queue.complete('w', landmark, [dict(p, error='transient')])
+        self.assertEqual(self.queue.progress(),
+                         {'pending': 0, 'leased': 0, 'done': 19, 'dead': 1})
+        results = list(self.queue.results())
+        self.assertEqual(len(results), 20)
+        self.assertEqual(results[10], (landmark, dict(p, error='transient')))
+        self.assertEqual(self.queue.requeue_dead(), 1)
+        self.assertEqual(self.queue.claim('w'), tasks[:1])
+        self.complete(self.queue, 'w', tasks[:1])
+        self.assertEqual(self.queue.progress()['done'], 20)
+        self.assertEqual(self.queue.requeue_dead(), 0)
+
+    def test_tasks_out_of_attempts_are_dead(self):
+        queue = WorkQueue(self.path, lease_seconds=0.01, max_attempts=2)
+        for _ in range(2):
+            self.assertEqual(len(queue.claim('dead', batch_size=20)), 20)
+            time.sleep(0.02)
+        self.assertEqual(queue.claim('dead'), [])
+        self.assertEqual(queue.progress(),
+                         {'pending': 0, 'leased': 0, 'done': 0, 'dead': 20})
+        landmark, result = next(queue.results())
+        self.assertEqual(result['error'], 'expired')
+        queue.requeue_dead()
+        self.assertEqual(len(queue.claim('alive', batch_size=20)), 20)
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()